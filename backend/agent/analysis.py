@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import logging
+import os
+from dataclasses import dataclass
+
+from agent.image import (
+    IMAGE_DECODE_ERRORS,
+    PreprocessedImage,
+    compute_image_dhash,
+    crop_to_receipt,
+    get_image_process_pool,
+    open_receipt_image,
+    preprocess_decoded_image_from_settings,
+)
+from agent.preclassifier import ReceiptImageScore, score_cropped_image
+from config import settings
+from metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+# Size the JPEG decoder may downscale to when only the previews of the pre-classifier and dHash are needed
+PREVIEW_DRAFT_SIZE = 512
+
+
+@dataclass(frozen=True)
+class ReceiptImageAnalysis:
+    """
+    Results of the CPU-bound steps run on a receipt image before it is parsed.
+
+    Each result is None when its step was not requested or the image could not be decoded.
+    """
+
+    image_score: ReceiptImageScore | None = None
+    dhash: int | None = None
+    processed: PreprocessedImage | None = None
+
+
+def analyze_receipt_image(
+    source: bytes | str,
+    classify: bool | None = None,
+    dhash: bool | None = None,
+    preprocess: bool | None = None,
+) -> ReceiptImageAnalysis:
+    """
+    Decode a receipt image once and run the requested steps on it.
+
+    The pre-classifier, the perceptual hash and the preprocessing all work on the image auto-rotated
+    and cropped to the receipt, so they share one decode instead of each decoding the image, which for
+    HEIC photos costs more than the steps themselves. Steps default to whether they are enabled in the
+    settings.
+
+    Args:
+        source (bytes | str): The JPEG, PNG or HEIC image content, or the path of a file holding it.
+        classify (bool | None): Whether to score the image with the pre-classifier, see agent/preclassifier.py.
+        dhash (bool | None): Whether to compute the perceptual hash of the image, see orm/perceptual.py.
+        preprocess (bool | None): Whether to re-encode the image for the LLM with the configured options.
+
+    Returns:
+        ReceiptImageAnalysis: The results of the steps.
+    """
+    classify = settings.preclassifier_enabled if classify is None else classify
+    dhash = settings.perceptual_dedup_enabled if dhash is None else dhash
+    preprocess = settings.image_preprocessing_enabled if preprocess is None else preprocess
+    if not (classify or dhash or preprocess):
+        return ReceiptImageAnalysis()
+
+    try:
+        draft_size = settings.image_max_dimension if preprocess else PREVIEW_DRAFT_SIZE
+        image = open_receipt_image(source, mode="RGB", draft_size=draft_size)
+        cropped = crop_to_receipt(image)
+        processed = None
+        if preprocess:
+            original_size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+            processed = preprocess_decoded_image_from_settings(
+                cropped if settings.image_crop_to_receipt else image, original_size=original_size
+            )
+        return ReceiptImageAnalysis(
+            image_score=score_cropped_image(cropped) if classify else None,
+            dhash=compute_image_dhash(cropped) if dhash else None,
+            processed=processed,
+        )
+    except IMAGE_DECODE_ERRORS:
+        logger.warning("Could not decode receipt image, sending the original to the LLM.", exc_info=True)
+        return ReceiptImageAnalysis()
+
+
+async def analyze_receipt_image_async(
+    source: bytes | memoryview | str,
+    classify: bool | None = None,
+    dhash: bool | None = None,
+    preprocess: bool | None = None,
+) -> ReceiptImageAnalysis:
+    """
+    Async variant of analyze_receipt_image running in a single task of the image process pool.
+
+    A file path is passed to the worker as is; other content is copied once to be pickled, which
+    memoryviews do not support.
+    """
+    classify = settings.preclassifier_enabled if classify is None else classify
+    dhash = settings.perceptual_dedup_enabled if dhash is None else dhash
+    preprocess = settings.image_preprocessing_enabled if preprocess is None else preprocess
+    if not (classify or dhash or preprocess):
+        return ReceiptImageAnalysis()
+
+    if isinstance(source, memoryview):
+        source = bytes(source)
+    loop = asyncio.get_running_loop()
+    with track_stage("image_analysis"):
+        return await loop.run_in_executor(
+            get_image_process_pool(),
+            functools.partial(analyze_receipt_image, source, classify=classify, dhash=dhash, preprocess=preprocess),
+        )
@@ -0,0 +1,221 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+
+from pydantic import ValidationError
+
+from config import settings
+from orm.data_models import GroceryReceiptSchema
+
+
+def make_parse_cache_key(image_hash: str, model: str, prompt_version: str) -> str:
+    """
+    Build the cache key for a parsed receipt.
+
+    Args:
+        image_hash (str): The SHA-256 hash of the receipt image.
+        model (str): The name of the model that parsed the receipt.
+        prompt_version (str): The version of the parsing prompt.
+
+    Returns:
+        str: The cache key.
+    """
+    return f"{model}:{prompt_version}:{image_hash}"
+
+
+class ParseCache(ABC):
+    """
+    Base class for caches of parsed grocery receipts.
+
+    Entries are stored as serialized GroceryReceiptSchema JSON, expire after `ttl_seconds`
+    and the least recently used entries are evicted once `max_entries` is exceeded.
+    """
+
+    def __init__(self, ttl_seconds: float | None = None, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+    def get(self, key: str) -> GroceryReceiptSchema | None:
+        """Return the cached parse for the key, or None on a miss."""
+        payload = self._get(key)
+        if payload is None:
+            return None
+
+        try:
+            return GroceryReceiptSchema.model_validate_json(payload)
+        except ValidationError:
+            # Entry written by an incompatible schema version
+            self.delete(key)
+            return None
+
+    def set(self, key: str, gr_schema: GroceryReceiptSchema):
+        """Cache the parse for the key."""
+        self._set(key, gr_schema.model_dump_json())
+
+    async def get_async(self, key: str) -> GroceryReceiptSchema | None:
+        """Return the cached parse for the key without blocking the event loop."""
+        return await asyncio.to_thread(self.get, key)
+
+    async def set_async(self, key: str, gr_schema: GroceryReceiptSchema):
+        """Cache the parse for the key without blocking the event loop."""
+        await asyncio.to_thread(self.set, key, gr_schema)
+
+    def _expires_at(self) -> float | None:
+        return time.time() + self.ttl_seconds if self.ttl_seconds else None
+
+    @abstractmethod
+    def _get(self, key: str) -> str | None: ...
+
+    @abstractmethod
+    def _set(self, key: str, payload: str): ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Remove the entry for the key if present."""
+
+    @abstractmethod
+    def clear(self):
+        """Remove all entries."""
+
+    @abstractmethod
+    def __len__(self) -> int: ...
+
+
+class MemoryParseCache(ParseCache):
+    """In-process LRU parse cache."""
+
+    def __init__(self, ttl_seconds: float | None = None, max_entries: int = 1024):
+        super().__init__(ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self._entries: OrderedDict[str, tuple[float | None, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get_async(self, key: str) -> GroceryReceiptSchema | None:
+        # Lookups never block, so skip the thread hop
+        return self.get(key)
+
+    async def set_async(self, key: str, gr_schema: GroceryReceiptSchema):
+        self.set(key, gr_schema)
+
+    def _get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, payload = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return payload
+
+    def _set(self, key: str, payload: str):
+        with self._lock:
+            self._entries[key] = (self._expires_at(), payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteParseCache(ParseCache):
+    """On-disk LRU parse cache backed by SQLite, shared by all processes using the same file."""
+
+    def __init__(self, path: str | Path, ttl_seconds: float | None = None, max_entries: int = 1024):
+        super().__init__(ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS parse_cache ("
+            "key TEXT PRIMARY KEY, payload TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_parse_cache_accessed_at ON parse_cache (accessed_at)")
+
+    def _get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT payload, expires_at FROM parse_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            payload, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self._conn.execute("DELETE FROM parse_cache WHERE key = ?", (key,))
+                return None
+
+            self._conn.execute("UPDATE parse_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return payload
+
+    def _set(self, key: str, payload: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parse_cache (key, payload, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, payload, self._expires_at(), now),
+            )
+            self._conn.execute("DELETE FROM parse_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM parse_cache WHERE key IN "
+                "(SELECT key FROM parse_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM parse_cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM parse_cache")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM parse_cache").fetchone()[0]
+
+
+# Global parse cache instance
+parse_cache: ParseCache | None = None
+_parse_cache_lock = threading.Lock()
+
+
+def get_parse_cache() -> ParseCache | None:
+    """Get the configured parse cache, or None if caching is disabled."""
+    global parse_cache
+    if parse_cache is None and settings.parse_cache_backend != "none":
+        with _parse_cache_lock:
+            if parse_cache is None:
+                parse_cache = create_parse_cache()
+    return parse_cache
+
+
+def create_parse_cache() -> ParseCache | None:
+    """Create a parse cache from the application settings."""
+    if settings.parse_cache_backend == "memory":
+        return MemoryParseCache(
+            ttl_seconds=settings.parse_cache_ttl_seconds, max_entries=settings.parse_cache_max_entries
+        )
+    if settings.parse_cache_backend == "sqlite":
+        return SQLiteParseCache(
+            path=settings.parse_cache_path,
+            ttl_seconds=settings.parse_cache_ttl_seconds,
+            max_entries=settings.parse_cache_max_entries,
+        )
+    return None
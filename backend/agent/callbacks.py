@@ -0,0 +1,46 @@
+import time
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from metrics import LLM_CALLS, LLM_TOKENS, observe_stage
+
+
+class LLMMetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Record the latency and token usage of one structured-output parser invocation.
+
+    The model call ends at `on_llm_end`; the remaining time until the parser returns is spent
+    validating the output into the schema. Create one handler per invocation.
+    """
+
+    # Run in the calling task so the recorded timestamps are not delayed by an executor
+    run_inline = True
+
+    def __init__(self, model: str):
+        self.model = model
+        self.started_at = time.perf_counter()
+        self.llm_ended_at: float | None = None
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any):
+        self.llm_ended_at = time.perf_counter()
+        LLM_CALLS.labels(model=self.model, outcome="success").inc()
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                for kind in ("input_tokens", "output_tokens"):
+                    if usage.get(kind):
+                        LLM_TOKENS.labels(model=self.model, kind=kind.removesuffix("_tokens")).inc(usage[kind])
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any):
+        LLM_CALLS.labels(model=self.model, outcome="error").inc()
+
+    def record_stages(self):
+        """Record the LLM call and output validation stages once the parser has returned or failed."""
+        ended_at = time.perf_counter()
+        if self.llm_ended_at is None:
+            observe_stage("llm_call", ended_at - self.started_at)
+            return
+        observe_stage("llm_call", self.llm_ended_at - self.started_at)
+        observe_stage("output_validation", ended_at - self.llm_ended_at)
@@ -0,0 +1,103 @@
+import asyncio
+import random
+import time
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import Runnable
+from pydantic import PrivateAttr
+
+from orm.data_models import GroceryReceiptSchema, Purchase, StoreBase, UserBase
+
+
+class FakeServiceError(RuntimeError):
+    """Injected failure of the fake chat model, standing in for an API error or timeout."""
+
+
+class FakeReceiptChatModel(BaseChatModel):
+    """
+    Local stand-in for a Gemini model that answers with a receipt as JSON after a simulated latency.
+
+    Faults are injected at the given rates: service errors, malformed output failing validation,
+    receipts marked invalid, and slow tail calls taking `tail_factor` times the usual latency.
+    """
+
+    model_name: str = "fake-receipt-model"
+    latency_seconds: float = 0.5
+    latency_jitter: float = 0.2
+    tail_rate: float = 0.0
+    tail_factor: float = 10.0
+    error_rate: float = 0.0
+    malformed_rate: float = 0.0
+    invalid_rate: float = 0.0
+    seed: int | None = None
+    receipt: GroceryReceiptSchema = GroceryReceiptSchema(
+        is_valid=True,
+        user=UserBase(username="fake_user"),
+        store=StoreBase(name="Fake Market"),
+        purchases=[Purchase(name="milk", quantity=1, unit_price=3.49, unit_type="ea")],
+    )
+
+    _random: random.Random = PrivateAttr()
+    _calls: int = PrivateAttr(default=0)
+
+    def model_post_init(self, context: Any):
+        self._random = random.Random(self.seed)
+
+    @property
+    def calls(self) -> int:
+        """Number of calls made to the model."""
+        return self._calls
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-receipt"
+
+    def _sample_latency(self) -> float:
+        self._calls += 1
+        latency = self.latency_seconds * (1 + self._random.uniform(-self.latency_jitter, self.latency_jitter))
+        if self._random.random() < self.tail_rate:
+            latency *= self.tail_factor
+        return latency
+
+    def _sample_result(self) -> ChatResult:
+        if self._random.random() < self.error_rate:
+            raise FakeServiceError(f"{self.model_name} failed.")
+        if self._random.random() < self.malformed_rate:
+            content = '{"is_valid": true, "purchases": [{"name": '
+        elif self._random.random() < self.invalid_rate:
+            content = self.receipt.model_copy(update={"is_valid": False, "purchases": []}).model_dump_json()
+        else:
+            content = self.receipt.model_dump_json()
+        message = AIMessage(
+            content=content,
+            usage_metadata={"input_tokens": 1000, "output_tokens": len(content) // 4, "total_tokens": 1000},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self._sample_latency())
+        return self._sample_result()
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self._sample_latency())
+        return self._sample_result()
+
+    def with_structured_output(self, schema: type[GroceryReceiptSchema], **kwargs: Any) -> Runnable:
+        return self | PydanticOutputParser(pydantic_object=schema)
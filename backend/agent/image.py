@@ -0,0 +1,269 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image, ImageFilter, ImageOps, UnidentifiedImageError
+from pillow_heif import register_heif_opener
+
+from config import settings
+
+register_heif_opener()
+
+logger = logging.getLogger(__name__)
+
+# Pillow format names of the supported output formats
+OUTPUT_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+
+# Errors raised when decoding an unsupported, malformed or oversized image, e.g. a decompression bomb
+IMAGE_DECODE_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError, ValueError)
+
+
+@dataclass(frozen=True)
+class PreprocessedImage:
+    content: bytes
+    format: str
+    original_size: int
+
+    @property
+    def size(self) -> int:
+        return len(self.content)
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_size - self.size
+
+
+def _longest_run(values: list[int], threshold: float) -> tuple[int, int] | None:
+    """Return the [start, end) bounds of the longest run of values at or above the threshold."""
+    best, start = None, None
+    for index, value in enumerate([*values, -1]):
+        if value >= threshold and start is None:
+            start = index
+        elif value < threshold and start is not None:
+            if best is None or index - start > best[1] - best[0]:
+                best = (start, index)
+            start = None
+    return best
+
+
+def crop_to_receipt(image: Image.Image, min_area_ratio: float = 0.1, margin_ratio: float = 0.02) -> Image.Image:
+    """
+    Crop an image to the bright paper region of a receipt photographed on a darker background.
+
+    The receipt is located from the column and row projections of a bright-pixel mask. The image is
+    returned unchanged when no plausible receipt region is found.
+
+    Args:
+        image (Image.Image): The image to crop.
+        min_area_ratio (float): Smallest fraction of the image the receipt region may cover.
+        margin_ratio (float): Margin kept around the region as a fraction of the image size.
+
+    Returns:
+        Image.Image: The cropped image.
+    """
+    preview = image.convert("L")
+    preview.thumbnail((256, 256))
+    width, height = preview.size
+
+    # Bright paper pixels; the min filter erodes thin highlights such as glare or veins in a countertop
+    mask = ImageOps.autocontrast(preview, cutoff=1).point(lambda pixel: 255 if pixel >= 170 else 0)
+    mask = mask.filter(ImageFilter.MinFilter(5))
+
+    # Mean of each column / row, computed by box-resampling the mask down to a single row / column
+    columns = _longest_run(list(mask.resize((width, 1), Image.Resampling.BOX).getdata()), threshold=0.25 * 255)
+    if columns is None:
+        return image
+    left, right = columns
+
+    rows = mask.crop((left, 0, right, height)).resize((1, height), Image.Resampling.BOX).getdata()
+    bright_rows = [index for index, value in enumerate(rows) if value >= 0.05 * 255]
+    if not bright_rows:
+        return image
+    top, bottom = bright_rows[0], bright_rows[-1] + 1
+
+    area_ratio = (right - left) * (bottom - top) / (width * height)
+    if not min_area_ratio <= area_ratio < 0.9:
+        return image
+
+    scale_x, scale_y = image.width / width, image.height / height
+    margin_x, margin_y = image.width * margin_ratio, image.height * margin_ratio
+    return image.crop(
+        (
+            max(0, int(left * scale_x - margin_x)),
+            max(0, int(top * scale_y - margin_y)),
+            min(image.width, int(right * scale_x + margin_x)),
+            min(image.height, int(bottom * scale_y + margin_y)),
+        )
+    )
+
+
+def open_receipt_image(source: bytes | str, mode: str, draft_size: int) -> Image.Image:
+    """
+    Decode an image from its content or file path, auto-rotated from its EXIF orientation.
+
+    Args:
+        source (bytes | str): The JPEG, PNG or HEIC image content, or the path of a file holding it.
+        mode (str): The mode the JPEG decoder may decode to directly, e.g. L for grayscale.
+        draft_size (int): The width and height the JPEG decoder may downscale to while decoding.
+
+    Returns:
+        Image.Image: The decoded image.
+    """
+    with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image:
+        # Let the JPEG decoder downscale while decoding
+        image.draft(mode, (draft_size, draft_size))
+        return ImageOps.exif_transpose(image)
+
+
+def encode_receipt_image(
+    image: Image.Image,
+    original_size: int,
+    max_dimension: int = 1600,
+    grayscale: bool = True,
+    output_format: str = "jpeg",
+    quality: int = 80,
+) -> PreprocessedImage:
+    """Convert a decoded receipt image, downscale it to fit `max_dimension` and re-encode it."""
+    image = image.convert("L" if grayscale else "RGB")
+    image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+    output = BytesIO()
+    image.save(output, format=OUTPUT_FORMATS[output_format], quality=quality, optimize=True)
+    return PreprocessedImage(content=output.getvalue(), format=output_format, original_size=original_size)
+
+
+def preprocess_receipt_image(
+    img_content: bytes,
+    max_dimension: int = 1600,
+    grayscale: bool = True,
+    crop: bool = True,
+    output_format: str = "jpeg",
+    quality: int = 80,
+) -> PreprocessedImage:
+    """
+    Normalize a receipt image into a compact image for the LLM.
+
+    The image is auto-rotated from its EXIF orientation, optionally cropped to the receipt and
+    converted to grayscale, downscaled to fit `max_dimension` and re-encoded.
+
+    Args:
+        img_content (bytes): The JPEG, PNG or HEIC image content.
+        max_dimension (int): Maximum width and height of the output image in pixels.
+        grayscale (bool): Whether to drop color information.
+        crop (bool): Whether to crop to the receipt region.
+        output_format (str): Output format, jpeg or webp.
+        quality (int): Encoder quality of the output image.
+
+    Returns:
+        PreprocessedImage: The re-encoded image.
+    """
+    image = open_receipt_image(img_content, mode="RGB", draft_size=max_dimension)
+    if crop:
+        image = crop_to_receipt(image)
+    return encode_receipt_image(
+        image,
+        original_size=len(img_content),
+        max_dimension=max_dimension,
+        grayscale=grayscale,
+        output_format=output_format,
+        quality=quality,
+    )
+
+
+def preprocess_decoded_image_from_settings(image: Image.Image, original_size: int) -> PreprocessedImage | None:
+    """
+    Re-encode a decoded receipt image with the configured options, already cropped if configured.
+
+    Returns None when re-encoding would not make the image smaller, in which case the original image
+    should be sent.
+    """
+    processed = encode_receipt_image(
+        image,
+        original_size=original_size,
+        max_dimension=settings.image_max_dimension,
+        grayscale=settings.image_grayscale,
+        output_format=settings.image_output_format,
+        quality=settings.image_output_quality,
+    )
+    if processed.bytes_saved <= 0:
+        return None
+
+    logger.info(
+        "Preprocessed receipt image from %d to %d bytes (%d bytes saved).",
+        processed.original_size,
+        processed.size,
+        processed.bytes_saved,
+    )
+    return processed
+
+
+def compute_image_dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """Compute the dHash of a decoded image, see compute_dhash."""
+    grid = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(grid.getdata())
+    dhash = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            offset = row * (hash_size + 1) + column
+            dhash = dhash << 1 | (pixels[offset] > pixels[offset + 1])
+    return dhash
+
+
+def compute_dhash(img_content: bytes, hash_size: int = 8, crop: bool = True) -> int:
+    """
+    Compute the difference hash (dHash) of an image, a perceptual hash robust to re-encoding and rescaling.
+
+    The image is auto-rotated, optionally cropped to the receipt and shrunk to a grayscale grid of
+    `hash_size + 1` by `hash_size` pixels; each bit records whether a pixel is brighter than its right
+    neighbor. Photos of the same receipt give hashes a small Hamming distance apart.
+
+    Args:
+        img_content (bytes): The JPEG, PNG or HEIC image content.
+        hash_size (int): Rows of the grid, giving a hash of `hash_size ** 2` bits.
+        crop (bool): Whether to crop to the receipt region first, ignoring the background.
+
+    Returns:
+        int: The hash as an unsigned integer.
+    """
+    # The receipt is located on a 256 pixel preview
+    image = open_receipt_image(img_content, mode="L", draft_size=256)
+    if crop:
+        image = crop_to_receipt(image)
+    return compute_image_dhash(image, hash_size=hash_size)
+
+
+def compute_receipt_dhash(img_content: bytes) -> int | None:
+    """Compute the dHash of a receipt image, or None when the image cannot be decoded."""
+    try:
+        return compute_dhash(img_content)
+    except IMAGE_DECODE_ERRORS:
+        logger.warning("Could not compute the perceptual hash of a receipt image.", exc_info=True)
+        return None
+
+
+# Global process pool for CPU-bound image work
+image_process_pool: ProcessPoolExecutor | None = None
+_image_process_pool_lock = threading.Lock()
+
+
+def get_image_process_pool() -> ProcessPoolExecutor:
+    """Get the process pool used to preprocess images off the event loop."""
+    global image_process_pool
+    if image_process_pool is None:
+        with _image_process_pool_lock:
+            if image_process_pool is None:
+                image_process_pool = ProcessPoolExecutor(
+                    max_workers=settings.image_preprocessing_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+    return image_process_pool
+
+
+def shutdown_image_process_pool():
+    """Stop the image process pool workers."""
+    global image_process_pool
+    if image_process_pool is not None:
+        image_process_pool.shutdown(cancel_futures=True)
+        image_process_pool = None
@@ -1,3 +1,4 @@
+import threading
 from enum import StrEnum
 
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -34,3 +35,31 @@ def create_gemini_model(
     if not google_api_key:
         raise ValueError("Google API key must be provided.")
     return ChatGoogleGenerativeAI(model=model.value, temperature=temperature, google_api_key=google_api_key)
+
+
+# Process-wide Gemini clients keyed by model and temperature
+gemini_models: dict[tuple[GeminiModels, float], ChatGoogleGenerativeAI] = {}
+_gemini_models_lock = threading.Lock()
+
+
+def get_gemini_model(
+    model: GeminiModels = GeminiModels.GEMINI_2_0_FLASH, temperature: float = 0
+) -> ChatGoogleGenerativeAI:
+    """
+    Get the shared Google Gemini model instance, creating it on first use.
+
+    Reusing one instance keeps its HTTP/gRPC transport and connections alive across requests.
+
+    Args:
+        model (GeminiModels): The model name to use.
+        temperature (float): The temperature setting for the model.
+
+    Returns:
+        ChatGoogleGenerativeAI: The shared instance of the Google Gemini model.
+    """
+    key = (model, temperature)
+    if key not in gemini_models:
+        with _gemini_models_lock:
+            if key not in gemini_models:
+                gemini_models[key] = create_gemini_model(model=model, temperature=temperature)
+    return gemini_models[key]
@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+
+from PIL import Image, ImageFilter, ImageOps, ImageStat
+
+from agent.image import crop_to_receipt, open_receipt_image
+from config import settings
+from metrics import LLM_CALLS_SAVED, PRECLASSIFIER_SCORES
+
+
+@dataclass(frozen=True)
+class ReceiptImageScore:
+    """Image statistics of a photo and the resulting likelihood that it shows a receipt, from 0 to 1."""
+
+    score: float
+    saturation: float
+    paper_fraction: float
+    midtone_fraction: float
+    ink_fraction: float
+    edge_density: float
+
+
+def _ramp(value: float, low: float, high: float) -> float:
+    """Map a value linearly from 0 at `low` to 1 at `high`, clamped to [0, 1]."""
+    return min(1.0, max(0.0, (value - low) / (high - low)))
+
+
+def white_balance(image: Image.Image, percentile: float = 0.99, max_gain: float = 1.6) -> Image.Image:
+    """
+    Scale each channel of an RGB image so its brightest tones are neutral, removing the color cast of
+    warm or cool lighting from white paper.
+
+    Gains are capped so that images which are colorful rather than tinted keep their colors.
+    """
+    num_pixels = image.width * image.height
+    channels = image.split()
+    brightest = []
+    for channel in channels:
+        histogram, count = channel.histogram(), 0
+        for value in range(255, -1, -1):
+            count += histogram[value]
+            if count >= num_pixels * (1 - percentile):
+                break
+        brightest.append(max(value, 1))
+
+    target = max(brightest)
+    return Image.merge(
+        "RGB",
+        [
+            channel.point([min(255, round(value * min(max_gain, target / level))) for value in range(256)])
+            for channel, level in zip(channels, brightest, strict=True)
+        ],
+    )
+
+
+def score_receipt_image(img_content: bytes, preview_size: int = 256) -> ReceiptImageScore:
+    """
+    Score how likely an image shows a receipt from cheap statistics of a small preview.
+
+    The image is cropped to the brightest paper region (see crop_to_receipt) and scored on five
+    features, each mapped to [0, 1] and averaged with weights: receipts are nearly colorless and
+    mostly bright paper, with few mid-tones between paper and ink, a modest share of dark ink, and
+    dense in the small edges of printed text.
+
+    Args:
+        img_content (bytes): The JPEG, PNG or HEIC image content.
+        preview_size (int): Width and height the preview is shrunk to fit.
+
+    Returns:
+        ReceiptImageScore: The score and the statistics it was computed from.
+    """
+    image = open_receipt_image(img_content, mode="RGB", draft_size=preview_size * 2)
+    return score_cropped_image(crop_to_receipt(image), preview_size=preview_size)
+
+
+def score_cropped_image(image: Image.Image, preview_size: int = 256) -> ReceiptImageScore:
+    """Score a decoded image already cropped to the receipt, see score_receipt_image."""
+    image = image.convert("RGB")
+    image.thumbnail((preview_size, preview_size))
+
+    num_pixels = image.width * image.height
+    saturation = ImageStat.Stat(white_balance(image).convert("HSV").getchannel("S")).mean[0] / 255
+
+    gray = image.convert("L")
+    paper_fraction = sum(gray.histogram()[140:]) / num_pixels
+    # Tones relative to the darkest ink and brightest paper of the photo, whatever the lighting
+    histogram = ImageOps.autocontrast(gray, cutoff=1).histogram()
+    midtone_fraction = sum(histogram[85:170]) / num_pixels
+    ink_fraction = sum(histogram[:85]) / num_pixels
+    edge_density = sum(gray.filter(ImageFilter.FIND_EDGES).histogram()[48:]) / num_pixels
+
+    # Feature scores with their weights; color and text are the strongest signs of a receipt
+    features = (
+        (1 - _ramp(saturation, 0.1, 0.35), 2),
+        (_ramp(paper_fraction, 0.4, 0.7), 1),
+        (1 - _ramp(midtone_fraction, 0.2, 0.45), 1),
+        (_ramp(ink_fraction, 0.01, 0.04) * (1 - _ramp(ink_fraction, 0.3, 0.45)), 1),
+        (_ramp(edge_density, 0.03, 0.08), 1),
+    )
+    return ReceiptImageScore(
+        score=sum(feature * weight for feature, weight in features) / sum(weight for _, weight in features),
+        saturation=saturation,
+        paper_fraction=paper_fraction,
+        midtone_fraction=midtone_fraction,
+        ink_fraction=ink_fraction,
+        edge_density=edge_density,
+    )
+
+
+def record_preclassification(image_score: ReceiptImageScore | None) -> bool:
+    """Record the score of a pre-classified image and whether it saved an LLM call.
+
+    Returns:
+        bool: Whether the image scores too low to be worth parsing.
+    """
+    if image_score is None:
+        return False
+    PRECLASSIFIER_SCORES.observe(image_score.score)
+    is_rejected = image_score.score < settings.preclassifier_min_score
+    if is_rejected:
+        LLM_CALLS_SAVED.labels(reason="preclassifier").inc()
+    return is_rejected
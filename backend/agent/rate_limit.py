@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+from config import settings
+
+
+class TokenBucket:
+    """
+    Async token-bucket rate limiter.
+
+    Tokens refill continuously at `rate` per second up to `capacity`; each acquire consumes one token
+    and waits until one is available.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        if rate <= 0 or capacity < 1:
+            raise ValueError("Rate must be positive and capacity at least 1.")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        """Wait until a token is available and consume it."""
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+# Global rate limiter for LLM calls
+llm_rate_limiter: TokenBucket | None = None
+
+
+def get_llm_rate_limiter() -> TokenBucket:
+    """Get the process-wide rate limiter for LLM calls."""
+    global llm_rate_limiter
+    if llm_rate_limiter is None:
+        llm_rate_limiter = TokenBucket(rate=settings.llm_rate_limit_per_second, capacity=settings.llm_rate_limit_burst)
+    return llm_rate_limiter
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from collections.abc import Callable
+from enum import StrEnum
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import Runnable
+from pydantic import ValidationError
+
+from agent.callbacks import LLMMetricsCallbackHandler
+from agent.model import GeminiModels
+from metrics import CIRCUIT_BREAKER_OPEN, ROUTING_EVENTS
+from orm.data_models import GroceryReceiptSchema
+
+logger = logging.getLogger(__name__)
+
+# Errors meaning the model answered but its output did not fit the schema
+OUTPUT_ERRORS = (OutputParserException, ValidationError)
+
+
+class ModelUnavailableError(RuntimeError):
+    """Raised when the circuit breakers of all models in a route are open."""
+
+
+class CircuitState(StrEnum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Stop calling a model after `failure_threshold` consecutive failures.
+
+    The circuit stays open for `reset_seconds`, after which a single trial call is let through; its
+    success closes the circuit and its failure or cancellation opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        """Check whether a call may be made, letting one trial call through once the reset time has passed."""
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = CircuitState.HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != CircuitState.CLOSED:
+            logger.info("Circuit of %s closed.", self.name)
+            self.state = CircuitState.CLOSED
+            CIRCUIT_BREAKER_OPEN.labels(model=self.name).set(0)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CircuitState.OPEN:
+                logger.warning("Circuit of %s opened after %d consecutive failures.", self.name, self.failures)
+            self.state = CircuitState.OPEN
+            self.opened_at = time.monotonic()
+            CIRCUIT_BREAKER_OPEN.labels(model=self.name).set(1)
+
+    def record_cancelled(self):
+        """Reopen the circuit if its trial call was cancelled, e.g. as a hedge loser, so another trial follows."""
+        if self.state == CircuitState.HALF_OPEN:
+            self.state = CircuitState.OPEN
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Rolling window of call latencies used to derive the hedging delay."""
+
+    def __init__(self, window: int = 200, min_samples: int = 50):
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def p95(self) -> float | None:
+        """Get the 95th percentile latency, or None until enough calls have been observed."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return statistics.quantiles(self.latencies, n=20)[-1]
+
+
+class ModelRouter:
+    """
+    Route receipt parses across a list of models ordered from cheapest to strongest.
+
+    Each model is tried in turn and the next one is used when a model fails, its output does not
+    validate, or (with `escalate_invalid`) it marks the receipt as invalid. A call still running
+    after the hedging delay is raced against a second call to the same model. Models whose circuit
+    breaker is open are skipped.
+
+    Args:
+        models (list[GeminiModels]): The models to route across, cheapest first.
+        parser_factory (Callable[[GeminiModels], Runnable]): Creates the structured-output parser of a model.
+        hedge_after_seconds (float | None): Fixed hedging delay; the model's observed p95 latency when None.
+        hedge_enabled (bool): Whether to hedge slow calls.
+        escalate_invalid (bool): Whether to retry receipts marked invalid with a stronger model.
+        failure_threshold (int): Consecutive failures that open a model's circuit.
+        reset_seconds (float): Seconds a circuit stays open before a trial call.
+    """
+
+    def __init__(
+        self,
+        models: list[GeminiModels],
+        parser_factory: Callable[[GeminiModels], Runnable],
+        hedge_after_seconds: float | None = None,
+        hedge_enabled: bool = True,
+        escalate_invalid: bool = True,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30.0,
+    ):
+        if not models:
+            raise ValueError("At least one model must be routed to.")
+        self.models = list(models)
+        self.parser_factory = parser_factory
+        self.hedge_after_seconds = hedge_after_seconds
+        self.hedge_enabled = hedge_enabled
+        self.escalate_invalid = escalate_invalid
+        self.breakers = {model: CircuitBreaker(model.value, failure_threshold, reset_seconds) for model in self.models}
+        self.latencies = {model: LatencyTracker() for model in self.models}
+
+    @property
+    def name(self) -> str:
+        """Name of the route, e.g. gemini-2.0-flash>gemini-2.5-flash."""
+        return ">".join(model.value for model in self.models)
+
+    def get_hedge_delay(self, model: GeminiModels) -> float | None:
+        """Get the seconds after which a call to the model is hedged, or None to not hedge."""
+        if not self.hedge_enabled:
+            return None
+        if self.hedge_after_seconds is not None:
+            return self.hedge_after_seconds
+        return self.latencies[model].p95()
+
+    async def _call(self, model: GeminiModels, messages: list) -> GroceryReceiptSchema:
+        """Make a single call to a model, recording its latency and outcome."""
+        breaker = self.breakers[model]
+        llm_metrics = LLMMetricsCallbackHandler(model=model.value)
+        start = time.perf_counter()
+        try:
+            gr_schema = await self.parser_factory(model).ainvoke(messages, config={"callbacks": [llm_metrics]})
+        except asyncio.CancelledError:
+            breaker.record_cancelled()
+            raise
+        except OUTPUT_ERRORS:
+            # The model is up, its answer just did not fit the schema
+            breaker.record_success()
+            llm_metrics.record_stages()
+            raise
+        except Exception:
+            breaker.record_failure()
+            llm_metrics.record_stages()
+            raise
+
+        breaker.record_success()
+        llm_metrics.record_stages()
+        self.latencies[model].add(time.perf_counter() - start)
+        return gr_schema
+
+    async def _call_hedged(self, model: GeminiModels, messages: list) -> GroceryReceiptSchema:
+        """Call a model, racing a second call against the first once it outlives the hedging delay."""
+        hedge_delay = self.get_hedge_delay(model)
+        if hedge_delay is None:
+            return await self._call(model, messages)
+
+        tasks = {asyncio.create_task(self._call(model, messages))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done and self.breakers[model].state == CircuitState.CLOSED:
+                ROUTING_EVENTS.labels(model=model.value, event="hedged").inc()
+                tasks.add(asyncio.create_task(self._call(model, messages)))
+
+            # Return the first successful call, or raise the error of the last one to fail
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def ainvoke(self, messages: list) -> GroceryReceiptSchema:
+        """
+        Parse the receipt messages, escalating across the routed models.
+
+        Args:
+            messages (list): The receipt parsing messages.
+
+        Raises:
+            ModelUnavailableError: If the circuits of all models are open.
+            Exception: The error of the last model tried if all calls failed.
+
+        Returns:
+            GroceryReceiptSchema: The parsed receipt, or the last invalid one if no model found it valid.
+        """
+        last_result, last_error = None, None
+        for index, model in enumerate(self.models):
+            is_last = index == len(self.models) - 1
+            if not self.breakers[model].allow():
+                ROUTING_EVENTS.labels(model=model.value, event="circuit_open").inc()
+                continue
+
+            try:
+                gr_schema = await self._call_hedged(model, messages)
+            except Exception as err:
+                event = "escalated_output_error" if isinstance(err, OUTPUT_ERRORS) else "escalated_error"
+                if not is_last:
+                    ROUTING_EVENTS.labels(model=model.value, event=event).inc()
+                logger.warning("Receipt parse with %s failed: %s", model.value, err)
+                last_error = err
+                continue
+
+            if gr_schema.is_valid or not self.escalate_invalid or is_last:
+                return gr_schema
+            ROUTING_EVENTS.labels(model=model.value, event="escalated_invalid").inc()
+            last_result = gr_schema
+
+        if last_result is not None:
+            return last_result
+        if last_error is not None:
+            raise last_error
+        raise ModelUnavailableError(f"The circuits of all models routed by {self.name} are open.")
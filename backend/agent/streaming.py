@@ -0,0 +1,205 @@
+import functools
+import time
+from collections.abc import AsyncIterator
+from enum import StrEnum
+
+from langchain_core.runnables import Runnable
+from langchain_core.utils.json import parse_partial_json
+from pydantic import ValidationError
+from sqlmodel import Field, SQLModel
+
+from agent.analysis import ReceiptImageAnalysis, analyze_receipt_image_async
+from agent.cache import ParseCache, get_parse_cache, make_parse_cache_key
+from agent.callbacks import LLMMetricsCallbackHandler
+from agent.model import GeminiModels, get_gemini_model
+from agent.preclassifier import record_preclassification
+from agent.utils import (
+    PROMPT_VERSION,
+    ImageContent,
+    ImageType,
+    create_grocery_parsing_messages,
+    make_invalid_receipt,
+    with_requesting_user,
+)
+from metrics import IMAGE_BYTES_SAVED, PARSE_CACHE_REQUESTS, observe_stage, track_stage
+from orm.data_models import GroceryReceipt, GroceryReceiptSchema, Purchase, StoreBase
+
+# Order in which the model generates the receipt fields, so the store and purchases come out first
+RECEIPT_PROPERTY_ORDERING = ["is_valid", "store", "purchases", "date_time", "user"]
+
+
+class ReceiptStreamEventType(StrEnum):
+    STORE = "store"
+    PURCHASE = "purchase"
+    RECEIPT = "receipt"
+    ERROR = "error"
+
+
+class ReceiptStreamEvent(SQLModel):
+    event: ReceiptStreamEventType = Field(description="Type of the event")
+    index: int | None = Field(default=None, description="Position of the purchase on the receipt")
+    store: StoreBase | None = Field(default=None, description="Store of the receipt, on store events")
+    purchase: Purchase | None = Field(default=None, description="A completed purchase, on purchase events")
+    receipt: GroceryReceiptSchema | None = Field(default=None, description="The validated receipt, on the last event")
+    detail: str | None = Field(default=None, description="Reason the parse failed, on error events")
+
+
+@functools.cache
+def get_receipt_response_schema() -> dict:
+    """Get the JSON schema constraining the streamed model output to a GroceryReceiptSchema."""
+    return {**GroceryReceiptSchema.model_json_schema(), "propertyOrdering": RECEIPT_PROPERTY_ORDERING}
+
+
+def get_receipt_stream_model(model: GeminiModels = GeminiModels.GEMINI_2_0_FLASH, temperature: float = 0) -> Runnable:
+    """Get the shared Gemini model bound to stream receipts as schema-constrained JSON."""
+    return get_gemini_model(model=model, temperature=temperature).bind(
+        response_mime_type="application/json", response_schema=get_receipt_response_schema()
+    )
+
+
+class PartialReceiptParser:
+    """
+    Incrementally parse the streamed JSON of a GroceryReceiptSchema.
+
+    The store is complete once a later field has started, and a purchase once the next purchase has
+    started; everything still open is completed by `finish` when the stream ends.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.store_emitted = False
+        self.purchases_emitted = 0
+
+    @staticmethod
+    def _is_field_done(partial: dict, field: str, is_done: bool) -> bool:
+        """Check whether a field is complete, i.e. the stream has ended or moved on to a later field."""
+        later_fields = RECEIPT_PROPERTY_ORDERING[RECEIPT_PROPERTY_ORDERING.index(field) + 1 :]
+        return is_done or any(later_field in partial for later_field in later_fields)
+
+    def _events(self, partial: dict, is_done: bool) -> list[ReceiptStreamEvent]:
+        events = []
+        if not self.store_emitted and self._is_field_done(partial, "store", is_done):
+            self.store_emitted = True
+            try:
+                store = StoreBase.model_validate(partial.get("store") or {})
+                events.append(ReceiptStreamEvent(event=ReceiptStreamEventType.STORE, store=store))
+            except ValidationError:
+                pass
+
+        purchases = partial.get("purchases")
+        if isinstance(purchases, list):
+            # The last purchase may still be streaming until the list is complete
+            completed = len(purchases) if self._is_field_done(partial, "purchases", is_done) else len(purchases) - 1
+            for index in range(self.purchases_emitted, completed):
+                try:
+                    purchase = Purchase.model_validate(purchases[index])
+                except ValidationError:
+                    continue
+                events.append(ReceiptStreamEvent(event=ReceiptStreamEventType.PURCHASE, index=index, purchase=purchase))
+            self.purchases_emitted = max(self.purchases_emitted, completed)
+        return events
+
+    def feed(self, text: str) -> list[ReceiptStreamEvent]:
+        """Add streamed text and return the events of the fields it completed."""
+        self.text += text
+        partial = parse_partial_json(self.text)
+        if not isinstance(partial, dict):
+            return []
+        return self._events(partial, is_done=False)
+
+    def finish(self) -> tuple[list[ReceiptStreamEvent], GroceryReceiptSchema]:
+        """Validate the full output, returning the events of the remaining fields and the receipt."""
+        gr_schema = GroceryReceiptSchema.model_validate_json(self.text)
+        events = self._events(gr_schema.model_dump(mode="json"), is_done=True)
+        return events, gr_schema
+
+
+def receipt_events(gr_schema: GroceryReceiptSchema) -> list[ReceiptStreamEvent]:
+    """Get all events of an already parsed receipt."""
+    events = [ReceiptStreamEvent(event=ReceiptStreamEventType.STORE, store=gr_schema.store)]
+    events += [
+        ReceiptStreamEvent(event=ReceiptStreamEventType.PURCHASE, index=index, purchase=purchase)
+        for index, purchase in enumerate(gr_schema.purchases)
+    ]
+    events.append(ReceiptStreamEvent(event=ReceiptStreamEventType.RECEIPT, receipt=gr_schema))
+    return events
+
+
+async def stream_grocery_receipt(
+    user: str,
+    img_content: ImageContent,
+    img_type: ImageType,
+    model: GeminiModels = GeminiModels.GEMINI_2_0_FLASH,
+    cache: ParseCache | None = None,
+    image_hash: str | None = None,
+    analysis: ReceiptImageAnalysis | None = None,
+) -> AsyncIterator[ReceiptStreamEvent]:
+    """
+    Parse a grocery receipt image, yielding the store and each purchase as soon as the model has generated them.
+
+    The last event carries the validated receipt. A cached parse of the same image, or the invalid
+    receipt of an image the pre-classifier rejects, is replayed at once.
+
+    Args:
+        user (str): The username to populate in the parsed receipt.
+        img_content (ImageContent): The image content in bytes.
+        img_type (ImageType): The type of the image.
+        model (GeminiModels): The Gemini model used for parsing.
+        cache (ParseCache | None): The parse cache, defaults to the configured global cache.
+        image_hash (str | None): The image hash if already computed while reading the upload.
+        analysis (ReceiptImageAnalysis | None): The analysis of the image if already run while checking the upload.
+
+    Yields:
+        ReceiptStreamEvent: The store, purchase and final receipt events.
+    """
+    if cache is None:
+        cache = get_parse_cache()
+    cache_key = make_parse_cache_key(
+        image_hash=image_hash or GroceryReceipt.generate_image_hash(img_content),
+        model=model.value,
+        prompt_version=PROMPT_VERSION,
+    )
+
+    if cache is not None:
+        with track_stage("cache_lookup"):
+            cached = await cache.get_async(cache_key)
+        PARSE_CACHE_REQUESTS.labels(result="miss" if cached is None else "hit").inc()
+        if cached is not None:
+            for event in receipt_events(with_requesting_user(cached, user=user)):
+                yield event
+            return
+
+    if analysis is None:
+        analysis = await analyze_receipt_image_async(img_content, dhash=False)
+    if record_preclassification(analysis.image_score):
+        for event in receipt_events(make_invalid_receipt(user=user)):
+            yield event
+        return
+    if analysis.processed is not None:
+        IMAGE_BYTES_SAVED.inc(analysis.processed.bytes_saved)
+        img_content, img_type = analysis.processed.content, ImageType(analysis.processed.format)
+
+    with track_stage("message_build"):
+        messages = create_grocery_parsing_messages(user=user, img_content=img_content, img_type=img_type)
+
+    parser = PartialReceiptParser()
+    llm_metrics = LLMMetricsCallbackHandler(model=model.value)
+    first_event_at = None
+    try:
+        async for chunk in get_receipt_stream_model(model=model).astream(messages, config={"callbacks": [llm_metrics]}):
+            for event in parser.feed(chunk.text()):
+                if first_event_at is None:
+                    first_event_at = time.perf_counter()
+                    observe_stage("llm_first_item", first_event_at - llm_metrics.started_at)
+                yield event
+        events, gr_schema = parser.finish()
+    finally:
+        llm_metrics.record_stages()
+
+    for event in events:
+        yield event
+    yield ReceiptStreamEvent(event=ReceiptStreamEventType.RECEIPT, receipt=gr_schema)
+
+    if cache is not None:
+        with track_stage("cache_store"):
+            await cache.set_async(cache_key, gr_schema)
@@ -1,10 +1,32 @@
-import base64
+import binascii
+import functools
+import logging
+import threading
 from enum import StrEnum
 
 from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable
 
-from agent.model import create_gemini_model
-from orm.data_models import GroceryCategory, GroceryReceiptSchema
+from agent.analysis import ReceiptImageAnalysis, analyze_receipt_image, analyze_receipt_image_async
+from agent.cache import ParseCache, get_parse_cache, make_parse_cache_key
+from agent.callbacks import LLMMetricsCallbackHandler
+from agent.model import GeminiModels, get_gemini_model
+from agent.preclassifier import record_preclassification
+from agent.rate_limit import TokenBucket
+from agent.routing import ModelRouter
+from config import settings
+from metrics import IMAGE_BYTES_SAVED, ITEM_CATALOG_PARSES, PARSE_CACHE_REQUESTS, track_stage
+from orm.catalog import ItemCatalog, UnknownReferenceError, get_item_catalog_async
+from orm.data_models import CompactGroceryReceiptSchema, GroceryCategory, GroceryReceipt, GroceryReceiptSchema, UserBase
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the parsing prompt changes so cached parses from older prompts are not reused
+PROMPT_VERSION = "1"
+
+
+# Image content as bytes or a zero-copy view of a spooled upload
+ImageContent = bytes | memoryview
 
 
 class ImageType(StrEnum):
@@ -12,6 +34,7 @@ class ImageType(StrEnum):
     JPG = "jpg"
     PNG = "png"
     HEIC = "heic"
+    WEBP = "webp"
 
     @classmethod
     def from_extension(cls, extension: str) -> "ImageType":
@@ -30,18 +53,26 @@ class ImageType(StrEnum):
         except ValueError as err:
             raise ValueError(f"Unsupported image type: {extension}.") from err
 
+    @property
+    def mime_type(self) -> str:
+        """The MIME type of the image, e.g. image/jpeg."""
+        return "image/jpeg" if self == ImageType.JPG else f"image/{self.value}"
+
 
-def b64_encode(data: bytes) -> str:
-    """Base64 encode the given bytes."""
-    return base64.b64encode(data).decode("utf-8")
+def b64_encode(data: ImageContent) -> str:
+    """Base64 encode the given bytes in a single pass, without copying a memoryview first."""
+    return binascii.b2a_base64(data, newline=False).decode("ascii")
 
 
-def create_gemini_img_message(img_content: bytes, img_type: ImageType) -> HumanMessage:
+def create_gemini_img_message(img_content: ImageContent, img_type: ImageType) -> HumanMessage:
     """
     Create message with image to Gemini API.
 
+    The image is sent as an inline media part holding the raw bytes, which the Gemini client
+    transmits as-is, instead of a base64 data URL that would be decoded back to bytes before sending.
+
     Args:
-        img_content (bytes): The image content in bytes.
+        img_content (ImageContent): The image content in bytes.
         img_type (ImageType): The type of the image.
 
     Returns:
@@ -49,7 +80,7 @@ def create_gemini_img_message(img_content: bytes, img_type: ImageType) -> HumanM
     """
     return HumanMessage(
         content=[
-            {"type": "image_url", "image_url": f"data:image/{img_type.value};base64,{b64_encode(img_content)}"},
+            {"type": "media", "mime_type": img_type.mime_type, "data": bytes(img_content)},
         ]
     )
 
@@ -69,18 +100,296 @@ def create_grocery_parsing_system_prompt(user: str) -> str:
     )
 
 
-def parse_grocery_receipt(user: str, img_content: bytes, img_type: ImageType) -> GroceryReceiptSchema:
+def create_compact_parsing_system_prompt(catalog: ItemCatalog) -> SystemMessage:
+    """
+    Create the system prompt listing the known stores and items of the user, to be referred to by ID.
+
+    The catalog comes before the instructions that vary per call, so prompts of a user share a prefix.
+    """
+    return SystemMessage(
+        content=[
+            "You are a helpful assistant that parses images of receipts and extracts the information.",
+            "Known stores as 'ID: name, address':",
+            catalog.format_stores(),
+            "Known items as 'ID: name | category | brand':",
+            catalog.format_items(),
+            "Format all dates in ISO format (YYYY-MM-DD HH:MM:SS).",
+            "If the store is one of the known stores, populate store_ref with its ID and leave store as None,",
+            "otherwise populate store and leave store_ref as None.",
+            "For each purchase of a known item, populate item_ref with its ID",
+            "and leave name, category and brand as None.",
+            "Only for items that are not known, populate name, category and brand instead of item_ref.",
+            f"Populate the category of new items with one of: {', '.join(GroceryCategory.__members__.keys())}.",
+            "If uploaded image is not a valid grocery receipt or cannot be parsed, mark is_valid as false",
+            "and return None for all other fields.",
+        ]
+    )
+
+
+# Output schemas of the receipt parsers
+ReceiptSchema = type[GroceryReceiptSchema] | type[CompactGroceryReceiptSchema]
+
+# Process-wide structured-output parsers keyed by model, temperature and output schema
+receipt_parsers: dict[tuple[GeminiModels, float, ReceiptSchema], Runnable] = {}
+_receipt_parsers_lock = threading.Lock()
+
+
+def get_receipt_parser(
+    model: GeminiModels = GeminiModels.GEMINI_2_0_FLASH,
+    temperature: float = 0,
+    schema: ReceiptSchema = GroceryReceiptSchema,
+) -> Runnable:
+    """
+    Get the shared structured-output parser for grocery receipts, creating it on first use.
+
+    Args:
+        model (GeminiModels): The Gemini model used for parsing.
+        temperature (float): The temperature setting for the model.
+        schema (ReceiptSchema): The output schema, CompactGroceryReceiptSchema for prompts with an item catalog.
+
+    Returns:
+        Runnable: A runnable returning the schema for the parsing messages.
+    """
+    key = (model, temperature, schema)
+    if key not in receipt_parsers:
+        with _receipt_parsers_lock:
+            if key not in receipt_parsers:
+                base_model = get_gemini_model(model=model, temperature=temperature)
+                receipt_parsers[key] = base_model.with_structured_output(schema=schema)
+    return receipt_parsers[key]
+
+
+def warm_receipt_parsers(models: list[GeminiModels], temperature: float = 0):
+    """Create the parsers and async transports for the models ahead of the first request."""
+    for model in models:
+        get_receipt_parser(model=model, temperature=temperature)
+        # The async gRPC client is built lazily on first access inside the running event loop
+        _ = get_gemini_model(model=model, temperature=temperature).async_client
+
+
+# Process-wide model routers keyed by their models and output schema, so circuit breakers and latencies are shared
+# across requests
+model_routers: dict[tuple[tuple[GeminiModels, ...], ReceiptSchema], ModelRouter] = {}
+_model_routers_lock = threading.Lock()
+
+
+def get_model_router(
+    models: tuple[GeminiModels, ...] | None = None, schema: ReceiptSchema = GroceryReceiptSchema
+) -> ModelRouter:
     """
-    Get a LLM model configured for grocery receipt parsing.
+    Get the shared router for receipt parses across the models, creating it on first use.
+
+    Args:
+        models (tuple[GeminiModels, ...] | None): The models to route across, defaults to the configured models.
+        schema (ReceiptSchema): The output schema of the parsers.
 
     Returns:
-        ChatGoogleGenerativeAI: A model instance configured for grocery receipt parsing.
+        ModelRouter: The router over the receipt parsers of the models.
     """
+    models = models or tuple(GeminiModels(model) for model in settings.llm_models)
+    key = (models, schema)
+    if key not in model_routers:
+        with _model_routers_lock:
+            if key not in model_routers:
+                model_routers[key] = ModelRouter(
+                    models=list(models),
+                    parser_factory=functools.partial(get_receipt_parser, schema=schema),
+                    hedge_after_seconds=settings.llm_hedge_after_seconds,
+                    hedge_enabled=settings.llm_hedge_enabled,
+                    escalate_invalid=settings.llm_escalate_invalid,
+                    failure_threshold=settings.llm_circuit_failure_threshold,
+                    reset_seconds=settings.llm_circuit_reset_seconds,
+                )
+    return model_routers[key]
+
 
-    base_model = create_gemini_model()
-    messages = [
+def create_grocery_parsing_messages(user: str, img_content: ImageContent, img_type: ImageType) -> list:
+    """Create the system prompt and image messages for parsing a grocery receipt."""
+    return [
         create_grocery_parsing_system_prompt(user=user),
         create_gemini_img_message(img_content=img_content, img_type=img_type),
     ]
-    gr_parser = base_model.with_structured_output(schema=GroceryReceiptSchema)
-    return gr_parser.invoke(messages)
+
+
+async def parse_with_item_catalog_async(
+    user: str,
+    img_content: ImageContent,
+    img_type: ImageType,
+    models: tuple[GeminiModels, ...] | None,
+    db_url: str | None,
+) -> GroceryReceiptSchema | None:
+    """
+    Parse a receipt given the known stores and items of the user, so the model returns item references
+    instead of full names, categories and brands.
+
+    Returns:
+        GroceryReceiptSchema | None: The expanded receipt, or None if the user has no catalog yet or the
+            model referred to unknown items, in which case the receipt should be parsed in full.
+    """
+    catalog = await get_item_catalog_async(username=user, db_url=db_url)
+    if not catalog:
+        return None
+
+    router = get_model_router(models, schema=CompactGroceryReceiptSchema)
+    with track_stage("message_build"):
+        messages = [
+            create_compact_parsing_system_prompt(catalog),
+            create_gemini_img_message(img_content=img_content, img_type=img_type),
+        ]
+    compact = await router.ainvoke(messages)
+
+    try:
+        gr_schema = catalog.expand(compact, user=user)
+    except UnknownReferenceError:
+        logger.warning("Parse referred to an unknown store or item, parsing in full.", exc_info=True)
+        ITEM_CATALOG_PARSES.labels(outcome="unknown_reference").inc()
+        return None
+    ITEM_CATALOG_PARSES.labels(outcome="expanded").inc()
+    return gr_schema
+
+
+def with_requesting_user(gr_schema: GroceryReceiptSchema, user: str) -> GroceryReceiptSchema:
+    """Return a copy of a cached parse attributed to the requesting user."""
+    return gr_schema.model_copy(update={"user": UserBase(username=user)})
+
+
+def make_invalid_receipt(user: str) -> GroceryReceiptSchema:
+    """Create the parse of an image that is not a receipt, as the model would return it."""
+    return GroceryReceiptSchema(is_valid=False, user=UserBase(username=user), purchases=[])
+
+
+def parse_grocery_receipt(
+    user: str,
+    img_content: ImageContent,
+    img_type: ImageType,
+    model: GeminiModels = GeminiModels.GEMINI_2_0_FLASH,
+    cache: ParseCache | None = None,
+    image_hash: str | None = None,
+) -> GroceryReceiptSchema:
+    """
+    Parse a grocery receipt image, reusing a cached parse of the same image when available.
+
+    Images the local pre-classifier finds unlike a receipt are marked invalid without an LLM call
+    (see agent/preclassifier.py).
+
+    Args:
+        user (str): The username to populate in the parsed receipt.
+        img_content (ImageContent): The image content in bytes.
+        img_type (ImageType): The type of the image.
+        model (GeminiModels): The Gemini model used for parsing.
+        cache (ParseCache | None): The parse cache, defaults to the configured global cache.
+        image_hash (str | None): The image hash if already computed while reading the upload.
+
+    Returns:
+        GroceryReceiptSchema: The parsed receipt data.
+    """
+    if cache is None:
+        cache = get_parse_cache()
+    cache_key = make_parse_cache_key(
+        image_hash=image_hash or GroceryReceipt.generate_image_hash(img_content),
+        model=model.value,
+        prompt_version=PROMPT_VERSION,
+    )
+
+    if cache is not None:
+        with track_stage("cache_lookup"):
+            cached = cache.get(cache_key)
+        PARSE_CACHE_REQUESTS.labels(result="miss" if cached is None else "hit").inc()
+        if cached is not None:
+            return with_requesting_user(cached, user=user)
+
+    with track_stage("image_analysis"):
+        analysis = analyze_receipt_image(bytes(img_content), dhash=False)
+    if record_preclassification(analysis.image_score):
+        return make_invalid_receipt(user=user)
+    if analysis.processed is not None:
+        IMAGE_BYTES_SAVED.inc(analysis.processed.bytes_saved)
+        img_content, img_type = analysis.processed.content, ImageType(analysis.processed.format)
+
+    gr_parser = get_receipt_parser(model=model)
+    with track_stage("message_build"):
+        messages = create_grocery_parsing_messages(user=user, img_content=img_content, img_type=img_type)
+    llm_metrics = LLMMetricsCallbackHandler(model=model.value)
+    try:
+        gr_schema = gr_parser.invoke(messages, config={"callbacks": [llm_metrics]})
+    finally:
+        llm_metrics.record_stages()
+
+    if cache is not None:
+        with track_stage("cache_store"):
+            cache.set(cache_key, gr_schema)
+    return gr_schema
+
+
+async def parse_grocery_receipt_async(
+    user: str,
+    img_content: ImageContent,
+    img_type: ImageType,
+    model: GeminiModels | None = None,
+    cache: ParseCache | None = None,
+    image_hash: str | None = None,
+    db_url: str | None = None,
+    analysis: ReceiptImageAnalysis | None = None,
+    rate_limiter: TokenBucket | None = None,
+) -> GroceryReceiptSchema:
+    """
+    Async variant of parse_grocery_receipt that awaits the Gemini call instead of blocking the event loop.
+
+    Without a model the parse is routed across the configured models, escalating to stronger models
+    and hedging slow calls (see ModelRouter). Users with saved receipts are parsed against the catalog
+    of their known stores and items (see orm/catalog.py), so the model returns short item references.
+
+    Args:
+        user (str): The username to populate in the parsed receipt.
+        img_content (ImageContent): The image content in bytes.
+        img_type (ImageType): The type of the image.
+        model (GeminiModels | None): The Gemini model used for parsing, routed across the configured models if None.
+        cache (ParseCache | None): The parse cache, defaults to the configured global cache.
+        image_hash (str | None): The image hash if already computed while reading the upload.
+        db_url (str | None): The database URL of the item catalog, defaults to the configured database.
+        analysis (ReceiptImageAnalysis | None): The analysis of the image if already run while checking the upload.
+        rate_limiter (TokenBucket | None): Limiter of the LLM calls, only acquired when the model is called.
+
+    Returns:
+        GroceryReceiptSchema: The parsed receipt data.
+    """
+    router = get_model_router((model,) if model else None)
+    if cache is None:
+        cache = get_parse_cache()
+    cache_key = make_parse_cache_key(
+        image_hash=image_hash or GroceryReceipt.generate_image_hash(img_content),
+        model=router.name,
+        prompt_version=PROMPT_VERSION,
+    )
+
+    if cache is not None:
+        with track_stage("cache_lookup"):
+            cached = await cache.get_async(cache_key)
+        PARSE_CACHE_REQUESTS.labels(result="miss" if cached is None else "hit").inc()
+        if cached is not None:
+            return with_requesting_user(cached, user=user)
+
+    if analysis is None:
+        analysis = await analyze_receipt_image_async(img_content, dhash=False)
+    if record_preclassification(analysis.image_score):
+        return make_invalid_receipt(user=user)
+    if analysis.processed is not None:
+        IMAGE_BYTES_SAVED.inc(analysis.processed.bytes_saved)
+        img_content, img_type = analysis.processed.content, ImageType(analysis.processed.format)
+
+    if rate_limiter is not None:
+        await rate_limiter.acquire()
+    gr_schema = None
+    if settings.item_catalog_enabled:
+        gr_schema = await parse_with_item_catalog_async(
+            user=user, img_content=img_content, img_type=img_type, models=(model,) if model else None, db_url=db_url
+        )
+    if gr_schema is None:
+        with track_stage("message_build"):
+            messages = create_grocery_parsing_messages(user=user, img_content=img_content, img_type=img_type)
+        gr_schema = await router.ainvoke(messages)
+
+    if cache is not None:
+        with track_stage("cache_store"):
+            await cache.set_async(cache_key, gr_schema)
+    return gr_schema
@@ -1,9 +1,50 @@
-from fastapi import FastAPI
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from functools import cache
+
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from agent.image import shutdown_image_process_pool
+from agent.model import GeminiModels
+from agent.utils import warm_receipt_parsers
+from config import settings
+from metrics import MetricsMiddleware
+from orm.dedup import load_dedup_index, refresh_dedup_index_periodically
+from orm.engine import dispose_engines
+from orm.migrations import run_migrations_async
+from orm.perceptual import load_perceptual_index, refresh_perceptual_index_periodically
+from response_cache import PrecompressedBody, ResponseCacheMiddleware
+from router import analytics, exports, prices, v0
+from router.uploads import RequestSizeLimitMiddleware
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.warm_llm_clients:
+        warm_receipt_parsers(models=[GeminiModels(model) for model in settings.llm_models])
+    if settings.db_migrate_on_startup:
+        await run_migrations_async()
+    await asyncio.to_thread(load_dedup_index)
+    await asyncio.to_thread(load_perceptual_index)
+    refresh_tasks = [
+        asyncio.create_task(refresh_dedup_index_periodically()),
+        asyncio.create_task(refresh_perceptual_index_periodically()),
+    ]
+    get_openapi_document()
+    yield
+    for task in refresh_tasks:
+        task.cancel()
+    await asyncio.gather(*refresh_tasks, return_exceptions=True)
+    await dispose_engines()
+    shutdown_image_process_pool()
 
-from router import v0
 
-app = FastAPI(title="Food API")
+# The OpenAPI document and docs are served by the routes below
+app = FastAPI(title="Food API", lifespan=lifespan, openapi_url=None, docs_url=None, redoc_url=None)
 
 # Vite development server
 origins = [
@@ -16,12 +57,45 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST"],
     allow_headers=["*"],
+    expose_headers=["Near-Duplicate-Receipt"],
 )
+app.add_middleware(RequestSizeLimitMiddleware, max_bytes=settings.max_request_bytes)
+app.add_middleware(
+    ResponseCacheMiddleware,
+    path_prefixes=("/api/v0/analytics", "/api/v0/grocery_receipts"),
+    shared_path_prefixes=("/api/v0/prices",),
+    max_age_seconds=settings.response_cache_max_age_seconds,
+)
+app.add_middleware(MetricsMiddleware, timing_header=settings.server_timing_header)
+
+
+@cache
+def get_openapi_document() -> PrecompressedBody:
+    """Build the OpenAPI document once, compressed with each supported encoding."""
+    return PrecompressedBody(body=json.dumps(app.openapi()).encode(), media_type="application/json")
+
+
+@app.get("/openapi.json", include_in_schema=False)
+def get_openapi_schema(request: Request) -> Response:
+    return get_openapi_document().response(request)
+
+
+@app.get("/docs", include_in_schema=False)
+def get_docs():
+    return get_swagger_ui_html(openapi_url="/openapi.json", title=f"{app.title} - Swagger UI")
+
+
+@app.get("/redoc", include_in_schema=False)
+def get_redoc():
+    return get_redoc_html(openapi_url="/openapi.json", title=f"{app.title} - ReDoc")
 
 
-@app.get("/openapi.json")
-def get_openapi_schema():
-    return app.openapi()
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 app.include_router(v0.router, prefix="/api")
+app.include_router(analytics.router, prefix="/api")
+app.include_router(prices.router, prefix="/api")
+app.include_router(exports.router, prefix="/api")
@@ -0,0 +1,102 @@
+"""
+Benchmark the per-upload cost of the receipt dedup check.
+
+Times is_image_hash_in_db_async, the check run for each upload, for new and already saved images
+with the in-process dedup index loaded and disabled, using a temporary SQLite database. With the index
+loaded, new images are answered without a database round trip.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_dedup --receipts 100000 --lookups 10000
+"""
+
+import argparse
+import asyncio
+import secrets
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import insert
+from sqlmodel import Session, SQLModel
+
+from config import settings
+from orm import dedup
+from orm.data_models import GroceryReceipt, Store, User
+from orm.dedup import BloomFilter, ReceiptDedupIndex
+from orm.engine import dispose_engines, get_engine
+from orm.utils import is_image_hash_in_db_async
+
+
+def seed_receipts(db_url: str, num_receipts: int) -> list[str]:
+    """Create a database with the given number of receipts and return their image hashes."""
+    engine = get_engine(db_url)
+    SQLModel.metadata.create_all(engine)
+    image_hashes = [secrets.token_hex(32) for _ in range(num_receipts)]
+
+    with Session(engine) as session:
+        session.add(User(id=1, username="bench_user"))
+        session.add(Store(id=1, name="bench_store"))
+        session.flush()
+        session.exec(
+            insert(GroceryReceipt.__table__),
+            params=[{"user_id": 1, "store_id": 1, "image_hash": image_hash} for image_hash in image_hashes],
+        )
+        session.commit()
+    return image_hashes
+
+
+async def time_lookups(image_hashes: list[str], db_url: str) -> tuple[float, int]:
+    """Run is_image_hash_in_db_async for each image hash, returning the seconds per lookup and the hits."""
+    start = time.perf_counter()
+    hits = 0
+    for image_hash in image_hashes:
+        hits += await is_image_hash_in_db_async(image_hash=image_hash, db_url=db_url)
+    return (time.perf_counter() - start) / len(image_hashes), hits
+
+
+async def run(args: argparse.Namespace, db_url: str):
+    saved_hashes = seed_receipts(db_url, args.receipts)
+    new_hashes = [secrets.token_hex(32) for _ in range(args.lookups)]
+    known_hashes = saved_hashes[: args.lookups]
+
+    index = ReceiptDedupIndex(BloomFilter(capacity=args.receipts, fp_rate=args.fp_rate))
+    start = time.perf_counter()
+    index.load(db_url=db_url)
+    load_seconds = time.perf_counter() - start
+
+    # Warm the connection pool so neither run pays for opening it
+    await is_image_hash_in_db_async(image_hash=known_hashes[0], db_url=db_url)
+
+    dedup.dedup_index = index
+    indexed_new, _ = await time_lookups(new_hashes, db_url)
+    indexed_known, _ = await time_lookups(known_hashes, db_url)
+    probable_hits = index.probable_hits - len(known_hashes)
+
+    dedup.dedup_index = None
+    settings.dedup_index_enabled = False
+    unindexed_new, _ = await time_lookups(new_hashes, db_url)
+    unindexed_known, _ = await time_lookups(known_hashes, db_url)
+    await dispose_engines()
+
+    print(f"Receipts indexed:            {args.receipts} in {load_seconds:.2f}s")
+    print(f"Bloom filter size:           {index.bloom_filter.num_bits // 8 / 1024:.0f} KiB")
+    print(f"New image, index loaded:     {indexed_new * 1e6:.2f} us")
+    print(f"New image, index disabled:   {unindexed_new * 1e6:.2f} us (local SQLite, no network)")
+    print(f"Saved image, index loaded:   {indexed_known * 1e6:.2f} us")
+    print(f"Saved image, index disabled: {unindexed_known * 1e6:.2f} us")
+    print(f"False positives:             {probable_hits} / {args.lookups}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", type=int, default=100_000, help="Receipts stored in the database")
+    parser.add_argument("--lookups", type=int, default=10_000, help="Dedup checks of new and saved images to time")
+    parser.add_argument("--fp-rate", type=float, default=0.001, help="Bloom filter false-positive rate")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(args, db_url=f"sqlite:///{Path(tmp_dir) / 'bench.sqlite3'}"))
+
+
+if __name__ == "__main__":
+    main()
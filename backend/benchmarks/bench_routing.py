@@ -0,0 +1,109 @@
+"""
+Benchmark tail latency and error rate of receipt parsing under injected model faults.
+
+Runs the same workload through several ModelRouter configurations backed by local fake chat models:
+a fast model with tail latency, errors, malformed output and invalid receipts, and a slower but
+reliable stronger model. No API calls are made.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_routing --requests 500 --concurrency 20
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from langchain_core.messages import HumanMessage
+
+from agent.fake import FakeReceiptChatModel
+from agent.model import GeminiModels
+from agent.routing import ModelRouter
+from orm.data_models import GroceryReceiptSchema
+
+FAST_MODEL, STRONG_MODEL = GeminiModels.GEMINI_2_0_FLASH, GeminiModels.GEMINI_2_5_FLASH
+
+
+def create_fake_models(args: argparse.Namespace) -> dict[GeminiModels, FakeReceiptChatModel]:
+    """Create the fake models with the fault profiles from the command line."""
+    return {
+        FAST_MODEL: FakeReceiptChatModel(
+            model_name=FAST_MODEL.value,
+            latency_seconds=args.latency,
+            tail_rate=args.tail_rate,
+            error_rate=args.error_rate,
+            malformed_rate=args.malformed_rate,
+            invalid_rate=args.invalid_rate,
+            seed=1,
+        ),
+        STRONG_MODEL: FakeReceiptChatModel(
+            model_name=STRONG_MODEL.value,
+            latency_seconds=args.latency * 2.5,
+            tail_rate=args.tail_rate / 5,
+            error_rate=args.error_rate / 5,
+            seed=2,
+        ),
+    }
+
+
+async def run_workload(router: ModelRouter, requests: int, concurrency: int) -> tuple[list[float], int, int]:
+    """Parse `requests` receipts through the router, returning the latencies and error and invalid counts."""
+    semaphore = asyncio.Semaphore(concurrency)
+    messages = [HumanMessage(content="receipt")]
+    latencies, errors, invalid = [], 0, 0
+
+    async def parse_one():
+        nonlocal errors, invalid
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                gr_schema: GroceryReceiptSchema = await router.ainvoke(messages)
+                invalid += not gr_schema.is_valid
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(parse_one() for _ in range(requests)))
+    return latencies, errors, invalid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500, help="Receipts parsed per configuration")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent parses")
+    parser.add_argument("--latency", type=float, default=0.05, help="Typical latency of the fast model in seconds")
+    parser.add_argument("--tail-rate", type=float, default=0.05, help="Fraction of slow calls (10x latency)")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="Fraction of failed calls")
+    parser.add_argument("--malformed-rate", type=float, default=0.03, help="Fraction of output failing validation")
+    parser.add_argument("--invalid-rate", type=float, default=0.05, help="Fraction of receipts marked invalid")
+    args = parser.parse_args()
+    # Failed calls are expected, keep their warnings out of the report
+    logging.getLogger("agent.routing").setLevel(logging.ERROR)
+
+    configurations = {
+        "single model": {"models": [FAST_MODEL], "hedge_enabled": False, "escalate_invalid": False},
+        "escalation": {"models": [FAST_MODEL, STRONG_MODEL], "hedge_enabled": False},
+        "escalation + p95 hedging": {"models": [FAST_MODEL, STRONG_MODEL], "hedge_enabled": True},
+    }
+
+    print(f"{'configuration':<26} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>8} {'invalid':>8} {'calls':>8}")
+    for name, options in configurations.items():
+        fake_models = create_fake_models(args)
+        parsers = {model: fake.with_structured_output(GroceryReceiptSchema) for model, fake in fake_models.items()}
+        router = ModelRouter(parser_factory=parsers.__getitem__, **options)
+        # Warm up the latency window the hedging delay is derived from
+        asyncio.run(run_workload(router, requests=200, concurrency=args.concurrency))
+        calls_before = sum(model.calls for model in fake_models.values())
+
+        latencies, errors, invalid = asyncio.run(run_workload(router, args.requests, args.concurrency))
+        calls = sum(model.calls for model in fake_models.values()) - calls_before
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(
+            f"{name:<26} {percentiles[49] * 1000:>8.1f} {percentiles[94] * 1000:>8.1f} {percentiles[98] * 1000:>8.1f} "
+            f"{errors / args.requests:>8.1%} {invalid / args.requests:>8.1%} {calls / args.requests:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
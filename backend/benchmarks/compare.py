@@ -0,0 +1,61 @@
+"""
+Compare two benchmark result files written by benchmarks/bench_pipeline.py.
+
+Prints the change of each metric and exits with status 1 when a metric regressed by more than the
+threshold, so it can gate a CI job.
+
+Usage (from the backend directory):
+    python -m benchmarks.compare .cache/benchmarks/pipeline-<base>.json .cache/benchmarks/pipeline-<head>.json
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+# Metrics of each section keyed by the field identifying a row, and whether higher values are better
+SECTIONS = {
+    "endpoint": ("concurrency", {"throughput_rps": True, "p50_ms": False, "p99_ms": False}),
+    "db_save": ("purchases", {"p50_ms": False, "p99_ms": False}),
+    "memory": ("upload_bytes", {"peak_bytes": False}),
+}
+
+
+def compare(base: dict, head: dict, threshold: float) -> list[str]:
+    """Print the metric changes between two result files and return the regressed metrics."""
+    regressions = []
+    for section, (key, metrics) in SECTIONS.items():
+        base_rows = {row[key]: row for row in base.get(section, [])}
+        for row in head.get(section, []):
+            base_row = base_rows.get(row[key])
+            if base_row is None:
+                continue
+            for metric, higher_is_better in metrics.items():
+                before, after = base_row[metric], row[metric]
+                change = (after - before) / before if before else 0.0
+                regressed = (-change if higher_is_better else change) > threshold
+                name = f"{section}[{key}={row[key]}].{metric}"
+                flag = "  REGRESSION" if regressed else ""
+                print(f"{name:<45} {before:>14.2f} -> {after:>14.2f} {change:>+8.1%}{flag}")
+                if regressed:
+                    regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base", type=Path, help="Results of the baseline commit")
+    parser.add_argument("head", type=Path, help="Results of the commit under test")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    base, head = json.loads(args.base.read_text()), json.loads(args.head.read_text())
+    print(f"Comparing {base.get('commit')} -> {head.get('commit')}")
+    regressions = compare(base, head, threshold=args.threshold)
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {args.threshold:.0%}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
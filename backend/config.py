@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
@@ -8,6 +10,113 @@ class Settings(BaseSettings):
     database_url: str | None = Field(default=None, description="Database connection URL")
     google_api_key: str | None = Field(default=None, description="Google API key for various Google services")
     log_level: str = Field(default="INFO", description="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+    db_pool_size: int = Field(default=5, description="Number of persistent database connections per engine")
+    db_max_overflow: int = Field(default=10, description="Database connections allowed beyond the pool size")
+    db_pool_timeout_seconds: float = Field(default=30, description="Seconds to wait for a free database connection")
+    db_pool_recycle_seconds: int = Field(default=1800, description="Seconds before a pooled connection is replaced")
+    db_pool_pre_ping: bool = Field(default=True, description="Check pooled connections are alive before use")
+    db_migrate_on_startup: bool = Field(
+        default=False, description="Apply pending schema migrations when the API starts, see scripts/migrate.py"
+    )
+    dedup_index_enabled: bool = Field(default=True, description="Skip database dedup lookups for new images")
+    dedup_bloom_capacity: int = Field(default=1_000_000, description="Receipts the dedup Bloom filter is sized for")
+    dedup_bloom_fp_rate: float = Field(default=0.001, description="Target false-positive rate of the Bloom filter")
+    dedup_bloom_path: str | None = Field(
+        default=".cache/dedup.bloom",
+        description="File backing the Bloom filter, shared by the processes of a host (e.g. /dev/shm/food.bloom), "
+        "or empty for a filter in memory",
+    )
+    dedup_refresh_interval_seconds: float = Field(
+        default=5.0, description="Seconds between refreshes of the dedup indexes with receipts saved by other processes"
+    )
+    perceptual_dedup_enabled: bool = Field(
+        default=True, description="Flag photos of a receipt the user already saved before parsing them"
+    )
+    perceptual_dedup_max_distance: int = Field(
+        default=6, description="Largest Hamming distance between the 64-bit dHashes of near-duplicate images"
+    )
+    max_upload_bytes: int = Field(default=10 * 1024 * 1024, description="Largest accepted receipt image in bytes")
+    max_request_bytes: int = Field(
+        default=256 * 1024 * 1024, description="Largest accepted request body in bytes, e.g. for batch uploads"
+    )
+    parse_cache_backend: Literal["memory", "sqlite", "none"] = Field(
+        default="memory", description="Backend for cached receipt parses (memory, sqlite or none to disable)"
+    )
+    parse_cache_ttl_seconds: int = Field(default=86400, description="Seconds before a cached receipt parse expires")
+    parse_cache_max_entries: int = Field(default=1024, description="Maximum number of cached receipt parses")
+    parse_cache_path: str = Field(
+        default=".cache/parse_cache.sqlite3", description="File path of the on-disk parse cache (sqlite backend)"
+    )
+    batch_max_concurrency: int = Field(default=4, description="Maximum concurrent receipt parses per batch upload")
+    llm_rate_limit_per_second: float = Field(default=2.0, description="Sustained rate of LLM calls per second")
+    llm_rate_limit_burst: int = Field(default=4, description="Maximum burst of LLM calls above the sustained rate")
+    preclassifier_enabled: bool = Field(
+        default=True, description="Mark images that do not look like receipts invalid without an LLM call"
+    )
+    preclassifier_min_score: float = Field(
+        default=0.4, description="Receipt likelihood from 0 to 1 below which the pre-classifier rejects an image"
+    )
+    image_preprocessing_enabled: bool = Field(default=True, description="Shrink receipt images before the LLM call")
+    image_max_dimension: int = Field(default=1600, description="Maximum width and height of images sent to the LLM")
+    image_grayscale: bool = Field(default=True, description="Convert images sent to the LLM to grayscale")
+    image_crop_to_receipt: bool = Field(default=True, description="Crop images to the detected receipt region")
+    image_output_format: Literal["jpeg", "webp"] = Field(default="jpeg", description="Format of images sent to the LLM")
+    image_output_quality: int = Field(default=80, description="Encoder quality of images sent to the LLM")
+    image_preprocessing_workers: int | None = Field(
+        default=None, description="Processes used for image preprocessing, defaults to the CPU count"
+    )
+    llm_models: list[str] = Field(
+        default=["gemini-2.0-flash", "gemini-2.5-flash"],
+        description="Gemini models receipt parses are routed across, cheapest first",
+    )
+    llm_escalate_invalid: bool = Field(
+        default=True, description="Retry receipts a model marked invalid with the next, stronger model"
+    )
+    llm_hedge_enabled: bool = Field(default=True, description="Race a second call against slow LLM calls")
+    llm_hedge_after_seconds: float | None = Field(
+        default=None, description="Seconds before a slow LLM call is hedged, defaults to the model's p95 latency"
+    )
+    llm_circuit_failure_threshold: int = Field(
+        default=5, description="Consecutive failures of a model before its circuit breaker opens"
+    )
+    llm_circuit_reset_seconds: float = Field(
+        default=30.0, description="Seconds an open circuit breaker waits before a trial call"
+    )
+    job_max_attempts: int = Field(default=3, description="Attempts of a queued receipt parse before it fails")
+    job_retry_base_seconds: float = Field(
+        default=5.0, description="Delay before the first retry of a failed job, doubled on each further retry"
+    )
+    job_lease_seconds: float = Field(
+        default=300.0, description="Seconds a worker may hold a job before it is handed to another worker"
+    )
+    job_poll_interval_seconds: float = Field(
+        default=1.0, description="Seconds between polls for queued jobs and job status events"
+    )
+    job_worker_concurrency: int = Field(default=4, description="Jobs processed concurrently by each worker process")
+    server_timing_header: bool = Field(
+        default=False, description="Return a per-request pipeline stage breakdown in a Server-Timing header"
+    )
+    item_canonicalization_enabled: bool = Field(
+        default=True, description="Match receipt item names to existing items of the store, e.g. abbreviations"
+    )
+    item_match_threshold: float = Field(
+        default=0.85, description="Similarity from 0 to 1 above which an item name matches an existing item"
+    )
+    item_catalog_enabled: bool = Field(
+        default=True, description="Send the user's known stores and items so the model can refer to them by ID"
+    )
+    item_catalog_max_stores: int = Field(default=3, description="Most frequent stores of the user in the item catalog")
+    item_catalog_max_items: int = Field(default=200, description="Most purchased items per store in the item catalog")
+    item_catalog_ttl_seconds: float = Field(
+        default=600.0, description="Seconds the items of a store are cached before being reloaded"
+    )
+    response_cache_enabled: bool = Field(default=True, description="Cache GET responses of read endpoints in memory")
+    response_cache_ttl_seconds: float = Field(default=60.0, description="Seconds a cached response is served at most")
+    response_cache_max_entries: int = Field(default=4096, description="Maximum number of cached responses")
+    response_cache_max_age_seconds: int = Field(
+        default=0, description="Seconds clients may reuse a response before revalidating it with its ETag"
+    )
+    warm_llm_clients: bool = Field(default=False, description="Create the Gemini clients at startup")
     model_config = {
         "env_file": ".env.local",
         "env_file_encoding": "utf-8",
@@ -0,0 +1,151 @@
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from orm.engine import get_pool_stats
+
+# Latency buckets in seconds, from in-process lookups up to slow LLM calls
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram(
+    "food_pipeline_stage_seconds",
+    "Time spent in each stage of the receipt pipeline",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "food_http_request_seconds",
+    "Time to the start of the HTTP response",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge("food_http_requests_in_progress", "HTTP requests currently being handled")
+LLM_CALLS = Counter("food_llm_calls_total", "Receipt parsing LLM calls", ["model", "outcome"])
+LLM_TOKENS = Counter("food_llm_tokens_total", "Tokens used by receipt parsing LLM calls", ["model", "kind"])
+ROUTING_EVENTS = Counter(
+    "food_llm_routing_events_total",
+    "Escalations, hedged calls and skipped models of the model router",
+    ["model", "event"],
+)
+CIRCUIT_BREAKER_OPEN = Gauge("food_llm_circuit_breaker_open", "Whether the circuit of a model is open", ["model"])
+PARSE_CACHE_REQUESTS = Counter("food_parse_cache_requests_total", "Parse cache lookups", ["result"])
+IMAGE_BYTES_SAVED = Counter("food_image_bytes_saved_total", "Bytes removed from images by preprocessing")
+PRECLASSIFIER_SCORES = Histogram(
+    "food_preclassifier_score",
+    "Receipt likelihood of the images scored by the local pre-classifier",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+LLM_CALLS_SAVED = Counter("food_llm_calls_saved_total", "Receipt parses answered without an LLM call", ["reason"])
+ITEM_CATALOG_PARSES = Counter(
+    "food_item_catalog_parses_total", "Receipt parses given the item catalog of the user", ["outcome"]
+)
+
+# Stage timings of the current request, shared by the tasks and threads it spawns
+request_timings: ContextVar[list[tuple[str, float]] | None] = ContextVar("request_timings", default=None)
+
+
+def observe_stage(stage: str, seconds: float):
+    """Record the duration of a pipeline stage in the histogram and the current request's timings."""
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """Time the enclosed block as a pipeline stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def format_server_timing(timings: list[tuple[str, float]]) -> str:
+    """Format stage timings as a Server-Timing header value, summing repeated stages."""
+    totals: dict[str, float] = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items())
+
+
+class DatabasePoolCollector:
+    """Export the connection pool metrics of the database engines at scrape time."""
+
+    def collect(self):
+        checked_out = GaugeMetricFamily("food_db_pool_checked_out", "Connections currently in use", labels=["database"])
+        checked_in = GaugeMetricFamily("food_db_pool_checked_in", "Idle connections in the pool", labels=["database"])
+        overflow = GaugeMetricFamily(
+            "food_db_pool_overflow", "Connections opened beyond the pool size", labels=["database"]
+        )
+        checkouts = CounterMetricFamily(
+            "food_db_pool_checkouts", "Connections acquired from the pool", labels=["database"]
+        )
+        wait_seconds = CounterMetricFamily(
+            "food_db_pool_wait_seconds", "Time spent acquiring connections", labels=["database"]
+        )
+
+        for stats in get_pool_stats():
+            database = stats.database + (" (async)" if stats.is_async else "")
+            if stats.checked_out is not None:
+                checked_out.add_metric([database], stats.checked_out)
+                checked_in.add_metric([database], stats.checked_in)
+                overflow.add_metric([database], stats.overflow)
+            checkouts.add_metric([database], stats.checkouts)
+            wait_seconds.add_metric([database], stats.wait_seconds_total)
+
+        yield from (checked_out, checked_in, overflow, checkouts, wait_seconds)
+
+
+REGISTRY.register(DatabasePoolCollector())
+
+
+class MetricsMiddleware:
+    """
+    Track request latency and concurrency, collecting the stage timings of each request.
+
+    When `timing_header` is set the stage timings recorded before the response starts are returned
+    in a Server-Timing header.
+    """
+
+    def __init__(self, app: ASGIApp, timing_header: bool = False):
+        self.app = app
+        self.timing_header = timing_header
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: list[tuple[str, float]] = []
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timings(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - start
+                route = scope.get("route")
+                HTTP_REQUEST_SECONDS.labels(
+                    method=scope["method"], route=getattr(route, "path", "unmatched"), status=status
+                ).observe(elapsed)
+                if self.timing_header:
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Server-Timing", format_server_timing([*timings, ("total", elapsed)]))
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            HTTP_REQUESTS_IN_PROGRESS.dec()
+            request_timings.reset(token)
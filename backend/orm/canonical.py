@@ -0,0 +1,357 @@
+import re
+import threading
+from collections import Counter
+from typing import NamedTuple
+
+from sqlalchemy import case, delete, update
+from sqlmodel import Session, select
+
+from config import settings
+from orm.data_models import GroceryCategory, Item, ItemAlias, ItemPrice, Transaction
+from orm.engine import get_dialect_insert
+
+# Common receipt abbreviations, expanded before names are compared
+ABBREVIATIONS = {
+    "bf": "beef",
+    "bnls": "boneless",
+    "brd": "bread",
+    "brst": "breast",
+    "chs": "cheese",
+    "chkn": "chicken",
+    "choc": "chocolate",
+    "crm": "cream",
+    "frz": "frozen",
+    "grd": "ground",
+    "grn": "green",
+    "lg": "large",
+    "lrg": "large",
+    "med": "medium",
+    "org": "organic",
+    "sknls": "skinless",
+    "sm": "small",
+    "veg": "vegetable",
+    "whl": "whole",
+    "wht": "white",
+    "yog": "yogurt",
+}
+
+# Whole words of up to four letters, which are not read as abbreviations of longer words (corn -> cornflakes)
+SHORT_WORDS = frozenset(
+    {
+        "bar", "bean", "beef", "bun", "cake", "chip", "cod", "corn", "crab", "cup", "date", "diet", "dill",
+        "dip", "duck", "egg", "feta", "fig", "fish", "ham", "hot", "ice", "jam", "kale", "lamb", "leek",
+        "lime", "loaf", "mild", "milk", "mini", "mint", "mix", "naan", "nut", "oat", "oil", "pea", "pear",
+        "pie", "pita", "plum", "pop", "pork", "red", "rice", "roll", "rye", "sage", "salt", "soda", "soup",
+        "soy", "sub", "tea", "tofu", "tuna", "veal", "wrap", "yam",
+    }
+)  # fmt: skip
+
+_NON_ALPHANUMERIC = re.compile(r"[^a-z0-9]+")
+_VOWELS = frozenset("aeiou")
+
+# Candidates scored in full per lookup, picked by the number of shared trigrams
+MAX_CANDIDATES = 20
+
+
+class ItemRef(NamedTuple):
+    id: int
+    category: GroceryCategory
+
+
+def singularize(token: str) -> str:
+    """Strip the plural suffix of an English word, e.g. bananas -> banana, berries -> berry."""
+    if len(token) <= 3 or not token.isalpha() or token.endswith("ss"):
+        return token
+    if token.endswith("ies"):
+        return token[:-3] + "y"
+    if token.endswith(("oes", "ches", "shes", "xes")):
+        return token[:-2]
+    if token.endswith("s"):
+        return token[:-1]
+    return token
+
+
+def normalize_item_name(name: str) -> str:
+    """Normalize an item name to the key items are matched on.
+
+    Lowercases, drops punctuation, expands common abbreviations and singularizes, so that e.g.
+    "ORG. BANANAS" and "Organic Banana" share the key "organic banana".
+    """
+    tokens = (token for token in _NON_ALPHANUMERIC.split(name.lower()) if token)
+    return " ".join(singularize(ABBREVIATIONS.get(token, token)) for token in tokens)
+
+
+def get_skeleton(token: str) -> str:
+    """Reduce a word to its first letter and following consonants without repeats, e.g. banana -> bnn."""
+    if not token.isalpha():
+        return token
+    skeleton = token[0]
+    for char in token[1:]:
+        if char not in _VOWELS and char != skeleton[-1]:
+            skeleton += char
+    return skeleton
+
+
+def get_trigrams(tokens: list[str]) -> set[str]:
+    """Get the trigrams of the skeletons of the tokens, padded to include word boundaries."""
+    trigrams = set()
+    for token in tokens:
+        padded = f" {get_skeleton(token)} "
+        trigrams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def is_subsequence(short: str, long: str) -> bool:
+    chars = iter(long)
+    return all(char in chars for char in short)
+
+
+def is_abbreviation(token: str) -> bool:
+    """Check whether a word may abbreviate a longer one rather than be a complete word.
+
+    Abbreviations on receipts drop vowels (chkn) or are short truncations (choc); longer words with
+    vowels are complete words, so e.g. butter does not abbreviate buttermilk.
+    """
+    return token not in SHORT_WORDS and (len(token) <= 4 or not _VOWELS.intersection(token[1:]))
+
+
+def get_token_similarity(a: str, b: str) -> float:
+    """Score how likely one word abbreviates the other, from 0 to 1.
+
+    A prefix (org -> organic) or a subsequence starting with the same letter (bnna -> banana) counts as
+    an abbreviation, unless the shorter word is a complete word (see is_abbreviation); numbers only
+    match exactly.
+    """
+    if a == b:
+        return 1.0
+    short, long = sorted((a, b), key=len)
+    if len(short) < 2 or short[0] != long[0] or not long.isalpha() or not is_abbreviation(short):
+        return 0.0
+    if long.startswith(short):
+        return 0.9
+    if len(short) >= 3 and is_subsequence(short, long):
+        return 0.7 + 0.3 * len(short) / len(long)
+    return 0.0
+
+
+def get_name_similarity(tokens: list[str], other_tokens: list[str]) -> float:
+    """Score two tokenized names from 0 to 1 by greedily pairing their most similar words."""
+    if not tokens or not other_tokens:
+        return 0.0
+    unmatched = list(other_tokens)
+    total = 0.0
+    for token in tokens:
+        scores = [get_token_similarity(token, other) for other in unmatched]
+        if not scores:
+            break
+        best = max(range(len(scores)), key=scores.__getitem__)
+        if scores[best] > 0:
+            total += scores[best]
+            unmatched.pop(best)
+    return total / max(len(tokens), len(other_tokens))
+
+
+class CanonicalItemIndex:
+    """
+    In-process index of the item names of a store for fuzzy matching.
+
+    Exact normalized keys are found with a dict lookup. Otherwise the trigrams of the names' consonant
+    skeletons select a few candidates from posting lists, which are then scored word by word, so a
+    lookup only touches items sharing parts of the name.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._ids_by_key: dict[str, int] = {}
+        self._tokens_by_id: dict[int, list[str]] = {}
+        self._postings: dict[str, set[int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._tokens_by_id)
+
+    def add(self, item_id: int, name: str):
+        """Add an item name to the index."""
+        key = normalize_item_name(name)
+        tokens = key.split()
+        with self._lock:
+            self._ids_by_key.setdefault(key, item_id)
+            self._tokens_by_id[item_id] = tokens
+            for trigram in get_trigrams(tokens):
+                self._postings.setdefault(trigram, set()).add(item_id)
+
+    def discard(self, item_id: int):
+        """Remove an item, e.g. one that was merged or no longer exists."""
+        with self._lock:
+            tokens = self._tokens_by_id.pop(item_id, None)
+            if tokens is None:
+                return
+            key = " ".join(tokens)
+            if self._ids_by_key.get(key) == item_id:
+                del self._ids_by_key[key]
+            for trigram in get_trigrams(tokens):
+                self._postings.get(trigram, set()).discard(item_id)
+
+    def match(self, name: str) -> int | None:
+        """Find the item most similar to a name, or None if no item reaches the threshold."""
+        key = normalize_item_name(name)
+        tokens = key.split()
+        with self._lock:
+            item_id = self._ids_by_key.get(key)
+            if item_id is not None:
+                return item_id
+
+            trigrams = get_trigrams(tokens)
+            shared_trigrams = Counter()
+            for trigram in trigrams:
+                shared_trigrams.update(self._postings.get(trigram, ()))
+            candidates = [
+                (candidate_id, self._tokens_by_id[candidate_id])
+                for candidate_id, count in shared_trigrams.most_common(MAX_CANDIDATES)
+                if count * 3 >= len(trigrams)
+            ]
+
+        best_id, best_score = None, self.threshold
+        for candidate_id, candidate_tokens in candidates:
+            score = get_name_similarity(tokens, candidate_tokens)
+            if score >= best_score:
+                best_id, best_score = candidate_id, score
+        return best_id
+
+
+# Global canonical indexes keyed by database URL and store ID
+canonical_indexes: dict[tuple[str, int], CanonicalItemIndex] = {}
+_canonical_indexes_lock = threading.Lock()
+
+
+def get_canonical_index(session: Session, store_id: int) -> CanonicalItemIndex:
+    """Get the canonical index of a store, loading the store's items on first use."""
+    index_key = (str(session.get_bind().url), store_id)
+    index = canonical_indexes.get(index_key)
+    if index is None:
+        with _canonical_indexes_lock:
+            index = canonical_indexes.get(index_key)
+            if index is None:
+                index = CanonicalItemIndex(threshold=settings.item_match_threshold)
+                for item_id, name in session.exec(select(Item.id, Item.name).where(Item.store_id == store_id)):
+                    index.add(item_id, name)
+                canonical_indexes[index_key] = index
+    return index
+
+
+def resolve_item_names(session: Session, store_id: int, names: list[str]) -> dict[str, ItemRef]:
+    """Resolve item names without an exact match to existing items of a store.
+
+    Names are looked up by their normalized key in the store's aliases, then fuzzily matched against
+    the store's items. Fuzzy matches are confirmed against the database, since the in-process index may
+    hold items of transactions that were rolled back.
+
+    Args:
+        session (Session): The database session.
+        store_id (int): The ID of the store.
+        names (list[str]): The item names to resolve.
+
+    Returns:
+        dict[str, ItemRef]: The resolved items keyed by name; unresolved names are left out.
+    """
+    keys = {name: normalize_item_name(name) for name in names}
+    aliases = {
+        alias: ItemRef(item_id, category)
+        for alias, item_id, category in session.exec(
+            select(ItemAlias.alias, Item.id, Item.category)
+            .join(Item, Item.id == ItemAlias.item_id)
+            .where(ItemAlias.store_id == store_id, ItemAlias.alias.in_(set(keys.values())))
+        )
+    }
+    items_by_name = {name: aliases[key] for name, key in keys.items() if key in aliases}
+
+    index = get_canonical_index(session, store_id)
+    matched_ids = {}
+    for name in names:
+        if name not in items_by_name:
+            item_id = index.match(name)
+            if item_id is not None:
+                matched_ids[name] = item_id
+    if matched_ids:
+        categories = dict(
+            session.exec(
+                select(Item.id, Item.category).where(Item.store_id == store_id, Item.id.in_(set(matched_ids.values())))
+            ).all()
+        )
+        for name, item_id in matched_ids.items():
+            if item_id in categories:
+                items_by_name[name] = ItemRef(item_id, categories[item_id])
+            else:
+                index.discard(item_id)
+    return items_by_name
+
+
+def record_item_aliases(session: Session, store_id: int, items_by_name: dict[str, ItemRef]):
+    """Store the normalized names of resolved or created items as aliases of the store in a single statement.
+
+    Args:
+        session (Session): The database session.
+        store_id (int): The ID of the store.
+        items_by_name (dict[str, ItemRef]): The items keyed by the name read off the receipt.
+    """
+    if not items_by_name:
+        return
+
+    aliases = {normalize_item_name(name): item.id for name, item in items_by_name.items()}
+    insert = get_dialect_insert(session)
+    item_aliases = ItemAlias.__table__
+    session.exec(
+        insert(item_aliases)
+        .values([{"store_id": store_id, "alias": alias, "item_id": item_id} for alias, item_id in aliases.items()])
+        .on_conflict_do_nothing(index_elements=[item_aliases.c.store_id, item_aliases.c.alias])
+    )
+
+
+def merge_duplicate_items(session: Session, store_id: int, dry_run: bool = False) -> dict[int, int]:
+    """Merge the items of a store whose names match an older item, and record aliases for all items.
+
+    Transactions, prices and aliases of a duplicate are moved to the item it matched before it is
+    deleted. Spending rollups use the category of the item and should be rebuilt after merging.
+
+    Args:
+        session (Session): The database session.
+        store_id (int): The ID of the store.
+        dry_run (bool): Whether to only find the duplicates without changing the database.
+
+    Returns:
+        dict[int, int]: The IDs of the merged items keyed by the ID of their duplicates.
+    """
+    index = CanonicalItemIndex(threshold=settings.item_match_threshold)
+    canonical_ids: dict[int, int] = {}
+    aliases: dict[str, int] = {}
+    for item_id, name in session.exec(select(Item.id, Item.name).where(Item.store_id == store_id).order_by(Item.id)):
+        canonical_id = index.match(name)
+        if canonical_id is None:
+            index.add(item_id, name)
+            canonical_id = item_id
+        else:
+            canonical_ids[item_id] = canonical_id
+        aliases.setdefault(normalize_item_name(name), canonical_id)
+    if dry_run or not aliases:
+        return canonical_ids
+
+    if canonical_ids:
+        duplicate_ids = list(canonical_ids)
+        for model in (Transaction, ItemPrice, ItemAlias):
+            session.exec(
+                update(model)
+                .where(model.item_id.in_(duplicate_ids))
+                .values(item_id=case(canonical_ids, value=model.item_id))
+            )
+        session.exec(delete(Item).where(Item.id.in_(duplicate_ids)))
+
+    insert = get_dialect_insert(session)
+    item_aliases = ItemAlias.__table__
+    session.exec(
+        insert(item_aliases)
+        .values([{"store_id": store_id, "alias": alias, "item_id": item_id} for alias, item_id in aliases.items()])
+        .on_conflict_do_nothing(index_elements=[item_aliases.c.store_id, item_aliases.c.alias])
+    )
+    # The in-process index of the store is reloaded on next use
+    canonical_indexes.pop((str(session.get_bind().url), store_id), None)
+    return canonical_ids
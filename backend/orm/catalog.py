@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+from metrics import track_stage
+from orm.data_models import (
+    CompactGroceryReceiptSchema,
+    GroceryCategory,
+    GroceryReceipt,
+    GroceryReceiptSchema,
+    Item,
+    ItemSchema,
+    Purchase,
+    Store,
+    StoreBase,
+    Transaction,
+    User,
+    UserBase,
+)
+from orm.engine import get_async_engine
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownReferenceError(ValueError):
+    """Raised when a compact receipt refers to a store or item missing from the catalog it was parsed with."""
+
+
+class StoreCatalog(NamedTuple):
+    store: StoreBase
+    items: dict[int, ItemSchema]
+
+
+class ItemCatalog:
+    """
+    Known stores of a user and their most purchased items, sent to the model so it can refer to them by ID.
+
+    The model then returns a CompactGroceryReceiptSchema holding references and prices instead of
+    full item names, categories and brands, which `expand` turns back into a GroceryReceiptSchema.
+    """
+
+    def __init__(self, stores: dict[int, StoreCatalog]):
+        self.stores = {store_id: catalog.store for store_id, catalog in stores.items()}
+        self.items = {item_id: item for catalog in stores.values() for item_id, item in catalog.items.items()}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def format_stores(self) -> str:
+        """List the stores as `ID: name, address` lines."""
+        return "\n".join(
+            f"{store_id}: {', '.join(part for part in (store.name, store.address) if part)}"
+            for store_id, store in sorted(self.stores.items())
+        )
+
+    def format_items(self) -> str:
+        """List the items as `ID: name | category | brand` lines, in a stable order so prompts share a prefix."""
+        return "\n".join(
+            f"{item_id}: {item.name} | {item.category.value} | {item.brand or '-'}"
+            for item_id, item in sorted(self.items.items())
+        )
+
+    def expand(self, compact: CompactGroceryReceiptSchema, user: str) -> GroceryReceiptSchema:
+        """Expand the references of a compact receipt into a full receipt.
+
+        Args:
+            compact (CompactGroceryReceiptSchema): The receipt returned by the model.
+            user (str): The username to populate in the receipt.
+
+        Returns:
+            GroceryReceiptSchema: The receipt with the names, categories and brands of the referenced items.
+
+        Raises:
+            UnknownReferenceError: If a reference is not in the catalog, or a new item has no name.
+        """
+        if compact.store_ref is not None:
+            if compact.store_ref not in self.stores:
+                raise UnknownReferenceError(f"Unknown store reference {compact.store_ref}.")
+            store = self.stores[compact.store_ref]
+        else:
+            store = compact.store or StoreBase()
+
+        purchases = []
+        for purchase in compact.purchases:
+            if purchase.item_ref is not None:
+                item = self.items.get(purchase.item_ref)
+                if item is None:
+                    raise UnknownReferenceError(f"Unknown item reference {purchase.item_ref}.")
+            elif purchase.name:
+                item = ItemSchema(
+                    name=purchase.name, category=purchase.category or GroceryCategory.OTHER, brand=purchase.brand
+                )
+            else:
+                raise UnknownReferenceError("A purchase has neither an item reference nor a name.")
+            purchases.append(
+                Purchase(
+                    name=item.name,
+                    category=item.category,
+                    brand=item.brand,
+                    quantity=purchase.quantity,
+                    unit_price=purchase.unit_price,
+                    unit_type=purchase.unit_type,
+                )
+            )
+
+        return GroceryReceiptSchema(
+            is_valid=compact.is_valid,
+            date_time=compact.date_time,
+            user=UserBase(username=user),
+            store=store,
+            purchases=purchases,
+        )
+
+
+async def load_store_catalog(session: AsyncSession, store_id: int, max_items: int) -> StoreCatalog:
+    """Load a store and its most purchased items."""
+    store = await session.get(Store, store_id)
+    rows = await session.exec(
+        select(Item.id, Item.name, Item.category, Item.brand)
+        .outerjoin(Transaction, Transaction.item_id == Item.id)
+        .where(Item.store_id == store_id)
+        .group_by(Item.id, Item.name, Item.category, Item.brand)
+        .order_by(func.count(Transaction.id).desc(), Item.id)
+        .limit(max_items)
+    )
+    return StoreCatalog(
+        store=StoreBase(name=store.name, address=store.address, phone=store.phone),
+        items={
+            item_id: ItemSchema(name=name, category=category, brand=brand) for item_id, name, category, brand in rows
+        },
+    )
+
+
+# Global store catalogs keyed by database URL and store ID, with the monotonic time they expire
+store_catalogs: dict[tuple[str, int], tuple[float, StoreCatalog]] = {}
+_store_catalogs_lock = threading.Lock()
+
+
+async def load_item_catalog_async(username: str, db_url: str) -> ItemCatalog:
+    """Load the catalog of the stores a user shops at most, reusing the cached items of each store."""
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        store_ids = await session.exec(
+            select(GroceryReceipt.store_id)
+            .join(User, User.id == GroceryReceipt.user_id)
+            .join(Store, Store.id == GroceryReceipt.store_id)
+            .where(User.username == username, Store.name != StoreBase().name)
+            .group_by(GroceryReceipt.store_id)
+            .order_by(func.count().desc(), GroceryReceipt.store_id)
+            .limit(settings.item_catalog_max_stores)
+        )
+
+        catalogs = {}
+        for store_id in store_ids.all():
+            cached = store_catalogs.get((db_url, store_id))
+            if cached is None or cached[0] <= time.monotonic():
+                catalog = await load_store_catalog(session, store_id, max_items=settings.item_catalog_max_items)
+                with _store_catalogs_lock:
+                    store_catalogs[(db_url, store_id)] = (time.monotonic() + settings.item_catalog_ttl_seconds, catalog)
+            else:
+                catalog = cached[1]
+            catalogs[store_id] = catalog
+    return ItemCatalog(catalogs)
+
+
+async def get_item_catalog_async(username: str, db_url: str | None = None) -> ItemCatalog:
+    """Get the catalog of the stores a user shops at most.
+
+    The receipt's store is only known once parsed, so the catalog covers the user's most frequent
+    stores. The items of each store are cached in-process for `item_catalog_ttl_seconds`, so a
+    repeat user takes a single query. Stores whose name could not be parsed are left out.
+
+    Args:
+        username (str): The username of the user.
+        db_url (str | None): The database URL, defaults to the configured database.
+
+    Returns:
+        ItemCatalog: The catalog, empty for a new user or if the database is unavailable.
+    """
+    db_url = db_url or settings.database_url
+    with track_stage("catalog_load"):
+        try:
+            return await load_item_catalog_async(username, db_url=db_url)
+        except SQLAlchemyError:
+            logger.warning("Could not load the item catalog, parsing without it.", exc_info=True)
+            return ItemCatalog({})
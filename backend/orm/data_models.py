@@ -1,8 +1,9 @@
 import hashlib
-from datetime import datetime
+import uuid
+from datetime import date, datetime
 from enum import StrEnum
 
-from sqlalchemy import String, UniqueConstraint
+from sqlalchemy import JSON, Index, LargeBinary, String, UniqueConstraint
 from sqlmodel import Column, Field, Relationship, SQLModel
 
 
@@ -34,11 +35,17 @@ class UserBase(SQLModel):
 
 class User(UserBase, table=True):
     __tablename__ = "users"
+    __table_args__ = (Index("ix_users_username", "username", unique=True),)
 
     id: int | None = Field(default=None, primary_key=True, description="Unique identifier for the user")
     email: str | None = Field(default=None, description="User email")
     first_name: str | None = Field(default=None, description="User's first name")
     last_name: str | None = Field(default=None, description="User's last name")
+    data_version: int = Field(
+        default=0,
+        sa_column_kwargs={"server_default": "0"},
+        description="Incremented by each change of the user's data, invalidating the cached responses computed from it",
+    )
 
     receipts: list["GroceryReceipt"] = Relationship(back_populates="user", sa_relationship_kwargs={"lazy": "select"})
 
@@ -51,6 +58,8 @@ class StoreBase(SQLModel):
 
 class Store(StoreBase, table=True):
     __tablename__ = "stores"
+    # Stores are looked up by name when saving receipts, and concurrent saves must not create a store twice
+    __table_args__ = (Index("uix_stores_name", "name", unique=True),)
 
     id: int = Field(primary_key=True, description="Unique identifier for the store")
 
@@ -69,9 +78,11 @@ class Transaction(TransactionBase, table=True):
 
     id: int = Field(primary_key=True, description="Unique identifier for transaction")
     receipt_id: int | None = Field(
-        default=None, foreign_key="grocery_receipts.id", description="ID of the associated grocery receipt"
+        default=None, foreign_key="grocery_receipts.id", index=True, description="ID of the associated grocery receipt"
+    )
+    item_id: int = Field(
+        foreign_key="items.id", index=True, description="ID of the purchased item, referencing the Item table"
     )
-    item_id: int = Field(foreign_key="items.id", description="ID of the purchased item, referencing the Item table")
 
     item: "Item" = Relationship(back_populates="transactions", sa_relationship_kwargs={"lazy": "select"})
     receipt: "GroceryReceipt" = Relationship(back_populates="transactions", sa_relationship_kwargs={"lazy": "select"})
@@ -87,6 +98,11 @@ class ItemSchema(SQLModel):
 
 class Item(ItemSchema, table=True):
     __tablename__ = "items"
+    __table_args__ = (
+        Index("uix_item_store", "store_id", "name", unique=True),
+        # Finds an item across stores for price comparison
+        Index("ix_items_name", "name"),
+    )
 
     id: int = Field(primary_key=True, description="Unique identifier for the item")
     store_id: int = Field(foreign_key="stores.id", description="ID of the store where the item is sold")
@@ -94,8 +110,17 @@ class Item(ItemSchema, table=True):
     store: Store | None = Relationship(back_populates="items", sa_relationship_kwargs={"lazy": "select"})
     transactions: list[Transaction] = Relationship(back_populates="item", sa_relationship_kwargs={"lazy": "select"})
 
-    class Config:
-        sa_table_args = (UniqueConstraint("store_id", "name", name="uix_item_store"),)
+
+class ItemAlias(SQLModel, table=True):
+    """A normalized item name of a store resolved to an item, e.g. an abbreviation read off a receipt."""
+
+    __tablename__ = "item_aliases"
+    __table_args__ = (UniqueConstraint("store_id", "alias", name="uix_item_alias_store"),)
+
+    id: int = Field(primary_key=True, description="Unique identifier for the alias")
+    store_id: int = Field(foreign_key="stores.id", description="ID of the store the alias is used at")
+    alias: str = Field(description="Normalized item name, see orm/canonical.py")
+    item_id: int = Field(foreign_key="items.id", index=True, description="ID of the item the alias resolves to")
 
 
 class Purchase(TransactionBase, ItemSchema):
@@ -115,8 +140,34 @@ class GroceryReceiptSchema(GroceryReceiptBase):
     purchases: list[Purchase] = Field(description="List of purchased items")
 
 
+class CompactPurchase(TransactionBase):
+    """A purchase returned by the model as a reference to a known item, or in full for a new item."""
+
+    item_ref: int | None = Field(default=None, description="ID of the purchased item if it is one of the known items")
+    name: str | None = Field(default=None, description="Name of the item, only if it is not a known item")
+    category: GroceryCategory | None = Field(
+        default=None, description="Category of the item, only if it is not a known item"
+    )
+    brand: str | None = Field(
+        default=None, description="Brand of the item, only if it is not a known item and the brand is clear"
+    )
+
+
+class CompactGroceryReceiptSchema(GroceryReceiptBase):
+    """A receipt returned by the model when given the known stores and items of the user, see orm/catalog.py."""
+
+    is_valid: bool = Field(description="Indicates if a valid grocery receipt")
+    store_ref: int | None = Field(default=None, description="ID of the store if it is one of the known stores")
+    store: StoreBase | None = Field(
+        default=None, description="Store where the purchase was made, only if it is not a known store"
+    )
+    purchases: list[CompactPurchase] = Field(description="List of purchased items")
+
+
 class GroceryReceipt(GroceryReceiptBase, table=True):
     __tablename__ = "grocery_receipts"
+    # Serves the receipt history of a user in keyset order
+    __table_args__ = (Index("ix_grocery_receipts_user_date", "user_id", "date_time", "id"),)
 
     id: int = Field(primary_key=True, description="Unique identifier for the grocery receipt")
     user_id: int = Field(foreign_key="users.id", description="ID of the user who made the purchase")
@@ -128,22 +179,40 @@ class GroceryReceipt(GroceryReceiptBase, table=True):
         sa_column=Column(String(64), unique=True, index=True),
         description="Unique hash of the receipt image for deduplication",
     )
+    perceptual_hash: str | None = Field(
+        default=None,
+        sa_column=Column(String(16)),
+        description="64-bit dHash of the receipt image in hex, for near-duplicate detection",
+    )
 
     user: User = Relationship(back_populates="receipts", sa_relationship_kwargs={"lazy": "select"})
     store: Store = Relationship(back_populates="receipts", sa_relationship_kwargs={"lazy": "select"})
     transactions: list[Transaction] = Relationship(back_populates="receipt", sa_relationship_kwargs={"lazy": "select"})
 
     @staticmethod
-    def generate_image_hash(image_content: bytes) -> str:
+    def new_image_hasher() -> "hashlib._Hash":
+        """Create a SHA-256 hasher for incrementally hashing image content."""
+        return hashlib.sha256()
+
+    @classmethod
+    def generate_image_hash(cls, image_content: bytes) -> str:
         """Generate a SHA-256 hash for the given image content."""
-        return hashlib.sha256(image_content).hexdigest()
+        hasher = cls.new_image_hasher()
+        hasher.update(image_content)
+        return hasher.hexdigest()
 
     @classmethod
     def from_image_and_data(
-        cls, image_content: bytes, user_id: int, store_id: int, date_time: datetime | None
+        cls,
+        image_content: bytes,
+        user_id: int,
+        store_id: int,
+        date_time: datetime | None,
+        perceptual_hash: str | None = None,
     ) -> "GroceryReceipt":
         receipt_data = {
             "image_hash": cls.generate_image_hash(image_content),
+            "perceptual_hash": perceptual_hash,
             "user_id": user_id,
             "store_id": store_id,
             "date_time": date_time,
@@ -151,3 +220,137 @@ class GroceryReceipt(GroceryReceiptBase, table=True):
 
         receipt = cls(**receipt_data)
         return receipt
+
+
+class ReceiptRead(GroceryReceiptBase):
+    id: int = Field(description="Unique identifier for the grocery receipt")
+    store: StoreBase = Field(default=StoreBase(), description="Store where the purchase was made")
+    item_count: int = Field(description="Number of purchases on the receipt")
+    total: float = Field(description="Sum of quantity times unit price of the purchases")
+    purchases: list[Purchase] | None = Field(default=None, description="Purchases on the receipt, if requested")
+
+
+class ReceiptPage(SQLModel):
+    receipts: list[ReceiptRead] = Field(description="Receipts ordered from the most recent purchase")
+    next_cursor: str | None = Field(default=None, description="Cursor of the next page, None on the last page")
+
+
+class ReceiptJobStatus(StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class ReceiptJobBase(SQLModel):
+    status: ReceiptJobStatus = Field(default=ReceiptJobStatus.QUEUED, index=True, description="Status of the job")
+    attempts: int = Field(default=0, description="Number of times the job has been started")
+    error: str | None = Field(default=None, description="Error of the last failed attempt")
+    created_at: datetime = Field(description="UTC time the job was enqueued")
+    updated_at: datetime = Field(description="UTC time the job was last updated")
+
+
+class ReceiptJob(ReceiptJobBase, table=True):
+    """A queued receipt parse, processed by the worker (see worker.py)."""
+
+    __tablename__ = "receipt_jobs"
+    # Enqueueing is idempotent per user and image, and jobs are only visible to the user who enqueued them
+    __table_args__ = (Index("uix_receipt_job_user_image", "username", "image_hash", unique=True),)
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True, description="Unique identifier for the job")
+    image_hash: str = Field(sa_column=Column(String(64), nullable=False), description="Hash of the receipt image")
+    username: str = Field(description="Username of the user who uploaded the receipt")
+    image_type: str = Field(description="Type of the uploaded image, e.g. jpeg")
+    image: bytes | None = Field(
+        default=None, sa_column=Column(LargeBinary), description="Image content, cleared once the job succeeds"
+    )
+    max_attempts: int = Field(description="Attempts before the job is marked as failed")
+    available_at: datetime = Field(index=True, description="UTC time from which the job may be claimed")
+    locked_until: datetime | None = Field(
+        default=None, description="UTC time the claim of a running job expires and it may be reclaimed"
+    )
+    result: dict | None = Field(default=None, sa_column=Column(JSON), description="Parsed receipt data")
+
+
+class ReceiptJobRead(ReceiptJobBase):
+    id: uuid.UUID = Field(description="Unique identifier for the job")
+    image_hash: str = Field(description="Hash of the receipt image")
+    result: GroceryReceiptSchema | None = Field(default=None, description="Parsed receipt data once succeeded")
+
+
+class RollupPeriod(StrEnum):
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
+
+
+class SpendingRollup(SQLModel, table=True):
+    """Spend and quantity of a user per category and store over a day, week or month.
+
+    Kept up to date in the transaction saving each receipt (see orm/rollups.py), so dashboards read a
+    few rows instead of aggregating transactions.
+    """
+
+    __tablename__ = "spending_rollups"
+    __table_args__ = (
+        UniqueConstraint("user_id", "period", "period_start", "category", "store_id", name="uix_spending_rollup"),
+    )
+
+    id: int = Field(primary_key=True, description="Unique identifier for the rollup")
+    user_id: int = Field(foreign_key="users.id", description="ID of the user who made the purchases")
+    store_id: int = Field(foreign_key="stores.id", description="ID of the store where the purchases were made")
+    category: GroceryCategory = Field(description="Category of the purchased items")
+    period: RollupPeriod = Field(description="Length of the period")
+    period_start: date = Field(description="First day of the period; weeks start on Monday")
+    spend: float = Field(default=0.0, description="Total spent, the sum of quantity times unit price")
+    quantity: float = Field(default=0.0, description="Total quantity purchased, regardless of unit type")
+    transaction_count: int = Field(default=0, description="Number of transactions")
+
+
+class SpendingSummary(SQLModel):
+    period_start: date | None = Field(default=None, description="First day of the period, if grouped by period")
+    category: GroceryCategory | None = Field(default=None, description="Category, if grouped by category")
+    store: str | None = Field(default=None, description="Name of the store, if grouped by store")
+    spend: float = Field(description="Total spent")
+    quantity: float = Field(description="Total quantity purchased, regardless of unit type")
+    transaction_count: int = Field(description="Number of transactions")
+
+
+class ItemPrice(SQLModel, table=True):
+    """Compact time series of item prices, normalized to a price per pound or per each.
+
+    Written alongside the transactions of each receipt (see orm/prices.py). The composite index covers
+    price history queries, so they are served from the index without reading the table.
+    """
+
+    __tablename__ = "item_prices"
+    __table_args__ = (Index("ix_item_prices_item_date", "item_id", "purchased_on", "unit_type", "unit_price"),)
+
+    id: int = Field(primary_key=True, description="Unique identifier for the price")
+    item_id: int = Field(foreign_key="items.id", description="ID of the purchased item")
+    receipt_id: int = Field(
+        foreign_key="grocery_receipts.id", index=True, description="ID of the receipt the price was read from"
+    )
+    purchased_on: date = Field(description="Date of the purchase")
+    unit_price: float = Field(description="Price per pound for items sold by weight, otherwise per each")
+    unit_type: UnitType = Field(description="Unit of the normalized price, either lb or ea")
+
+
+class PricePoint(SQLModel):
+    period_start: date = Field(description="First day of the bucket")
+    unit_type: UnitType = Field(description="Unit of the prices, either lb or ea")
+    min_price: float = Field(description="Lowest unit price in the bucket")
+    avg_price: float = Field(description="Average unit price in the bucket")
+    max_price: float = Field(description="Highest unit price in the bucket")
+    count: int = Field(description="Number of purchases in the bucket")
+
+
+class StorePriceSummary(SQLModel):
+    store: str = Field(description="Name of the store")
+    item_id: int = Field(description="ID of the item at the store")
+    unit_type: UnitType = Field(description="Unit of the prices, either lb or ea")
+    min_price: float = Field(description="Lowest unit price")
+    avg_price: float = Field(description="Average unit price")
+    max_price: float = Field(description="Highest unit price")
+    count: int = Field(description="Number of purchases")
+    last_purchased_on: date = Field(description="Date of the latest purchase")
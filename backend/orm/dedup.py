@@ -0,0 +1,235 @@
+import asyncio
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from collections.abc import Iterable
+from contextlib import contextmanager
+from pathlib import Path
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+from orm.data_models import GroceryReceipt
+from orm.engine import get_async_engine, get_engine
+
+logger = logging.getLogger(__name__)
+
+# Receipts below the highest indexed ID re-read by each refresh, so that receipts committed out of ID
+# order, e.g. a long save that started before a shorter one, are still picked up
+REFRESH_OVERLAP_RECEIPTS = 1000
+
+
+class BloomFilter:
+    """
+    Bloom filter over string keys.
+
+    The bit array lives in memory, or in a memory-mapped file when `path` is given so that several
+    worker processes mapping the same file (e.g. under /dev/shm) share one filter.
+    """
+
+    MAGIC = b"BLM1"
+    HEADER = struct.Struct("<4sQI")
+
+    def __init__(self, capacity: int, fp_rate: float, path: str | Path | None = None):
+        if capacity < 1 or not 0 < fp_rate < 1:
+            raise ValueError("Capacity must be positive and the false-positive rate between 0 and 1.")
+
+        self.num_bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2 / 8) * 8
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+
+        if self.path is None:
+            self._file = None
+            self._bits = bytearray(self.num_bits // 8)
+        else:
+            self._file, self._bits = self._open_mapped_bits(self.path)
+
+    def _open_mapped_bits(self, path: Path):
+        header = self.HEADER.pack(self.MAGIC, self.num_bits, self.num_hashes)
+        size = self.HEADER.size + self.num_bits // 8
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        file = os.fdopen(fd, "r+b")
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            # Recreate the file if it was sized for a different capacity or false-positive rate
+            if os.fstat(fd).st_size != size or file.read(self.HEADER.size) != header:
+                file.seek(0)
+                file.truncate(0)
+                file.write(header)
+                file.truncate(size)
+                file.flush()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        mapped = mmap.mmap(fd, size)
+        return file, memoryview(mapped)[self.HEADER.size :]
+
+    def _positions(self, key: str) -> list[int]:
+        digest = hashlib.sha256(key.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            if self._file is None:
+                yield
+                return
+            # Bits are set with read-modify-write on whole bytes, so writers in other processes must be excluded
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def add(self, key: str):
+        """Add the key to the filter."""
+        positions = self._positions(key)
+        with self._write_lock():
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+
+    def add_many(self, keys: list[str]):
+        """Add the keys to the filter under a single lock acquisition."""
+        positions = [position for key in keys for position in self._positions(key)]
+        with self._write_lock():
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class ReceiptDedupIndex:
+    """
+    In-process index of known receipt image hashes.
+
+    A miss means the image is definitely new and the database lookup can be skipped; a hit only means
+    the image is probably known and must be confirmed against the database. Until the index has been
+    loaded every lookup is treated as a probable hit.
+
+    Receipts are saved by the worker and ingestion processes. When the filter is in a file shared with
+    them, the savers update it directly. The index is also refreshed in the background from the
+    database, which covers savers on other hosts and in-memory filters: each refresh re-reads the last
+    REFRESH_OVERLAP_RECEIPTS receipts below the highest ID seen so receipts committed out of ID order
+    are not missed. Lookups themselves never query the database.
+    """
+
+    def __init__(self, bloom_filter: BloomFilter):
+        self.bloom_filter = bloom_filter
+        self.is_loaded = False
+        self.last_receipt_id = 0
+        self.lookups = 0
+        self.probable_hits = 0
+
+    def add_receipts(self, receipts: Iterable[tuple[int, str]]):
+        """Add receipts given as their ID and image hash."""
+        receipts = list(receipts)
+        self.bloom_filter.add_many([image_hash for _, image_hash in receipts])
+        self.last_receipt_id = max([self.last_receipt_id, *(receipt_id for receipt_id, _ in receipts)])
+
+    def select_new_receipts(self, overlap: int = 0):
+        """Select the receipts above the highest indexed ID, less `overlap` IDs."""
+        return (
+            select(GroceryReceipt.id, GroceryReceipt.image_hash)
+            .where(GroceryReceipt.id > max(0, self.last_receipt_id - overlap), GroceryReceipt.image_hash.is_not(None))
+            .order_by(GroceryReceipt.id)
+        )
+
+    def load(self, db_url: str | None = None, batch_size: int = 10000):
+        """Add all image hashes in the database to the index with a streamed scan."""
+        with Session(get_engine(db_url)) as session:
+            receipts = session.exec(self.select_new_receipts().execution_options(yield_per=batch_size))
+            for partition in receipts.partitions():
+                self.add_receipts(partition)
+        self.is_loaded = True
+
+    async def refresh_async(self, session: AsyncSession):
+        """Add the receipts saved since the index was last refreshed, including late commits below it."""
+        self.add_receipts((await session.exec(self.select_new_receipts(overlap=REFRESH_OVERLAP_RECEIPTS))).all())
+
+    def add(self, image_hash: str):
+        """Record a newly stored image hash."""
+        self.bloom_filter.add(image_hash)
+
+    def might_contain(self, image_hash: str) -> bool:
+        """Check whether the image hash may already be in the database."""
+        self.lookups += 1
+        is_probable_hit = not self.is_loaded or image_hash in self.bloom_filter
+        self.probable_hits += is_probable_hit
+        return is_probable_hit
+
+
+# Global dedup index instance
+dedup_index: ReceiptDedupIndex | None = None
+_dedup_index_lock = threading.Lock()
+
+
+def get_dedup_index() -> ReceiptDedupIndex | None:
+    """Get the receipt dedup index, or None if it is disabled."""
+    global dedup_index
+    if dedup_index is None and settings.dedup_index_enabled:
+        with _dedup_index_lock:
+            if dedup_index is None:
+                bloom_filter = BloomFilter(
+                    capacity=settings.dedup_bloom_capacity,
+                    fp_rate=settings.dedup_bloom_fp_rate,
+                    path=settings.dedup_bloom_path,
+                )
+                dedup_index = ReceiptDedupIndex(bloom_filter=bloom_filter)
+    return dedup_index
+
+
+def load_dedup_index(db_url: str | None = None):
+    """Load the dedup index from the database, leaving it unloaded if the database is unavailable."""
+    index = get_dedup_index()
+    if index is None:
+        return
+
+    try:
+        index.load(db_url=db_url)
+    except SQLAlchemyError:
+        logger.warning("Could not load the receipt dedup index, falling back to database lookups.", exc_info=True)
+
+
+async def refresh_dedup_index_periodically(db_url: str | None = None, interval_seconds: float | None = None):
+    """Refresh the dedup index from the database until cancelled, e.g. as a task of the API lifespan."""
+    index = get_dedup_index()
+    if index is None:
+        return
+    if interval_seconds is None:
+        interval_seconds = settings.dedup_refresh_interval_seconds
+
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            async with AsyncSession(get_async_engine(db_url)) as session:
+                await index.refresh_async(session)
+        except SQLAlchemyError:
+            logger.warning("Could not refresh the receipt dedup index.", exc_info=True)
+
+
+def filter_probable_image_hashes(image_hashes: list[str]) -> list[str]:
+    """Drop the image hashes the dedup index knows are not in the database."""
+    index = get_dedup_index()
+    if index is None:
+        return image_hashes
+    return [image_hash for image_hash in image_hashes if index.might_contain(image_hash)]
+
+
+def record_image_hash(image_hash: str | None):
+    """Record a committed receipt image hash in the dedup index."""
+    index = get_dedup_index()
+    if index is not None and image_hash is not None:
+        index.add(image_hash)
@@ -0,0 +1,180 @@
+import threading
+import time
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlmodel import Field, Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+
+# Async drivers used in place of the sync driver of a database URL
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+# Global engine instances keyed by database URL
+engines: dict[str, Engine] = {}
+async_engines: dict[str, AsyncEngine] = {}
+_engines_lock = threading.Lock()
+
+
+class PoolStats(SQLModel):
+    database: str = Field(description="Database URL of the engine with the password hidden")
+    is_async: bool = Field(description="Whether the engine uses an async driver")
+    pool_size: int | None = Field(default=None, description="Number of persistent connections in the pool")
+    checked_in: int | None = Field(default=None, description="Idle connections in the pool")
+    checked_out: int | None = Field(default=None, description="Connections currently in use")
+    overflow: int | None = Field(default=None, description="Connections opened beyond the pool size")
+    checkouts: int = Field(default=0, description="Connections acquired from the pool")
+    wait_seconds_total: float = Field(default=0.0, description="Total time spent acquiring connections")
+    wait_seconds_max: float = Field(default=0.0, description="Longest time spent acquiring a connection")
+
+
+class InstrumentedPoolMixin:
+    """Records how long callers wait to acquire a connection, including opening new ones."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._wait_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def get_pool_options(db_url: str, is_async: bool = False) -> dict:
+    """Get the connection pool options from the application settings.
+
+    SQLite keeps the SQLAlchemy defaults since in-memory databases must stay on a single connection.
+
+    Args:
+        db_url (str): The database URL.
+        is_async (bool): Whether the engine uses an async driver.
+
+    Returns:
+        dict: Keyword arguments for create_engine / create_async_engine.
+    """
+    if make_url(db_url).get_backend_name() == "sqlite":
+        return {}
+
+    return {
+        "poolclass": InstrumentedAsyncQueuePool if is_async else InstrumentedQueuePool,
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout_seconds,
+        "pool_recycle": settings.db_pool_recycle_seconds,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+
+
+def get_engine(db_url: str | None = None) -> Engine:
+    """Get the shared engine for the database URL, defaulting to the configured database."""
+    db_url = db_url or settings.database_url
+    if db_url not in engines:
+        with _engines_lock:
+            if db_url not in engines:
+                engines[db_url] = create_engine(db_url, **get_pool_options(db_url))
+    return engines[db_url]
+
+
+def get_session():
+    """FastAPI dependency to get database session"""
+    with Session(get_engine()) as session:
+        yield session
+
+
+def get_dialect_insert(session: Session):
+    """Get the dialect-specific insert construct supporting ON CONFLICT for the session's database."""
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == "postgresql":
+        return postgresql.insert
+    if dialect_name == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"Bulk upserts are not supported for {dialect_name}.")
+
+
+def get_async_database_url(db_url: str) -> str:
+    """Convert a database URL to use the async driver of its dialect.
+
+    Args:
+        db_url (str): The database URL, e.g. postgresql+psycopg2://...
+
+    Returns:
+        str: The database URL with an async driver, e.g. postgresql+asyncpg://...
+    """
+    url = make_url(db_url)
+    async_driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if async_driver is None or url.get_driver_name() in ("asyncpg", "aiosqlite", "psycopg"):
+        return url.render_as_string(hide_password=False)
+    return url.set(drivername=async_driver).render_as_string(hide_password=False)
+
+
+def get_async_engine(db_url: str | None = None) -> AsyncEngine:
+    """Get the shared async engine for the database URL, defaulting to the configured database."""
+    db_url = get_async_database_url(db_url or settings.database_url)
+    if db_url not in async_engines:
+        with _engines_lock:
+            if db_url not in async_engines:
+                async_engines[db_url] = create_async_engine(db_url, **get_pool_options(db_url, is_async=True))
+    return async_engines[db_url]
+
+
+async def get_async_session():
+    """FastAPI dependency to get an async database session"""
+    async with AsyncSession(get_async_engine()) as session:
+        yield session
+
+
+async def dispose_engines():
+    """Close the connection pools of all engines."""
+    for async_engine in async_engines.values():
+        await async_engine.dispose()
+    async_engines.clear()
+
+    for sync_engine in engines.values():
+        sync_engine.dispose()
+    engines.clear()
+
+
+def get_pool_stats() -> list[PoolStats]:
+    """Get the connection pool metrics of all engines."""
+    all_engines = [(sync_engine, False) for sync_engine in engines.values()]
+    all_engines += [(async_engine.sync_engine, True) for async_engine in async_engines.values()]
+
+    pool_stats = []
+    for sync_engine, is_async in all_engines:
+        pool = sync_engine.pool
+        stats = PoolStats(database=sync_engine.url.render_as_string(hide_password=True), is_async=is_async)
+        if isinstance(pool, QueuePool):
+            stats.pool_size = pool.size()
+            stats.checked_in = pool.checkedin()
+            stats.checked_out = pool.checkedout()
+            stats.overflow = max(pool.overflow(), 0)
+        if isinstance(pool, InstrumentedPoolMixin):
+            stats.checkouts = pool.checkouts
+            stats.wait_seconds_total = pool.wait_seconds_total
+            stats.wait_seconds_max = pool.wait_seconds_max
+        pool_stats.append(stats)
+    return pool_stats
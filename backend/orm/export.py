@@ -0,0 +1,337 @@
+import json
+import os
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from enum import StrEnum
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import func
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from orm.data_models import GroceryCategory, GroceryReceipt, Item, Store, Transaction, UnitType, User
+from orm.engine import get_async_engine, get_engine
+
+# Rows fetched from the server-side cursor and written per record batch
+EXPORT_BATCH_SIZE = 10000
+
+# File in the export directory holding the last exported transaction ID
+WATERMARK_FILE = "_watermark.json"
+
+# Transactions below the watermark re-read by each export, so that transactions committed out of ID
+# order, e.g. a long receipt save that started before a shorter one, are still exported
+EXPORT_OVERLAP_TRANSACTIONS = 10000
+
+# Partition of transactions whose receipt has no date
+UNKNOWN_MONTH = "unknown"
+
+# Fixed dictionaries of the enum columns, so every batch and file shares the same dictionary
+CATEGORY_DICTIONARY = pa.array([category.value for category in GroceryCategory], type=pa.string())
+UNIT_TYPE_DICTIONARY = pa.array([unit_type.value for unit_type in UnitType], type=pa.string())
+_category_indices = {category: index for index, category in enumerate(GroceryCategory)}
+_unit_type_indices = {unit_type: index for index, unit_type in enumerate(UnitType)}
+
+TRANSACTION_EXPORT_SCHEMA = pa.schema(
+    [
+        pa.field("transaction_id", pa.int64(), nullable=False),
+        pa.field("receipt_id", pa.int64()),
+        pa.field("date_time", pa.timestamp("us")),
+        pa.field("username", pa.string()),
+        pa.field("store_id", pa.int64()),
+        pa.field("store_name", pa.string()),
+        pa.field("item_id", pa.int64()),
+        pa.field("item_name", pa.string()),
+        pa.field("category", pa.dictionary(pa.int8(), pa.string())),
+        pa.field("brand", pa.string()),
+        pa.field("quantity", pa.float64()),
+        pa.field("unit_price", pa.float64()),
+        pa.field("unit_type", pa.dictionary(pa.int8(), pa.string())),
+    ]
+)
+
+
+class ExportFormat(StrEnum):
+    PARQUET = "parquet"
+    ARROW = "arrow"
+
+
+def select_transactions_for_export(since: int, until: int, username: str | None = None):
+    """Select the transactions with IDs in (since, until] joined with their receipt, user, item and store."""
+    query = (
+        select(
+            Transaction.id,
+            Transaction.receipt_id,
+            GroceryReceipt.date_time,
+            User.username,
+            Store.id,
+            Store.name,
+            Item.id,
+            Item.name,
+            Item.category,
+            Item.brand,
+            Transaction.quantity,
+            Transaction.unit_price,
+            Transaction.unit_type,
+        )
+        .join(Item, Item.id == Transaction.item_id)
+        .join(Store, Store.id == Item.store_id)
+        .outerjoin(GroceryReceipt, GroceryReceipt.id == Transaction.receipt_id)
+        .outerjoin(User, User.id == GroceryReceipt.user_id)
+        .where(Transaction.id > since, Transaction.id <= until)
+        .order_by(Transaction.id)
+    )
+    if username is not None:
+        query = query.where(User.username == username)
+    return query
+
+
+def to_record_batch(rows: list) -> pa.RecordBatch:
+    """Convert rows of select_transactions_for_export to a record batch of TRANSACTION_EXPORT_SCHEMA."""
+    columns = list(zip(*rows, strict=True)) if rows else [()] * len(TRANSACTION_EXPORT_SCHEMA)
+    arrays = []
+    for schema_field, values in zip(TRANSACTION_EXPORT_SCHEMA, columns, strict=True):
+        if schema_field.name in ("category", "unit_type"):
+            indices, dictionary = (
+                (_category_indices, CATEGORY_DICTIONARY)
+                if schema_field.name == "category"
+                else (_unit_type_indices, UNIT_TYPE_DICTIONARY)
+            )
+            arrays.append(
+                pa.DictionaryArray.from_arrays(
+                    pa.array([indices[value] for value in values], type=pa.int8()), dictionary
+                )
+            )
+        else:
+            arrays.append(pa.array(values, type=schema_field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=TRANSACTION_EXPORT_SCHEMA)
+
+
+def iter_transaction_batches(
+    session: Session, since: int, until: int, username: str | None = None, batch_size: int = EXPORT_BATCH_SIZE
+) -> Iterator[list]:
+    """Stream the rows of the exported transactions in chunks from a server-side cursor."""
+    query = select_transactions_for_export(since, until, username=username).execution_options(yield_per=batch_size)
+    yield from session.exec(query).partitions()
+
+
+def get_export_watermark(session: Session) -> int:
+    """
+    Get the ID of the last transaction, the upper bound of an export started now.
+
+    IDs are assigned when transactions are inserted rather than when they commit, so a transaction
+    still being saved may get a lower ID and only become visible after the export.
+    """
+    return session.exec(select(func.max(Transaction.id))).one() or 0
+
+
+async def get_export_watermark_async(db_url: str) -> int:
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        return (await session.exec(select(func.max(Transaction.id)))).one() or 0
+
+
+def get_month_partition(date_time: datetime | None) -> str:
+    """Get the month partition of a transaction from the date of its receipt, e.g. 2025-07."""
+    return f"{date_time:%Y-%m}" if date_time is not None else UNKNOWN_MONTH
+
+
+@dataclass
+class ExportWatermark:
+    """
+    The transactions exported to a directory.
+
+    Every transaction with an ID up to `window_start` was exported. Of those in (window_start,
+    transaction_id], only the `window_ids` were: the others were not committed yet and are exported
+    by the next run.
+    """
+
+    transaction_id: int = 0
+    window_start: int = 0
+    window_ids: set[int] = field(default_factory=set)
+
+
+def read_watermark(output_dir: Path) -> ExportWatermark:
+    """Get the transactions exported to a directory, none if nothing was exported yet."""
+    path = output_dir / WATERMARK_FILE
+    if not path.exists():
+        return ExportWatermark()
+    data = json.loads(path.read_text())
+    # Watermarks written before the overlap window have no window
+    return ExportWatermark(
+        transaction_id=data["transaction_id"],
+        window_start=data.get("window_start", data["transaction_id"]),
+        window_ids=set(data.get("window_ids", [])),
+    )
+
+
+def write_watermark(output_dir: Path, watermark: ExportWatermark):
+    path = output_dir / WATERMARK_FILE
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(
+        json.dumps(
+            {
+                "transaction_id": watermark.transaction_id,
+                "window_start": watermark.window_start,
+                "window_ids": sorted(watermark.window_ids),
+                "exported_at": datetime.now(UTC).isoformat(),
+            }
+        )
+        + "\n"
+    )
+    os.replace(tmp_path, path)
+
+
+class PartitionWriter:
+    """Writer of the record batches of one month partition to a temporary file, moved in place on commit."""
+
+    def __init__(self, path: Path, export_format: ExportFormat):
+        self.path = path
+        self.tmp_path = path.with_name(f".{path.name}.tmp")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if export_format == ExportFormat.PARQUET:
+            self.writer = pq.ParquetWriter(self.tmp_path, TRANSACTION_EXPORT_SCHEMA, compression="zstd")
+        else:
+            self.writer = pa.ipc.new_file(
+                str(self.tmp_path), TRANSACTION_EXPORT_SCHEMA, options=pa.ipc.IpcWriteOptions(compression="zstd")
+            )
+        self.rows = 0
+
+    def write(self, batch: pa.RecordBatch):
+        self.writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def commit(self):
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.writer.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+
+@dataclass
+class ExportResult:
+    since: int
+    until: int
+    rows: int = 0
+    files: list[Path] = field(default_factory=list)
+
+
+def export_transactions(
+    output_dir: Path,
+    export_format: ExportFormat = ExportFormat.PARQUET,
+    since: int | None = None,
+    username: str | None = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    overlap: int = EXPORT_OVERLAP_TRANSACTIONS,
+    db_url: str | None = None,
+) -> ExportResult:
+    """
+    Export the transactions saved since the last export to files partitioned by month.
+
+    Rows are streamed from a server-side cursor in chunks of `batch_size` and each chunk is written
+    as soon as it is fetched, so memory stays flat regardless of the table size. Files are laid out
+    as `month=YYYY-MM/part-<first ID>.<format>`, readable as one Hive-partitioned dataset. The last
+    exported transaction ID is stored in the directory once every file is written, so an interrupted
+    export leaves no partial files and is simply run again.
+
+    Transactions can commit out of ID order, so each run re-reads the last `overlap` IDs below the
+    watermark and exports those the previous runs did not, whose IDs are kept with the watermark.
+    Transactions committed more than `overlap` IDs late are missed.
+
+    Args:
+        output_dir (Path): The export directory.
+        export_format (ExportFormat): Whether to write Parquet or Arrow IPC files.
+        since (int | None): Export transactions with a greater ID, defaults to those not exported to the directory.
+        username (str | None): Only export the transactions of this user.
+        batch_size (int): The rows fetched and written per chunk.
+        overlap (int): The IDs below the watermark checked for transactions committed out of order.
+        db_url (str | None): The database URL, defaults to the configured database.
+
+    Returns:
+        ExportResult: The exported ID range, row count and files written.
+    """
+    watermark = (
+        read_watermark(output_dir) if since is None else ExportWatermark(transaction_id=since, window_start=since)
+    )
+
+    with Session(get_engine(db_url)) as session:
+        until = max(watermark.transaction_id, get_export_watermark(session))
+        result = ExportResult(since=watermark.window_start, until=until)
+        window_ids = set(watermark.window_ids)
+        writers: dict[str, PartitionWriter] = {}
+        try:
+            for rows in iter_transaction_batches(
+                session, watermark.window_start, until, username=username, batch_size=batch_size
+            ):
+                rows_by_month: dict[str, list] = {}
+                for row in rows:
+                    if row[0] not in watermark.window_ids:
+                        rows_by_month.setdefault(get_month_partition(row[2]), []).append(row)
+                        if row[0] > until - overlap:
+                            window_ids.add(row[0])
+                for month, month_rows in rows_by_month.items():
+                    if month not in writers:
+                        # Named after the first row, which no other run exports
+                        path = output_dir / f"month={month}" / f"part-{month_rows[0][0]:012d}.{export_format.value}"
+                        writers[month] = PartitionWriter(path, export_format)
+                    writers[month].write(to_record_batch(month_rows))
+        except BaseException:
+            for writer in writers.values():
+                writer.abort()
+            raise
+
+    for writer in writers.values():
+        writer.commit()
+        result.rows += writer.rows
+        result.files.append(writer.path)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    window_start = max(watermark.window_start, until - overlap)
+    write_watermark(
+        output_dir,
+        ExportWatermark(
+            transaction_id=until,
+            window_start=window_start,
+            window_ids={transaction_id for transaction_id in window_ids if transaction_id > window_start},
+        ),
+    )
+    return result
+
+
+class StreamBuffer:
+    """Write-only file object whose written bytes are taken out after each record batch."""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def stream_transactions_arrow(
+    since: int, until: int, username: str | None = None, batch_size: int = EXPORT_BATCH_SIZE, db_url: str | None = None
+) -> Iterator[bytes]:
+    """Stream the transactions with IDs in (since, until] as an Arrow IPC stream, one record batch per chunk."""
+    buffer = StreamBuffer()
+    with Session(get_engine(db_url)) as session:
+        writer = pa.ipc.new_stream(buffer, TRANSACTION_EXPORT_SCHEMA)
+        yield buffer.take()
+        for rows in iter_transaction_batches(session, since, until, username=username, batch_size=batch_size):
+            writer.write_batch(to_record_batch(rows))
+            yield buffer.take()
+        writer.close()
+    yield buffer.take()
@@ -0,0 +1,219 @@
+import uuid
+from datetime import UTC, datetime, timedelta
+
+from sqlalchemy import and_, or_, update
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from orm.data_models import GroceryReceiptSchema, ReceiptJob, ReceiptJobStatus
+from orm.engine import get_async_engine, get_dialect_insert
+
+
+def utcnow() -> datetime:
+    """Get the current UTC time as a naive datetime, as stored in the job table."""
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+def enqueue_receipt_job(
+    session: Session, username: str, img_content: bytes, img_type: str, image_hash: str, max_attempts: int
+) -> ReceiptJob:
+    """Enqueue a receipt parse, returning the existing job if the user already enqueued the image.
+
+    A job of the same user and image that has failed is queued again with its attempts reset.
+
+    Args:
+        session (Session): The database session.
+        username (str): The username of the user who uploaded the receipt.
+        img_content (bytes): The image content of the grocery receipt.
+        img_type (str): The type of the image, e.g. jpeg.
+        image_hash (str): The hash of the image content.
+        max_attempts (int): Attempts before the job is marked as failed.
+
+    Returns:
+        ReceiptJob: The queued, running or finished job of the user's image.
+    """
+    now = utcnow()
+    insert = get_dialect_insert(session)
+    jobs = ReceiptJob.__table__
+    session.exec(
+        insert(jobs)
+        .values(
+            id=uuid.uuid4(),
+            image_hash=image_hash,
+            username=username,
+            image_type=img_type,
+            image=img_content,
+            status=ReceiptJobStatus.QUEUED,
+            attempts=0,
+            max_attempts=max_attempts,
+            available_at=now,
+            created_at=now,
+            updated_at=now,
+        )
+        .on_conflict_do_nothing(index_elements=[jobs.c.username, jobs.c.image_hash])
+    )
+
+    job = session.exec(
+        select(ReceiptJob).where(ReceiptJob.username == username, ReceiptJob.image_hash == image_hash)
+    ).one()
+    if job.status == ReceiptJobStatus.FAILED:
+        job.status = ReceiptJobStatus.QUEUED
+        job.attempts = 0
+        job.max_attempts = max_attempts
+        job.available_at = now
+        job.updated_at = now
+        job.image = img_content
+        session.add(job)
+        session.flush()
+    return job
+
+
+def claim_receipt_job(session: Session, lease_seconds: float) -> ReceiptJob | None:
+    """Claim the next available job for this worker.
+
+    Queued jobs become available once their retry backoff has passed, and running jobs once the lease
+    of the worker holding them has expired. Postgres skips rows locked by other workers; on SQLite the
+    conditional update ensures only one worker wins a job.
+
+    Args:
+        session (Session): The database session.
+        lease_seconds (float): Seconds the claimed job is held before other workers may reclaim it.
+
+    Returns:
+        ReceiptJob | None: The claimed job, or None if no job is available.
+    """
+    now = utcnow()
+    is_available = or_(
+        and_(ReceiptJob.status == ReceiptJobStatus.QUEUED, ReceiptJob.available_at <= now),
+        and_(ReceiptJob.status == ReceiptJobStatus.RUNNING, ReceiptJob.locked_until < now),
+    )
+    job_id = session.exec(
+        select(ReceiptJob.id)
+        .where(is_available)
+        .order_by(ReceiptJob.available_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).first()
+    if job_id is None:
+        return None
+
+    claimed = session.exec(
+        update(ReceiptJob)
+        .where(ReceiptJob.id == job_id, is_available)
+        .values(
+            status=ReceiptJobStatus.RUNNING,
+            attempts=ReceiptJob.attempts + 1,
+            locked_until=now + timedelta(seconds=lease_seconds),
+            updated_at=now,
+        )
+    )
+    if claimed.rowcount == 0:
+        return None
+    return session.get(ReceiptJob, job_id, populate_existing=True)
+
+
+def _update_claimed_job(session: Session, job: ReceiptJob, **values) -> bool:
+    """Update a job only if it is still held by this attempt, i.e. it has not been reclaimed since."""
+    updated = session.exec(
+        update(ReceiptJob)
+        .where(
+            ReceiptJob.id == job.id,
+            ReceiptJob.status == ReceiptJobStatus.RUNNING,
+            ReceiptJob.attempts == job.attempts,
+        )
+        .values(updated_at=utcnow(), **values)
+    )
+    return updated.rowcount > 0
+
+
+def complete_receipt_job(session: Session, job: ReceiptJob, result: GroceryReceiptSchema) -> bool:
+    """Mark a claimed job as succeeded with its parsed receipt, dropping the stored image.
+
+    Returns:
+        bool: False if the job was reclaimed by another worker in the meantime.
+    """
+    return _update_claimed_job(
+        session,
+        job,
+        status=ReceiptJobStatus.SUCCEEDED,
+        result=result.model_dump(mode="json"),
+        image=None,
+        error=None,
+        locked_until=None,
+    )
+
+
+def fail_receipt_job(session: Session, job: ReceiptJob, error: str, retry_base_seconds: float) -> ReceiptJobStatus:
+    """Requeue a claimed job with exponential backoff, or mark it as failed once out of attempts.
+
+    Returns:
+        ReceiptJobStatus: The new status of the job.
+    """
+    if job.attempts >= job.max_attempts:
+        status, available_at = ReceiptJobStatus.FAILED, job.available_at
+    else:
+        status = ReceiptJobStatus.QUEUED
+        available_at = utcnow() + timedelta(seconds=retry_base_seconds * 2 ** (job.attempts - 1))
+
+    _update_claimed_job(session, job, status=status, available_at=available_at, error=error, locked_until=None)
+    return status
+
+
+async def enqueue_receipt_job_async(
+    username: str, img_content: bytes, img_type: str, image_hash: str, max_attempts: int, db_url: str
+) -> ReceiptJob:
+    """Async variant of enqueue_receipt_job committing in its own session."""
+    async with AsyncSession(get_async_engine(db_url), expire_on_commit=False) as session:
+        job = await session.run_sync(
+            lambda sync_session: enqueue_receipt_job(
+                session=sync_session,
+                username=username,
+                img_content=img_content,
+                img_type=img_type,
+                image_hash=image_hash,
+                max_attempts=max_attempts,
+            )
+        )
+        await session.commit()
+        return job
+
+
+async def get_receipt_job_async(job_id: uuid.UUID, username: str, db_url: str) -> ReceiptJob | None:
+    """Get a job by its ID, or None if it does not exist or was enqueued by another user."""
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        job = await session.exec(select(ReceiptJob).where(ReceiptJob.id == job_id, ReceiptJob.username == username))
+        return job.first()
+
+
+async def claim_receipt_job_async(lease_seconds: float, db_url: str) -> ReceiptJob | None:
+    """Async variant of claim_receipt_job committing the claim in its own session."""
+    async with AsyncSession(get_async_engine(db_url), expire_on_commit=False) as session:
+        job = await session.run_sync(
+            lambda sync_session: claim_receipt_job(session=sync_session, lease_seconds=lease_seconds)
+        )
+        await session.commit()
+        return job
+
+
+async def complete_receipt_job_async(job: ReceiptJob, result: GroceryReceiptSchema, db_url: str) -> bool:
+    """Async variant of complete_receipt_job committing in its own session."""
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        completed = await session.run_sync(
+            lambda sync_session: complete_receipt_job(session=sync_session, job=job, result=result)
+        )
+        await session.commit()
+        return completed
+
+
+async def fail_receipt_job_async(
+    job: ReceiptJob, error: str, retry_base_seconds: float, db_url: str
+) -> ReceiptJobStatus:
+    """Async variant of fail_receipt_job committing in its own session."""
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        status = await session.run_sync(
+            lambda sync_session: fail_receipt_job(
+                session=sync_session, job=job, error=error, retry_base_seconds=retry_base_seconds
+            )
+        )
+        await session.commit()
+        return status
@@ -0,0 +1,292 @@
+import logging
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import Connection, inspect, text
+from sqlmodel import Field, SQLModel, select
+
+# Importing the models registers the tables created by the first migration
+from orm.data_models import ReceiptJob
+from orm.engine import get_async_engine
+from orm.jobs import utcnow
+
+logger = logging.getLogger(__name__)
+
+# Key of the Postgres advisory lock held while migrating, so concurrent runs apply each migration once
+MIGRATION_LOCK_KEY = 0x666F6F64
+
+
+class SchemaMigration(SQLModel, table=True):
+    """An applied schema migration."""
+
+    __tablename__ = "schema_migrations"
+
+    version: int = Field(primary_key=True, description="Version of the migration")
+    description: str = Field(description="What the migration changes")
+    applied_at: datetime = Field(description="UTC time the migration was applied")
+    duration_seconds: float = Field(description="Seconds the migration took")
+
+
+class MigrationError(RuntimeError):
+    """Raised when a migration cannot be applied to the data in the database."""
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    A versioned schema change, applied once and recorded in the schema_migrations table.
+
+    Transactional migrations run in one transaction. Others run in autocommit mode, so Postgres can
+    build their indexes with CREATE INDEX CONCURRENTLY without blocking writes; they must be idempotent
+    since a failure leaves them partly applied.
+    """
+
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+    transactional: bool = True
+
+
+def create_index(
+    connection: Connection, name: str, table: str, columns: list[str], unique: bool = False, concurrently: bool = True
+):
+    """Create an index if it does not exist, without blocking writes to the table on Postgres.
+
+    A concurrent build that failed leaves an invalid index behind, which is dropped and built again.
+
+    Args:
+        connection (Connection): A connection in autocommit mode if building concurrently.
+        name (str): The name of the index.
+        table (str): The name of the table.
+        columns (list[str]): The indexed columns, in order.
+        unique (bool): Whether the index enforces unique values.
+        concurrently (bool): Whether to use CREATE INDEX CONCURRENTLY on Postgres.
+    """
+    concurrently = concurrently and connection.dialect.name == "postgresql"
+    if concurrently:
+        is_invalid = connection.execute(
+            text(
+                "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+            ),
+            {"name": name},
+        ).first()
+        if is_invalid:
+            logger.warning("Dropping invalid index %s left by an interrupted build.", name)
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    logger.info("Creating index %s on %s (%s).", name, table, ", ".join(columns))
+    connection.execute(
+        text(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {'CONCURRENTLY ' if concurrently else ''}"
+            f"IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+        )
+    )
+
+
+def create_missing_tables(connection: Connection):
+    """Create the tables of the models that do not exist yet, with their indexes."""
+    SQLModel.metadata.create_all(connection, checkfirst=True)
+
+
+def add_perceptual_hash_column(connection: Connection):
+    """Add the perceptual hash of receipt images, see orm/perceptual.py."""
+    columns = {column["name"] for column in inspect(connection).get_columns("grocery_receipts")}
+    if "perceptual_hash" not in columns:
+        connection.execute(text("ALTER TABLE grocery_receipts ADD COLUMN perceptual_hash VARCHAR(16)"))
+
+
+def index_hot_path_lookups(connection: Connection):
+    """Index the columns looked up when saving receipts and reading the receipt history."""
+    create_index(connection, "ix_stores_name", "stores", ["name"])
+    create_index(connection, "ix_transactions_receipt_id", "transactions", ["receipt_id"])
+    create_index(connection, "ix_transactions_item_id", "transactions", ["item_id"])
+    create_index(connection, "ix_grocery_receipts_user_date", "grocery_receipts", ["user_id", "date_time", "id"])
+    create_index(connection, "ix_items_name", "items", ["name"])
+
+
+def make_usernames_unique(connection: Connection):
+    """Enforce one user per username, failing with the duplicates to merge if there are any."""
+    duplicates = (
+        connection.execute(
+            text("SELECT username FROM users GROUP BY username HAVING COUNT(*) > 1 ORDER BY username LIMIT 10")
+        )
+        .scalars()
+        .all()
+    )
+    if duplicates:
+        raise MigrationError(
+            f"Usernames of several users must be merged before they can be made unique: {', '.join(duplicates)}."
+        )
+    create_index(connection, "ix_users_username", "users", ["username"], unique=True)
+
+
+def make_item_names_unique_per_store(connection: Connection):
+    """Enforce one item per store and name, the conflict target of the item upsert in orm/utils.py."""
+    duplicates = connection.execute(
+        text(
+            "SELECT store_id, name FROM items GROUP BY store_id, name HAVING COUNT(*) > 1 "
+            "ORDER BY store_id, name LIMIT 10"
+        )
+    ).all()
+    if duplicates:
+        raise MigrationError(
+            "Items of a store sharing a name must be merged before they can be made unique: "
+            f"{', '.join(f'{name} (store {store_id})' for store_id, name in duplicates)}."
+        )
+    create_index(connection, "uix_item_store", "items", ["store_id", "name"], unique=True)
+
+
+def make_store_names_unique(connection: Connection):
+    """Enforce one store per name, replacing the non-unique index on the names."""
+    duplicates = (
+        connection.execute(text("SELECT name FROM stores GROUP BY name HAVING COUNT(*) > 1 ORDER BY name LIMIT 10"))
+        .scalars()
+        .all()
+    )
+    if duplicates:
+        raise MigrationError(
+            f"Stores sharing a name must be merged before their names can be made unique: {', '.join(duplicates)}."
+        )
+    create_index(connection, "uix_stores_name", "stores", ["name"], unique=True)
+    logger.info("Dropping index ix_stores_name.")
+    concurrently = "CONCURRENTLY " if connection.dialect.name == "postgresql" else ""
+    connection.execute(text(f"DROP INDEX {concurrently}IF EXISTS ix_stores_name"))
+
+
+def scope_receipt_jobs_to_users(connection: Connection):
+    """Make receipt jobs unique per user and image instead of per image, see orm/jobs.py."""
+    image_hash_constraints = [
+        constraint
+        for constraint in inspect(connection).get_unique_constraints("receipt_jobs")
+        if constraint["column_names"] == ["image_hash"]
+    ]
+    if image_hash_constraints and connection.dialect.name == "sqlite":
+        # SQLite cannot drop a column's unique constraint, so the table is rebuilt with the model's schema
+        logger.info("Rebuilding table receipt_jobs.")
+        connection.execute(text("ALTER TABLE receipt_jobs RENAME TO receipt_jobs_old"))
+        for index in inspect(connection).get_indexes("receipt_jobs_old"):
+            connection.execute(text(f"DROP INDEX {index['name']}"))
+        ReceiptJob.__table__.create(connection)
+        columns = ", ".join(column.name for column in ReceiptJob.__table__.columns)
+        connection.execute(text(f"INSERT INTO receipt_jobs ({columns}) SELECT {columns} FROM receipt_jobs_old"))
+        connection.execute(text("DROP TABLE receipt_jobs_old"))
+        return
+
+    for constraint in image_hash_constraints:
+        logger.info("Dropping constraint %s.", constraint["name"])
+        connection.execute(text(f"ALTER TABLE receipt_jobs DROP CONSTRAINT {constraint['name']}"))
+    create_index(
+        connection,
+        "uix_receipt_job_user_image",
+        "receipt_jobs",
+        ["username", "image_hash"],
+        unique=True,
+        concurrently=False,
+    )
+
+
+# Append new migrations with the next version, and declare the same schema on the models in
+# orm/data_models.py so that databases bootstrapped by the first migration match
+def add_user_data_versions(connection: Connection):
+    """Add the version of each user's data, checked by the response cache, see response_cache.py."""
+    columns = {column["name"] for column in inspect(connection).get_columns("users")}
+    if "data_version" not in columns:
+        connection.execute(text("ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0"))
+
+
+MIGRATIONS = [
+    Migration(1, "Create missing tables", create_missing_tables),
+    Migration(2, "Add grocery_receipts.perceptual_hash", add_perceptual_hash_column),
+    Migration(3, "Index hot-path lookups", index_hot_path_lookups, transactional=False),
+    Migration(4, "Make usernames unique", make_usernames_unique, transactional=False),
+    Migration(5, "Make item names unique per store", make_item_names_unique_per_store, transactional=False),
+    Migration(6, "Make store names unique", make_store_names_unique, transactional=False),
+    Migration(7, "Scope receipt jobs to their user", scope_receipt_jobs_to_users),
+    Migration(8, "Add users.data_version", add_user_data_versions),
+]
+
+
+def get_applied_versions(connection: Connection) -> set[int]:
+    with connection.begin():
+        SchemaMigration.__table__.create(connection, checkfirst=True)
+        return set(connection.execute(select(SchemaMigration.version)).scalars())
+
+
+def apply_migration(connection: Connection, migration: Migration):
+    """Apply a migration and record it, in one transaction if the migration is transactional."""
+    start = time.perf_counter()
+    if migration.transactional:
+        connection.begin()
+    else:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        migration.upgrade(connection)
+        if not migration.transactional:
+            connection.commit()
+            connection.execution_options(isolation_level=connection.default_isolation_level)
+            connection.begin()
+        connection.execute(
+            SchemaMigration.__table__.insert().values(
+                version=migration.version,
+                description=migration.description,
+                applied_at=utcnow(),
+                duration_seconds=time.perf_counter() - start,
+            )
+        )
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        connection.execution_options(isolation_level=connection.default_isolation_level)
+        raise
+
+
+def run_migrations(connection: Connection) -> list[Migration]:
+    """Apply the migrations not applied to the database yet, in order.
+
+    Args:
+        connection (Connection): A connection outside of a transaction.
+
+    Returns:
+        list[Migration]: The migrations applied.
+    """
+    is_postgres = connection.dialect.name == "postgresql"
+    if is_postgres:
+        with connection.begin():
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+    try:
+        applied_versions = get_applied_versions(connection)
+        pending = [migration for migration in MIGRATIONS if migration.version not in applied_versions]
+        for migration in pending:
+            logger.info("Applying migration %d: %s.", migration.version, migration.description)
+            apply_migration(connection, migration)
+        return pending
+    finally:
+        if is_postgres:
+            with connection.begin():
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+async def run_migrations_async(db_url: str | None = None) -> list[Migration]:
+    """Apply the pending migrations over the async engine of the database, see run_migrations."""
+    async with get_async_engine(db_url).connect() as connection:
+        return await connection.run_sync(run_migrations)
+
+
+async def get_migration_status_async(db_url: str | None = None) -> tuple[list[SchemaMigration], list[Migration]]:
+    """Get the applied migrations and the pending ones."""
+
+    def get_status(connection: Connection) -> tuple[list[SchemaMigration], list[Migration]]:
+        if not inspect(connection).has_table(SchemaMigration.__tablename__):
+            return [], list(MIGRATIONS)
+        applied = [
+            SchemaMigration.model_validate(row)
+            for row in connection.execute(select(SchemaMigration).order_by(SchemaMigration.version)).mappings()
+        ]
+        applied_versions = {migration.version for migration in applied}
+        return applied, [migration for migration in MIGRATIONS if migration.version not in applied_versions]
+
+    async with get_async_engine(db_url).connect() as connection:
+        return await connection.run_sync(get_status)
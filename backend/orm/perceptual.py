@@ -0,0 +1,253 @@
+import asyncio
+import itertools
+import logging
+import sys
+import threading
+from collections.abc import Iterable, Iterator
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from agent.analysis import analyze_receipt_image_async
+from agent.image import compute_receipt_dhash
+from config import settings
+from metrics import track_stage
+from orm.data_models import GroceryReceipt, User
+from orm.dedup import REFRESH_OVERLAP_RECEIPTS
+from orm.engine import get_async_engine, get_engine
+
+logger = logging.getLogger(__name__)
+
+# Bits of the perceptual hashes and of the chunks indexed by MultiIndexHashTable
+HASH_BITS = 64
+CHUNK_BITS = 16
+
+
+def format_perceptual_hash(perceptual_hash: int) -> str:
+    """Format a perceptual hash as the hex string stored in the database."""
+    return f"{perceptual_hash:0{HASH_BITS // 4}x}"
+
+
+def parse_perceptual_hash(perceptual_hash: str) -> int:
+    return int(perceptual_hash, 16)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def get_neighbors(value: int, bits: int, radius: int) -> Iterator[int]:
+    """Generate the values of `bits` bits within Hamming distance `radius` of a value, the value first."""
+    for distance in range(radius + 1):
+        for positions in itertools.combinations(range(bits), distance):
+            neighbor = value
+            for position in positions:
+                neighbor ^= 1 << position
+            yield neighbor
+
+
+def compute_perceptual_hash(img_content: bytes) -> str | None:
+    """Compute the perceptual hash stored with a receipt, or None if disabled or the image cannot be decoded."""
+    if not settings.perceptual_dedup_enabled:
+        return None
+    with track_stage("perceptual_hash"):
+        perceptual_hash = compute_receipt_dhash(img_content)
+    return format_perceptual_hash(perceptual_hash) if perceptual_hash is not None else None
+
+
+async def compute_perceptual_hash_async(img_content: bytes | memoryview | str) -> str | None:
+    """Async variant of compute_perceptual_hash running in the image process pool, also given a file path."""
+    if not settings.perceptual_dedup_enabled:
+        return None
+    with track_stage("perceptual_hash"):
+        analysis = await analyze_receipt_image_async(img_content, classify=False, dhash=True, preprocess=False)
+    return format_perceptual_hash(analysis.dhash) if analysis.dhash is not None else None
+
+
+class MultiIndexHashTable:
+    """
+    Index of hashes answering Hamming-distance range queries with multi-index hashing.
+
+    Hashes are split into chunks, each indexed in its own table. Two hashes within distance d differ
+    by at most d // chunks bits in one of their chunks, so a query only probes the chunk values within
+    that radius and checks the full distance of the hashes found. Unlike a BK-tree, whose searches visit
+    most of the tree once the radius nears the typical distance between hashes, the work per query
+    grows with the hashes sharing a nearby chunk rather than with the whole index.
+    """
+
+    def __init__(self, bits: int = HASH_BITS, chunk_bits: int = CHUNK_BITS):
+        if bits % chunk_bits:
+            raise ValueError("The hash bits must be a multiple of the chunk bits.")
+
+        self.chunk_bits = chunk_bits
+        self.num_chunks = bits // chunk_bits
+        self._chunk_mask = (1 << chunk_bits) - 1
+        self._tables: list[dict[int, set[int]]] = [{} for _ in range(self.num_chunks)]
+        self._values: dict[int, set[int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def _chunks(self, value: int) -> list[int]:
+        return [value >> (index * self.chunk_bits) & self._chunk_mask for index in range(self.num_chunks)]
+
+    def add(self, value: int, key: int):
+        """Add a hash with the key it identifies, e.g. a receipt ID."""
+        with self._lock:
+            keys = self._values.get(value)
+            if keys is None:
+                keys = self._values[value] = set()
+                for table, chunk in zip(self._tables, self._chunks(value), strict=True):
+                    table.setdefault(chunk, set()).add(value)
+            keys.add(key)
+
+    def search(self, value: int, max_distance: int) -> list[tuple[int, int]]:
+        """Find the keys of the hashes within `max_distance` of a hash.
+
+        Returns:
+            list[tuple[int, int]]: The distance and key of each match, closest first.
+        """
+        radius = max_distance // self.num_chunks
+        matches = []
+        with self._lock:
+            candidates = set()
+            for table, chunk in zip(self._tables, self._chunks(value), strict=True):
+                for neighbor in get_neighbors(chunk, self.chunk_bits, radius):
+                    candidates.update(table.get(neighbor, ()))
+
+            for candidate in candidates:
+                distance = hamming_distance(value, candidate)
+                if distance <= max_distance:
+                    matches.extend((distance, key) for key in self._values[candidate])
+        return sorted(matches)
+
+
+class PerceptualHashIndex:
+    """
+    In-process index of the perceptual hashes of saved receipts with the usernames they belong to.
+
+    The index is loaded once from the database, records the receipts saved by its own process and is
+    refreshed in the background with those saved by other processes, e.g. the receipt worker. Each
+    refresh re-reads the last REFRESH_OVERLAP_RECEIPTS receipts below the highest ID seen so receipts
+    committed out of ID order are not missed. Lookups themselves never query the database.
+    """
+
+    def __init__(self):
+        self.table = MultiIndexHashTable()
+        self.receipt_users: dict[int, str] = {}
+        self.last_receipt_id = 0
+
+    def add_many(self, receipts: Iterable[tuple[int, str, str]]):
+        """Add receipts given as their ID, hex perceptual hash and username."""
+        for receipt_id, perceptual_hash, username in receipts:
+            self.table.add(parse_perceptual_hash(perceptual_hash), receipt_id)
+            # Usernames repeat across a user's receipts, so a single copy of each is kept
+            self.receipt_users[receipt_id] = sys.intern(username)
+            self.last_receipt_id = max(self.last_receipt_id, receipt_id)
+
+    def select_new_receipts(self, overlap: int = 0):
+        """Select the receipts above the highest indexed ID, less `overlap` IDs."""
+        return (
+            select(GroceryReceipt.id, GroceryReceipt.perceptual_hash, User.username)
+            .join(User, User.id == GroceryReceipt.user_id)
+            .where(
+                GroceryReceipt.id > max(0, self.last_receipt_id - overlap), GroceryReceipt.perceptual_hash.is_not(None)
+            )
+            .order_by(GroceryReceipt.id)
+        )
+
+    def load(self, db_url: str | None = None, batch_size: int = 10000):
+        """Add the perceptual hashes of all receipts in the database with a streamed scan."""
+        with Session(get_engine(db_url)) as session:
+            receipts = session.exec(self.select_new_receipts().execution_options(yield_per=batch_size))
+            for partition in receipts.partitions():
+                self.add_many(partition)
+
+    async def refresh_async(self, session: AsyncSession):
+        """Add the receipts saved since the index was last refreshed, including late commits below it."""
+        self.add_many((await session.exec(self.select_new_receipts(overlap=REFRESH_OVERLAP_RECEIPTS))).all())
+
+    def search(self, perceptual_hash: int, max_distance: int, username: str) -> list[tuple[int, int]]:
+        """Find the receipts of a user within `max_distance` of a perceptual hash, as (distance, ID), closest first."""
+        return [
+            (distance, receipt_id)
+            for distance, receipt_id in self.table.search(perceptual_hash, max_distance)
+            if self.receipt_users.get(receipt_id) == username
+        ]
+
+
+# Global perceptual hash index instance
+perceptual_index: PerceptualHashIndex | None = None
+_perceptual_index_lock = threading.Lock()
+
+
+def get_perceptual_index() -> PerceptualHashIndex | None:
+    """Get the perceptual hash index, or None if near-duplicate detection is disabled."""
+    global perceptual_index
+    if perceptual_index is None and settings.perceptual_dedup_enabled:
+        with _perceptual_index_lock:
+            if perceptual_index is None:
+                perceptual_index = PerceptualHashIndex()
+    return perceptual_index
+
+
+def load_perceptual_index(db_url: str | None = None):
+    """Load the perceptual hash index from the database, leaving it to the background refresh if unavailable."""
+    index = get_perceptual_index()
+    if index is None:
+        return
+
+    try:
+        index.load(db_url=db_url)
+    except SQLAlchemyError:
+        logger.warning("Could not load the perceptual hash index.", exc_info=True)
+
+
+async def refresh_perceptual_index_periodically(db_url: str | None = None, interval_seconds: float | None = None):
+    """Refresh the perceptual hash index from the database until cancelled, e.g. as a task of the API lifespan."""
+    index = get_perceptual_index()
+    if index is None:
+        return
+    if interval_seconds is None:
+        interval_seconds = settings.dedup_refresh_interval_seconds
+
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            async with AsyncSession(get_async_engine(db_url)) as session:
+                await index.refresh_async(session)
+        except SQLAlchemyError:
+            logger.warning("Could not refresh the perceptual hash index.", exc_info=True)
+
+
+def record_perceptual_hash(receipt_id: int, perceptual_hash: str | None, username: str):
+    """Record the perceptual hash of a committed receipt in the perceptual hash index."""
+    index = get_perceptual_index()
+    if index is not None and perceptual_hash is not None:
+        index.add_many([(receipt_id, perceptual_hash, username)])
+
+
+def find_near_duplicate_receipt(perceptual_hash: str, username: str, max_distance: int | None = None) -> int | None:
+    """Find a saved receipt of a user whose image is a near-duplicate of an image, e.g. another photo of it.
+
+    Only the user's own receipts are considered, so similar-looking receipts of other users are never
+    reported as duplicates. Receipts saved by other processes are found once the index is refreshed.
+
+    Args:
+        perceptual_hash (str): The perceptual hash of the image, as computed by compute_perceptual_hash.
+        username (str): The username of the user.
+        max_distance (int | None): The largest Hamming distance of a near-duplicate, defaults to the configured one.
+
+    Returns:
+        int | None: The ID of the closest near-duplicate receipt, or None if there is none.
+    """
+    index = get_perceptual_index()
+    if index is None:
+        return None
+    if max_distance is None:
+        max_distance = settings.perceptual_dedup_max_distance
+
+    matches = index.search(parse_perceptual_hash(perceptual_hash), max_distance, username=username)
+    return matches[0][1] if matches else None
@@ -0,0 +1,172 @@
+import math
+from collections.abc import Iterable
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import case, delete, func, insert, literal
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from orm.data_models import (
+    GroceryReceipt,
+    Item,
+    ItemPrice,
+    PricePoint,
+    Purchase,
+    Store,
+    StorePriceSummary,
+    Transaction,
+    UnitType,
+)
+from orm.engine import get_async_engine
+
+OUNCES_PER_POUND = 16
+
+
+def normalize_unit_price(unit_price: float, unit_type: UnitType) -> tuple[float, UnitType]:
+    """Convert a unit price to a price per pound for weighed items; prices per each are kept as is."""
+    if unit_type == UnitType.OZ:
+        return unit_price * OUNCES_PER_POUND, UnitType.LB
+    return unit_price, unit_type
+
+
+def record_item_prices(
+    session: Session, receipt_id: int, date_time: datetime | None, purchases: Iterable[tuple[int, Purchase]]
+):
+    """Add the normalized prices of a receipt's purchases to the price history in a single statement.
+
+    Receipts without a purchase date cannot be placed in time and are left out of the history.
+
+    Args:
+        session (Session): The database session saving the receipt.
+        receipt_id (int): The ID of the grocery receipt.
+        date_time (datetime | None): The date and time of the purchase.
+        purchases (Iterable[tuple[int, Purchase]]): The purchases with the ID of their item.
+    """
+    if date_time is None:
+        return
+
+    rows = []
+    for item_id, purchase in purchases:
+        unit_price, unit_type = normalize_unit_price(purchase.unit_price, purchase.unit_type)
+        rows.append(
+            {
+                "item_id": item_id,
+                "receipt_id": receipt_id,
+                "purchased_on": date_time.date(),
+                "unit_price": unit_price,
+                "unit_type": unit_type,
+            }
+        )
+    if rows:
+        session.exec(insert(ItemPrice.__table__).values(rows))
+
+
+def rebuild_item_prices(session: Session) -> int:
+    """Recompute the price history from the stored transactions with a single INSERT ... SELECT.
+
+    Args:
+        session (Session): The database session.
+
+    Returns:
+        int: The number of prices written.
+    """
+    session.exec(delete(ItemPrice))
+    is_ounces = Transaction.unit_type == UnitType.OZ
+    prices = (
+        select(
+            Transaction.item_id,
+            Transaction.receipt_id,
+            func.date(GroceryReceipt.date_time),
+            case((is_ounces, Transaction.unit_price * OUNCES_PER_POUND), else_=Transaction.unit_price),
+            case((is_ounces, literal(UnitType.LB, Transaction.unit_type.type)), else_=Transaction.unit_type),
+        )
+        .join(GroceryReceipt, GroceryReceipt.id == Transaction.receipt_id)
+        .where(GroceryReceipt.date_time.is_not(None))
+    )
+    columns = ["item_id", "receipt_id", "purchased_on", "unit_price", "unit_type"]
+    result = session.exec(insert(ItemPrice.__table__).from_select(columns, prices))
+    return result.rowcount
+
+
+def get_bucket_days(start: date, end: date, max_points: int) -> int:
+    """Get the width in days of the buckets downsampling a date range to at most `max_points` buckets."""
+    return max(1, math.ceil((end - start).days / max_points))
+
+
+async def get_item_price_history_async(
+    item_id: int, start: date, end: date, max_points: int, db_url: str
+) -> list[PricePoint]:
+    """Get the price history of an item, downsampled to equal-width buckets of days.
+
+    Only the indexed columns are read, in index order, so the query is an index range scan whose cost
+    depends on the purchases of this item alone.
+
+    Args:
+        item_id (int): The ID of the item.
+        start (date): The first day of the range.
+        end (date): The day after the last day of the range.
+        max_points (int): The maximum number of buckets per unit type.
+        db_url (str): The database URL.
+
+    Returns:
+        list[PricePoint]: The price buckets ordered by date.
+    """
+    bucket_days = get_bucket_days(start, end, max_points)
+    query = (
+        select(ItemPrice.purchased_on, ItemPrice.unit_type, ItemPrice.unit_price)
+        .where(ItemPrice.item_id == item_id, ItemPrice.purchased_on >= start, ItemPrice.purchased_on < end)
+        .order_by(ItemPrice.purchased_on)
+    )
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        rows = await session.exec(query)
+
+        buckets: dict[tuple[date, UnitType], list[float]] = {}
+        for purchased_on, unit_type, unit_price in rows:
+            period_start = start + timedelta(days=(purchased_on - start).days // bucket_days * bucket_days)
+            buckets.setdefault((period_start, unit_type), []).append(unit_price)
+
+    return [
+        PricePoint(
+            period_start=period_start,
+            unit_type=unit_type,
+            min_price=min(prices),
+            avg_price=sum(prices) / len(prices),
+            max_price=max(prices),
+            count=len(prices),
+        )
+        for (period_start, unit_type), prices in buckets.items()
+    ]
+
+
+async def compare_item_prices_async(name: str, start: date, end: date, db_url: str) -> list[StorePriceSummary]:
+    """Compare the prices of an item across the stores selling an item of that name.
+
+    Args:
+        name (str): The name of the item.
+        start (date): The first day of the range.
+        end (date): The day after the last day of the range.
+        db_url (str): The database URL.
+
+    Returns:
+        list[StorePriceSummary]: The prices per store and unit, ordered from the cheapest.
+    """
+    query = (
+        select(
+            Store.name.label("store"),
+            ItemPrice.item_id,
+            ItemPrice.unit_type,
+            func.min(ItemPrice.unit_price).label("min_price"),
+            func.avg(ItemPrice.unit_price).label("avg_price"),
+            func.max(ItemPrice.unit_price).label("max_price"),
+            func.count().label("count"),
+            func.max(ItemPrice.purchased_on).label("last_purchased_on"),
+        )
+        .join(Item, Item.id == ItemPrice.item_id)
+        .join(Store, Store.id == Item.store_id)
+        .where(Item.name == name, ItemPrice.purchased_on >= start, ItemPrice.purchased_on < end)
+        .group_by(Store.name, ItemPrice.item_id, ItemPrice.unit_type)
+        .order_by(ItemPrice.unit_type, func.avg(ItemPrice.unit_price))
+    )
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        rows = await session.exec(query)
+        return [StorePriceSummary.model_validate(row._mapping) for row in rows]
@@ -0,0 +1,150 @@
+import json
+import re
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+
+from sqlalchemy import Connection, Dialect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import Executable
+from sqlmodel import select
+
+from orm.data_models import GroceryCategory, GroceryReceipt, Item, ItemAlias, Store, Transaction, User
+from orm.engine import get_async_engine
+from orm.receipts import select_receipt_page
+
+# Full table scans in SQLite query plans, e.g. "SCAN users" or "SCAN TABLE users" before SQLite 3.36
+SQLITE_SCAN_PATTERN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+
+
+@dataclass(frozen=True)
+class PlanCheck:
+    """A hot-path query and the tables it must read through an index rather than a full scan.
+
+    Dialect-specific statements, such as upserts, are built from the dialect of the checked database.
+    """
+
+    name: str
+    statement: Executable | Callable[[Dialect], Executable]
+    tables: tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class PlanRegression:
+    check: str
+    table: str
+    plan: str
+    reason: str = "full scan"
+
+
+def upsert_store_items(dialect: Dialect) -> Executable:
+    """The item upsert of orm/utils.py, which fails to plan if its ON CONFLICT target is not unique."""
+    insert = postgresql.insert if dialect.name == "postgresql" else sqlite.insert
+    items = Item.__table__
+    return (
+        insert(items)
+        .values(store_id=1, name="MILK", category=GroceryCategory.DAIRY)
+        .on_conflict_do_nothing(index_elements=[items.c.store_id, items.c.name])
+        .returning(items.c.name, items.c.id, items.c.category)
+    )
+
+
+HOT_PATH_QUERIES = [
+    PlanCheck("user by username", select(User.id).where(User.username == "food_user"), ("users",)),
+    PlanCheck("store by name", select(Store.id).where(Store.name == "unknown"), ("stores",)),
+    PlanCheck(
+        "items of a store by name",
+        select(Item.id).where(Item.store_id == 1, Item.name.in_(["MILK", "EGGS"])),
+        ("items",),
+    ),
+    PlanCheck("upsert of store items", upsert_store_items, ("items",)),
+    PlanCheck(
+        "alias of a store item",
+        select(ItemAlias.item_id).where(ItemAlias.store_id == 1, ItemAlias.alias == "milk"),
+        ("item_aliases",),
+    ),
+    PlanCheck(
+        "receipt by image hash",
+        select(GroceryReceipt.id).where(GroceryReceipt.image_hash == "0" * 64),
+        ("grocery_receipts",),
+    ),
+    PlanCheck("receipt history page", select_receipt_page("food_user", limit=20), ("users", "grocery_receipts")),
+    PlanCheck(
+        "purchases of receipts",
+        select(Transaction.receipt_id, Item.name)
+        .join(Item, Item.id == Transaction.item_id)
+        .where(Transaction.receipt_id.in_([1, 2, 3])),
+        ("transactions", "items"),
+    ),
+    PlanCheck("transactions of an item", select(Transaction.id).where(Transaction.item_id == 1), ("transactions",)),
+]
+
+
+def iter_postgres_plan_nodes(node: dict) -> Iterator[dict]:
+    yield node
+    for child in node.get("Plans", ()):
+        yield from iter_postgres_plan_nodes(child)
+
+
+def get_full_scans(connection: Connection, statement: Executable) -> tuple[set[str], str]:
+    """Get the tables a query reads with a full scan, and its plan.
+
+    On Postgres sequential scans are disabled for the query, so the planner only picks one when no
+    index can serve it, however small the tables are.
+
+    Returns:
+        tuple[set[str], str]: The fully scanned tables and the plan as text.
+    """
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    if connection.dialect.name == "postgresql":
+        with connection.begin() as transaction:
+            connection.execute(text("SET LOCAL enable_seqscan = off"))
+            plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar_one()
+            transaction.rollback()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        scanned = {
+            node["Relation Name"]
+            for node in iter_postgres_plan_nodes(plan[0]["Plan"])
+            if node["Node Type"] == "Seq Scan"
+        }
+        return scanned, json.dumps(plan, indent=2)
+
+    if connection.dialect.name == "sqlite":
+        with connection.begin():
+            details = [row[-1] for row in connection.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+        scanned = {match.group(1) for detail in details if (match := SQLITE_SCAN_PATTERN.match(detail))}
+        return scanned, "\n".join(details)
+
+    raise NotImplementedError(f"Query plan checks are not supported for {connection.dialect.name}.")
+
+
+def check_query_plans(connection: Connection, checks: list[PlanCheck] | None = None) -> list[PlanRegression]:
+    """Check that the hot-path queries read their tables through indexes.
+
+    Args:
+        connection (Connection): A connection to a migrated database, outside of a transaction.
+        checks (list[PlanCheck] | None): The queries to check, defaults to HOT_PATH_QUERIES.
+
+    Returns:
+        list[PlanRegression]: The tables fully scanned by the queries or whose queries cannot be
+            planned, e.g. an upsert without a matching unique index, empty if all use an index.
+    """
+    regressions = []
+    for check in checks or HOT_PATH_QUERIES:
+        statement = check.statement(connection.dialect) if callable(check.statement) else check.statement
+        try:
+            scanned, plan = get_full_scans(connection, statement)
+        except DBAPIError as error:
+            regressions.append(
+                PlanRegression(check=check.name, table=check.tables[0], plan=str(error.orig), reason="failed planning")
+            )
+            continue
+        regressions.extend(
+            PlanRegression(check=check.name, table=table, plan=plan) for table in check.tables if table in scanned
+        )
+    return regressions
+
+
+async def check_query_plans_async(db_url: str | None = None) -> list[PlanRegression]:
+    async with get_async_engine(db_url).connect() as connection:
+        return await connection.run_sync(check_query_plans)
@@ -0,0 +1,190 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, func, or_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from orm.data_models import (
+    GroceryReceipt,
+    Item,
+    Purchase,
+    ReceiptPage,
+    ReceiptRead,
+    Store,
+    StoreBase,
+    Transaction,
+    User,
+)
+from orm.engine import get_async_engine
+
+
+def encode_cursor(date_time: datetime | None, receipt_id: int) -> str:
+    """Encode the position after a receipt as an opaque page cursor."""
+    position = {"date_time": date_time.isoformat() if date_time else None, "id": receipt_id}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime | None, int]:
+    """Decode a page cursor into the purchase date and ID of the last receipt of the previous page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        date_time = datetime.fromisoformat(position["date_time"]) if position["date_time"] else None
+        return date_time, int(position["id"])
+    except (ValueError, TypeError, KeyError) as err:
+        raise ValueError("Invalid page cursor.") from err
+
+
+def select_receipt_page(username: str, limit: int, cursor: str | None = None):
+    """Select a page of a user's receipts in keyset order: most recent purchase first, undated last.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    query = (
+        select(GroceryReceipt.id, GroceryReceipt.date_time, GroceryReceipt.store_id)
+        .join(User, User.id == GroceryReceipt.user_id)
+        .where(User.username == username)
+    )
+    if cursor is not None:
+        date_time, receipt_id = decode_cursor(cursor)
+        if date_time is None:
+            query = query.where(GroceryReceipt.date_time.is_(None), GroceryReceipt.id < receipt_id)
+        else:
+            query = query.where(
+                or_(
+                    GroceryReceipt.date_time < date_time,
+                    and_(GroceryReceipt.date_time == date_time, GroceryReceipt.id < receipt_id),
+                    GroceryReceipt.date_time.is_(None),
+                )
+            )
+    return query.order_by(GroceryReceipt.date_time.desc().nulls_last(), GroceryReceipt.id.desc()).limit(limit)
+
+
+def select_receipt_summaries(receipts):
+    """Select the store and purchase totals of the receipts of a subquery, in the subquery's order."""
+    return (
+        select(
+            receipts.c.id,
+            receipts.c.date_time,
+            Store.name,
+            Store.address,
+            Store.phone,
+            func.count(Transaction.id).label("item_count"),
+            func.coalesce(func.sum(Transaction.quantity * Transaction.unit_price), 0.0).label("total"),
+        )
+        .select_from(receipts)
+        .outerjoin(Store, Store.id == receipts.c.store_id)
+        .outerjoin(Transaction, Transaction.receipt_id == receipts.c.id)
+        .group_by(receipts.c.id, receipts.c.date_time, Store.id, Store.name, Store.address, Store.phone)
+        .order_by(receipts.c.date_time.desc().nulls_last(), receipts.c.id.desc())
+    )
+
+
+async def load_purchases(session: AsyncSession, receipt_ids: list[int]) -> dict[int, list[Purchase]]:
+    """Load the purchases of several receipts in a single query, keyed by receipt ID."""
+    purchases: dict[int, list[Purchase]] = {receipt_id: [] for receipt_id in receipt_ids}
+    if not receipt_ids:
+        return purchases
+
+    rows = await session.exec(
+        select(
+            Transaction.receipt_id,
+            Item.name,
+            Item.category,
+            Item.brand,
+            Transaction.quantity,
+            Transaction.unit_price,
+            Transaction.unit_type,
+        )
+        .join(Item, Item.id == Transaction.item_id)
+        .where(Transaction.receipt_id.in_(receipt_ids))
+        .order_by(Transaction.receipt_id, Transaction.id)
+    )
+    for receipt_id, name, category, brand, quantity, unit_price, unit_type in rows:
+        purchases[receipt_id].append(
+            Purchase(
+                name=name,
+                category=category,
+                brand=brand,
+                quantity=quantity,
+                unit_price=unit_price,
+                unit_type=unit_type,
+            )
+        )
+    return purchases
+
+
+def to_receipt_read(row, purchases: list[Purchase] | None = None) -> ReceiptRead:
+    receipt_id, date_time, store_name, address, phone, item_count, total = row
+    store = StoreBase(name=store_name, address=address, phone=phone) if store_name is not None else StoreBase()
+    return ReceiptRead(
+        id=receipt_id, date_time=date_time, store=store, item_count=item_count, total=total, purchases=purchases
+    )
+
+
+async def list_receipts_async(
+    username: str, limit: int, cursor: str | None, include_purchases: bool, db_url: str
+) -> ReceiptPage:
+    """List a page of a user's receipts with their store and totals.
+
+    Rows are projected straight into the response schema without loading ORM objects. A page takes one
+    query, or two with purchases, whatever its size.
+
+    Args:
+        username (str): The username of the user.
+        limit (int): The maximum number of receipts on the page.
+        cursor (str | None): The cursor returned with the previous page, or None for the first page.
+        include_purchases (bool): Whether to include the purchases of each receipt.
+        db_url (str): The database URL.
+
+    Returns:
+        ReceiptPage: The receipts and the cursor of the next page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    # One receipt beyond the page tells whether there is a next page
+    page = select_receipt_page(username=username, limit=limit + 1, cursor=cursor).subquery()
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        rows = (await session.exec(select_receipt_summaries(page))).all()
+        has_next_page = len(rows) > limit
+        rows = rows[:limit]
+
+        purchases = None
+        if include_purchases:
+            purchases = await load_purchases(session, [row.id for row in rows])
+
+    receipts = [to_receipt_read(row, purchases[row.id] if purchases is not None else None) for row in rows]
+    next_cursor = encode_cursor(rows[-1].date_time, rows[-1].id) if has_next_page else None
+    return ReceiptPage(receipts=receipts, next_cursor=next_cursor)
+
+
+async def get_receipt_async(receipt_id: int, username: str, db_url: str) -> ReceiptRead | None:
+    """Get a receipt of a user with its store, totals and purchases in two queries.
+
+    Args:
+        receipt_id (int): The ID of the receipt.
+        username (str): The username of the user, receipts of other users are not found.
+        db_url (str): The database URL.
+
+    Returns:
+        ReceiptRead | None: The receipt, or None if the user has no receipt with this ID.
+    """
+    receipt = (
+        select(GroceryReceipt.id, GroceryReceipt.date_time, GroceryReceipt.store_id)
+        .join(User, User.id == GroceryReceipt.user_id)
+        .where(GroceryReceipt.id == receipt_id, User.username == username)
+        .subquery()
+    )
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        row = (await session.exec(select_receipt_summaries(receipt))).first()
+        if row is None:
+            return None
+        purchases = await load_purchases(session, [receipt_id])
+    return to_receipt_read(row, purchases[receipt_id])
@@ -0,0 +1,296 @@
+from collections.abc import Iterable
+from datetime import date, datetime, timedelta
+from enum import StrEnum
+
+from sqlalchemy import delete, func, or_
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from orm.data_models import (
+    GroceryCategory,
+    GroceryReceipt,
+    Item,
+    Purchase,
+    RollupPeriod,
+    SpendingRollup,
+    SpendingSummary,
+    Store,
+    Transaction,
+    User,
+)
+from orm.engine import get_async_engine, get_dialect_insert
+
+# Rows of a rollup keyed by (period, period start, category, store ID), holding spend, quantity and count
+RollupTotals = dict[tuple[RollupPeriod, date, GroceryCategory, int], list[float]]
+
+# Rows inserted per statement when rebuilding the rollups
+REBUILD_BATCH_SIZE = 1000
+
+
+class SpendingGroupBy(StrEnum):
+    CATEGORY = "category"
+    STORE = "store"
+    NONE = "none"
+
+
+def get_period_start(day: date, period: RollupPeriod) -> date:
+    """Get the first day of the period containing a day; weeks start on Monday."""
+    if period == RollupPeriod.WEEK:
+        return day - timedelta(days=day.weekday())
+    if period == RollupPeriod.MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def add_to_rollup_totals(
+    totals: RollupTotals, day: date, category: GroceryCategory, store_id: int, quantity: float, unit_price: float
+):
+    """Add a transaction to the totals of each period containing its day."""
+    for period in RollupPeriod:
+        row = totals.setdefault((period, get_period_start(day, period), category, store_id), [0.0, 0.0, 0])
+        row[0] += quantity * unit_price
+        row[1] += quantity
+        row[2] += 1
+
+
+def upsert_rollup_totals(session: Session, user_id: int, totals: RollupTotals):
+    """Add totals to the rollups of a user in a single statement, creating missing rows.
+
+    Concurrent saves of the same user add to the same rows atomically through ON CONFLICT DO UPDATE.
+    """
+    if not totals:
+        return
+
+    insert = get_dialect_insert(session)
+    rollups = SpendingRollup.__table__
+    insert_stmt = insert(rollups).values(
+        [
+            {
+                "user_id": user_id,
+                "period": period,
+                "period_start": period_start,
+                "category": category,
+                "store_id": store_id,
+                "spend": spend,
+                "quantity": quantity,
+                "transaction_count": transaction_count,
+            }
+            for (period, period_start, category, store_id), (spend, quantity, transaction_count) in totals.items()
+        ]
+    )
+    session.exec(
+        insert_stmt.on_conflict_do_update(
+            index_elements=[
+                rollups.c.user_id,
+                rollups.c.period,
+                rollups.c.period_start,
+                rollups.c.category,
+                rollups.c.store_id,
+            ],
+            set_={
+                "spend": rollups.c.spend + insert_stmt.excluded.spend,
+                "quantity": rollups.c.quantity + insert_stmt.excluded.quantity,
+                "transaction_count": rollups.c.transaction_count + insert_stmt.excluded.transaction_count,
+            },
+        )
+    )
+
+
+def update_spending_rollups(
+    session: Session,
+    user_id: int,
+    store_id: int,
+    date_time: datetime | None,
+    purchases: Iterable[tuple[GroceryCategory, Purchase]],
+):
+    """Add the purchases of a receipt to the spending rollups of its user.
+
+    Receipts without a purchase date are not part of any period and are left out of the rollups.
+
+    Args:
+        session (Session): The database session saving the receipt.
+        user_id (int): The ID of the user who made the purchases.
+        store_id (int): The ID of the store where the purchases were made.
+        date_time (datetime | None): The date and time of the purchase.
+        purchases (Iterable[tuple[GroceryCategory, Purchase]]): The purchases with the category of their item.
+    """
+    if date_time is None:
+        return
+
+    totals: RollupTotals = {}
+    for category, purchase in purchases:
+        add_to_rollup_totals(
+            totals, date_time.date(), category, store_id, quantity=purchase.quantity, unit_price=purchase.unit_price
+        )
+    upsert_rollup_totals(session=session, user_id=user_id, totals=totals)
+
+
+def rebuild_spending_rollups(session: Session, user_id: int | None = None) -> int:
+    """Recompute the spending rollups from the stored transactions.
+
+    Transactions are streamed in batches, so memory grows with the number of rollup rows rather than transactions.
+
+    Args:
+        session (Session): The database session.
+        user_id (int | None): The ID of the user to rebuild the rollups of, or None for all users.
+
+    Returns:
+        int: The number of transactions aggregated.
+    """
+    delete_stmt = delete(SpendingRollup)
+    if user_id is not None:
+        delete_stmt = delete_stmt.where(SpendingRollup.user_id == user_id)
+    session.exec(delete_stmt)
+
+    query = (
+        select(
+            GroceryReceipt.user_id,
+            GroceryReceipt.store_id,
+            GroceryReceipt.date_time,
+            Item.category,
+            Transaction.quantity,
+            Transaction.unit_price,
+        )
+        .join(Transaction, Transaction.receipt_id == GroceryReceipt.id)
+        .join(Item, Item.id == Transaction.item_id)
+        .where(GroceryReceipt.date_time.is_not(None))
+        .execution_options(yield_per=REBUILD_BATCH_SIZE)
+    )
+    if user_id is not None:
+        query = query.where(GroceryReceipt.user_id == user_id)
+
+    totals_by_user: dict[int, RollupTotals] = {}
+    transaction_count = 0
+    for receipt_user_id, store_id, date_time, category, quantity, unit_price in session.exec(query):
+        totals = totals_by_user.setdefault(receipt_user_id, {})
+        add_to_rollup_totals(totals, date_time.date(), category, store_id, quantity=quantity, unit_price=unit_price)
+        transaction_count += 1
+
+    for receipt_user_id, totals in totals_by_user.items():
+        rows = list(totals.items())
+        for start in range(0, len(rows), REBUILD_BATCH_SIZE):
+            upsert_rollup_totals(
+                session=session, user_id=receipt_user_id, totals=dict(rows[start : start + REBUILD_BATCH_SIZE])
+            )
+    return transaction_count
+
+
+def split_date_range(start: date, end: date) -> list[tuple[RollupPeriod, date, date]]:
+    """Split a date range into the fewest day and month periods covering it.
+
+    Args:
+        start (date): The first day of the range.
+        end (date): The day after the last day of the range.
+
+    Returns:
+        list[tuple[RollupPeriod, date, date]]: The period and the range of period starts to read, end exclusive.
+    """
+    if start >= end:
+        return []
+
+    first_month = get_period_start(start, RollupPeriod.MONTH)
+    if first_month < start:
+        first_month = (first_month + timedelta(days=32)).replace(day=1)
+    last_month = get_period_start(end, RollupPeriod.MONTH)
+    if first_month >= last_month:
+        return [(RollupPeriod.DAY, start, end)]
+
+    ranges = [
+        (RollupPeriod.DAY, start, first_month),
+        (RollupPeriod.MONTH, first_month, last_month),
+        (RollupPeriod.DAY, last_month, end),
+    ]
+    return [(period, range_start, range_end) for period, range_start, range_end in ranges if range_start < range_end]
+
+
+def select_spending(username: str, group_by: SpendingGroupBy):
+    """Select the summed rollups of a user, grouped by category or store name."""
+    columns = [
+        func.sum(SpendingRollup.spend).label("spend"),
+        func.sum(SpendingRollup.quantity).label("quantity"),
+        func.sum(SpendingRollup.transaction_count).label("transaction_count"),
+    ]
+    if group_by == SpendingGroupBy.CATEGORY:
+        columns.append(SpendingRollup.category)
+    elif group_by == SpendingGroupBy.STORE:
+        columns.append(Store.name.label("store"))
+
+    query = select(*columns).join(User, User.id == SpendingRollup.user_id).where(User.username == username)
+    if group_by == SpendingGroupBy.CATEGORY:
+        query = query.group_by(SpendingRollup.category)
+    elif group_by == SpendingGroupBy.STORE:
+        query = query.join(Store, Store.id == SpendingRollup.store_id).group_by(Store.name)
+    return query
+
+
+async def get_spending_series_async(
+    username: str, period: RollupPeriod, start: date, end: date, group_by: SpendingGroupBy, db_url: str
+) -> list[SpendingSummary]:
+    """Get the spending of a user per period, read from the rollups of that period.
+
+    Args:
+        username (str): The username of the user.
+        period (RollupPeriod): The period to aggregate by.
+        start (date): The first day of the range; periods starting before it are left out.
+        end (date): The day after the last day of the range.
+        group_by (SpendingGroupBy): Whether to split each period by category or store.
+        db_url (str): The database URL.
+
+    Returns:
+        list[SpendingSummary]: The spending ordered by period.
+    """
+    query = (
+        select_spending(username=username, group_by=group_by)
+        .add_columns(SpendingRollup.period_start)
+        .where(
+            SpendingRollup.period == period,
+            SpendingRollup.period_start >= start,
+            SpendingRollup.period_start < end,
+        )
+        .group_by(SpendingRollup.period_start)
+        .order_by(SpendingRollup.period_start)
+    )
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        rows = await session.exec(query)
+        return [SpendingSummary.model_validate(row._mapping) for row in rows]
+
+
+async def get_spending_breakdown_async(
+    username: str, start: date, end: date, group_by: SpendingGroupBy, db_url: str
+) -> list[SpendingSummary]:
+    """Get the total spending of a user over a date range.
+
+    Whole months are read from the monthly rollups and only the partial months at the edges from the
+    daily rollups, so the rows read stay bounded for long ranges.
+
+    Args:
+        username (str): The username of the user.
+        start (date): The first day of the range.
+        end (date): The day after the last day of the range.
+        group_by (SpendingGroupBy): Whether to split the total by category or store.
+        db_url (str): The database URL.
+
+    Returns:
+        list[SpendingSummary]: The spending ordered from the highest.
+    """
+    ranges = split_date_range(start, end)
+    if not ranges:
+        return []
+
+    query = (
+        select_spending(username=username, group_by=group_by)
+        .where(
+            or_(
+                *(
+                    (SpendingRollup.period == period)
+                    & (SpendingRollup.period_start >= range_start)
+                    & (SpendingRollup.period_start < range_end)
+                    for period, range_start, range_end in ranges
+                )
+            )
+        )
+        .order_by(func.sum(SpendingRollup.spend).desc())
+    )
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        rows = await session.exec(query)
+        return [SpendingSummary.model_validate(row._mapping) for row in rows if row.transaction_count]
@@ -1,10 +1,20 @@
 from datetime import datetime
 
-from sqlmodel import Session, create_engine, select
+from sqlalchemy import func, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from config import settings
+from metrics import track_stage
+from orm.canonical import (
+    ItemRef,
+    get_canonical_index,
+    normalize_item_name,
+    record_item_aliases,
+    resolve_item_names,
+)
 from orm.data_models import (
-    GroceryCategory,
     GroceryReceipt,
     GroceryReceiptSchema,
     Item,
@@ -13,20 +23,11 @@ from orm.data_models import (
     Transaction,
     User,
 )
-
-# Global engine instance
-engine = None
-
-def get_engine():
-    global engine
-    if engine is None:
-        engine = create_engine(settings.database_url)
-    return engine
-
-def get_session():
-    """FastAPI dependency to get database session"""
-    with Session(get_engine()) as session:
-        yield session
+from orm.dedup import filter_probable_image_hashes, record_image_hash
+from orm.engine import get_async_engine, get_dialect_insert, get_engine
+from orm.perceptual import compute_perceptual_hash, compute_perceptual_hash_async, record_perceptual_hash
+from orm.prices import record_item_prices
+from orm.rollups import update_spending_rollups
 
 
 def get_or_create_user(session: Session, username: str) -> User:
@@ -43,9 +44,13 @@ def get_or_create_user(session: Session, username: str) -> User:
     user = session.exec(select(User).where(User.username == username)).first()
 
     if not user:
-        user = User(username=username)
-        session.add(user)
-        session.flush()
+        try:
+            with session.begin_nested():
+                user = User(username=username)
+                session.add(user)
+        except IntegrityError:
+            # Created by a concurrent request since the lookup
+            user = session.exec(select(User).where(User.username == username)).one()
     return user
 
 
@@ -64,9 +69,13 @@ def get_or_create_store(session: Session, name: str = "unknown", address: str =
     store = session.exec(select(Store).where(Store.name == name)).first()
 
     if not store:
-        store = Store(name=name, address=address, phone=phone)
-        session.add(store)
-        session.flush()
+        try:
+            with session.begin_nested():
+                store = Store(name=name, address=address, phone=phone)
+                session.add(store)
+        except IntegrityError:
+            # Created by a concurrent request since the lookup
+            store = session.exec(select(Store).where(Store.name == name)).one()
     return store
 
 
@@ -76,6 +85,7 @@ def create_grocery_receipt(
     store: Store,
     date_time: datetime,
     img_content: bytes,
+    perceptual_hash: str | None = None,
 ) -> GroceryReceipt:
     """Create a grocery receipt in the database.
 
@@ -85,77 +95,147 @@ def create_grocery_receipt(
         store (Store): The store where the purchase was made.
         date_time (datetime): The date and time of the purchase.
         img_content (bytes): The image content of the receipt.
+        perceptual_hash (str | None): The perceptual hash of the image, see orm/perceptual.py.
 
     Returns:
         GroceryReceipt: The created grocery receipt.
     """
     receipt = GroceryReceipt.from_image_and_data(
-        user_id=user.id, store_id=store.id, date_time=date_time, image_content=img_content
+        user_id=user.id,
+        store_id=store.id,
+        date_time=date_time,
+        image_content=img_content,
+        perceptual_hash=perceptual_hash,
     )
     session.add(receipt)
     session.flush()
     return receipt
 
 
-def get_or_create_item(
-    session: Session, store_id: int, name: str, category: GroceryCategory, brand: str | None = None
-) -> Item:
-    """Create a new item or retrieve an existing one.
+def get_or_create_items(session: Session, store_id: int, purchases: list[Purchase]) -> dict[str, ItemRef]:
+    """Resolve the items of the purchases for a store, creating missing ones in a single statement.
+
+    Items are unique per store and name; the first purchase of a name decides the category and brand
+    of a new item. With item canonicalization enabled, names without an exact match are first resolved
+    through the store's aliases and fuzzy matching (see orm/canonical.py), and names sharing a
+    normalized key create a single item.
 
     Args:
         session (Session): The database session.
-        store_id (int): The ID of the store where the item is sold.
-        name (str): The name of the item.
-        category (GroceryCategory): The category of the item.
-        brand (str | None, optional): The brand of the item. Defaults to None.
+        store_id (int): The ID of the store where the items are sold.
+        purchases (list[Purchase]): The purchases to resolve items for.
 
     Returns:
-        Item: The created or retrieved item.
+        dict[str, ItemRef]: The item IDs and categories keyed by item name.
     """
-    item = session.exec(select(Item).where(Item.name == name, Item.store_id == store_id)).first()
+    purchases_by_name: dict[str, Purchase] = {}
+    for purchase in purchases:
+        purchases_by_name.setdefault(purchase.name, purchase)
+    if not purchases_by_name:
+        return {}
+
+    items_by_name = {
+        name: ItemRef(item_id, category)
+        for name, item_id, category in session.exec(
+            select(Item.name, Item.id, Item.category).where(Item.store_id == store_id, Item.name.in_(purchases_by_name))
+        )
+    }
+
+    missing_names = [name for name in purchases_by_name if name not in items_by_name]
+    if not missing_names:
+        return items_by_name
+
+    canonicalize = settings.item_canonicalization_enabled
+    if canonicalize:
+        items_by_name.update(resolve_item_names(session=session, store_id=store_id, names=missing_names))
+        missing_names = [name for name in missing_names if name not in items_by_name]
+
+    # Names sharing a normalized key are created as one item, named after the first of them
+    names_by_key: dict[str, list[str]] = {}
+    for name in missing_names:
+        names_by_key.setdefault(normalize_item_name(name) if canonicalize else name, []).append(name)
+    new_names = [names[0] for names in names_by_key.values()]
+
+    if new_names:
+        insert = get_dialect_insert(session)
+        items = Item.__table__
+        insert_stmt = (
+            insert(items)
+            .values(
+                [
+                    {
+                        "store_id": store_id,
+                        "name": name,
+                        "category": purchases_by_name[name].category,
+                        "brand": purchases_by_name[name].brand,
+                    }
+                    for name in new_names
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=[items.c.store_id, items.c.name])
+            .returning(items.c.name, items.c.id, items.c.category)
+        )
+        created_items = {name: ItemRef(item_id, category) for name, item_id, category in session.exec(insert_stmt)}
+        items_by_name.update(created_items)
+
+        # Items inserted concurrently by another session are skipped by ON CONFLICT and must be re-read
+        conflicting_names = [name for name in new_names if name not in items_by_name]
+        if conflicting_names:
+            items_by_name.update(
+                (name, ItemRef(item_id, category))
+                for name, item_id, category in session.exec(
+                    select(Item.name, Item.id, Item.category).where(
+                        Item.store_id == store_id, Item.name.in_(conflicting_names)
+                    )
+                )
+            )
 
-    if not item:
-        item = Item(name=name, category=category, brand=brand, store_id=store_id)
-        session.add(item)
-        session.flush()
-    return item
+        for names in names_by_key.values():
+            for name in names[1:]:
+                items_by_name[name] = items_by_name[names[0]]
 
+        if canonicalize:
+            index = get_canonical_index(session=session, store_id=store_id)
+            for name, item in created_items.items():
+                index.add(item.id, name)
 
-def create_transaction_from_purchase(
-    session: Session,
-    purchase: Purchase,
-    receipt_id: int,
-    store_id: int,
-) -> Transaction:
-    """Create a new transaction from a purchase.
+    if canonicalize:
+        record_item_aliases(
+            session=session,
+            store_id=store_id,
+            items_by_name={name: items_by_name[name] for name in purchases_by_name if name in items_by_name},
+        )
+    return items_by_name
+
+
+def create_transactions_from_purchases(
+    session: Session, purchases: list[Purchase], receipt_id: int, items: dict[str, ItemRef]
+):
+    """Create the transactions of a receipt with a single multi-row insert.
 
     Args:
         session (Session): The database session.
-        purchase (Purchase): The purchase to create a transaction for.
+        purchases (list[Purchase]): The purchases to create transactions for.
         receipt_id (int): The ID of the grocery receipt.
-        store_id (int): The ID of the store.
-
-    Returns:
-        Transaction: The created transaction.
+        items (dict[str, ItemRef]): The items keyed by item name.
     """
-
-    item = get_or_create_item(
-        session=session,
-        store_id=store_id,
-        name=purchase.name,
-        category=purchase.category,
-        brand=purchase.brand,
-    )
-    transaction = Transaction(
-        receipt_id=receipt_id,
-        item_id=item.id,
-        quantity=purchase.quantity,
-        unit_price=purchase.unit_price,
-        unit_type=purchase.unit_type,
+    if not purchases:
+        return
+
+    session.exec(
+        insert(Transaction.__table__).values(
+            [
+                {
+                    "receipt_id": receipt_id,
+                    "item_id": items[purchase.name].id,
+                    "quantity": purchase.quantity,
+                    "unit_price": purchase.unit_price,
+                    "unit_type": purchase.unit_type,
+                }
+                for purchase in purchases
+            ]
+        )
     )
-    session.add(transaction)
-    session.flush()
-    return transaction
 
 
 def is_receipt_in_db(img_content: bytes, db_url: str) -> bool:
@@ -169,44 +249,235 @@ def is_receipt_in_db(img_content: bytes, db_url: str) -> bool:
         bool: True if the receipt exists, False otherwise.
     """
     img_hash = GroceryReceipt.generate_image_hash(img_content)
-    engine = create_engine(db_url)
+    if not filter_probable_image_hashes([img_hash]):
+        return False
 
-    with Session(engine) as session:
+    with track_stage("dedup_query"), Session(get_engine(db_url)) as session:
         existing_receipt = session.exec(select(GroceryReceipt).where(GroceryReceipt.image_hash == img_hash)).first()
         return existing_receipt is not None
 
 
-def add_grocery_receipt_to_db(img_content: bytes, parsed_data: GroceryReceiptSchema, db_url: str):
-    """Add a grocery receipt to the database.
+def get_existing_image_hashes(image_hashes: list[str], db_url: str) -> set[str]:
+    """Find which of the given image hashes already belong to a receipt in the database.
+
+    Args:
+        image_hashes (list[str]): The image hashes to look up.
+        db_url (str): The database URL.
+
+    Returns:
+        set[str]: The subset of image hashes already in the database.
+    """
+    image_hashes = filter_probable_image_hashes(image_hashes)
+    if not image_hashes:
+        return set()
+
+    with track_stage("dedup_query"), Session(get_engine(db_url)) as session:
+        existing = session.exec(select(GroceryReceipt.image_hash).where(GroceryReceipt.image_hash.in_(image_hashes)))
+        return set(existing.all())
+
+
+async def is_receipt_in_db_async(img_content: bytes, db_url: str) -> bool:
+    """Async variant of is_receipt_in_db.
 
     Args:
         img_content (bytes): The image content of the grocery receipt.
-        parsed_data (GroceryReceiptSchema): The parsed data from the grocery receipt.
         db_url (str): The database URL.
+
+    Returns:
+        bool: True if the receipt exists, False otherwise.
     """
-    engine = create_engine(db_url)
+    return await is_image_hash_in_db_async(image_hash=GroceryReceipt.generate_image_hash(img_content), db_url=db_url)
 
-    with Session(engine) as session:
-        user = get_or_create_user(session=session, username=parsed_data.user.username)
 
-        if parsed_data.store:
-            store = get_or_create_store(
-                session=session,
-                name=parsed_data.store.name,
-                address=parsed_data.store.address,
-                phone=parsed_data.store.phone,
+async def is_image_hash_in_db_async(image_hash: str, db_url: str) -> bool:
+    """Check if a grocery receipt with the image hash already exists in the database.
+
+    Args:
+        image_hash (str): The image hash of the grocery receipt.
+        db_url (str): The database URL.
+
+    Returns:
+        bool: True if the receipt exists, False otherwise.
+    """
+    if not filter_probable_image_hashes([image_hash]):
+        return False
+
+    with track_stage("dedup_query"):
+        async with AsyncSession(get_async_engine(db_url)) as session:
+            existing = await session.exec(select(GroceryReceipt.id).where(GroceryReceipt.image_hash == image_hash))
+            return existing.first() is not None
+
+
+async def get_existing_image_hashes_async(image_hashes: list[str], db_url: str) -> set[str]:
+    """Async variant of get_existing_image_hashes.
+
+    Args:
+        image_hashes (list[str]): The image hashes to look up.
+        db_url (str): The database URL.
+
+    Returns:
+        set[str]: The subset of image hashes already in the database.
+    """
+    image_hashes = filter_probable_image_hashes(image_hashes)
+    if not image_hashes:
+        return set()
+
+    with track_stage("dedup_query"):
+        async with AsyncSession(get_async_engine(db_url)) as session:
+            existing = await session.exec(
+                select(GroceryReceipt.image_hash).where(GroceryReceipt.image_hash.in_(image_hashes))
             )
+            return set(existing.all())
+
+
+def bump_data_versions(session: Session, user_ids: list[int] | None = None):
+    """Mark the data of users as changed, so the cached responses computed from it are not served again.
+
+    Args:
+        session (Session): The database session, whose transaction makes the change.
+        user_ids (list[int] | None): The IDs of the users whose data changed, or None for all users.
+    """
+    statement = update(User).values(data_version=User.data_version + 1)
+    if user_ids is not None:
+        statement = statement.where(User.id.in_(user_ids))
+    session.exec(statement)
+
+
+async def get_data_version_async(username: str | None, db_url: str | None = None) -> int:
+    """Get the version of a user's data, which changes with each committed change of it.
+
+    Args:
+        username (str | None): The username of the user, or None for the data shared by all users.
+        db_url (str | None): The database URL, defaults to the configured database.
+
+    Returns:
+        int: The version, 0 for an unknown user.
+    """
+    if username is None:
+        statement = select(func.coalesce(func.sum(User.data_version), 0))
+    else:
+        statement = select(User.data_version).where(User.username == username)
+    async with AsyncSession(get_async_engine(db_url)) as session:
+        return (await session.exec(statement)).first() or 0
+
+
+def save_grocery_receipt(
+    session: Session, img_content: bytes, parsed_data: GroceryReceiptSchema, perceptual_hash: str | None = None
+) -> GroceryReceipt:
+    """Add a parsed grocery receipt with its user, store and transactions to the session.
+
+    The number of statements is constant regardless of the number of purchases on the receipt. The
+    spending rollups, item price history and the user's data version are updated in the same transaction.
+
+    Args:
+        session (Session): The database session.
+        img_content (bytes): The image content of the grocery receipt.
+        parsed_data (GroceryReceiptSchema): The parsed data from the grocery receipt.
+        perceptual_hash (str | None): The perceptual hash of the image, computed from the image if None.
 
-        receipt = create_grocery_receipt(
-            session=session, user=user, store=store, date_time=parsed_data.date_time, img_content=img_content
+    Returns:
+        GroceryReceipt: The created grocery receipt.
+    """
+    user = get_or_create_user(session=session, username=parsed_data.user.username)
+    bump_data_versions(session=session, user_ids=[user.id])
+
+    if parsed_data.store:
+        store = get_or_create_store(
+            session=session,
+            name=parsed_data.store.name,
+            address=parsed_data.store.address,
+            phone=parsed_data.store.phone,
         )
+    else:
+        store = get_or_create_store(session=session)
 
-        for purchase in parsed_data.purchases:
-            create_transaction_from_purchase(
-                session=session,
-                purchase=purchase,
-                receipt_id=receipt.id,
-                store_id=store.id,
-            )
+    if perceptual_hash is None:
+        perceptual_hash = compute_perceptual_hash(img_content)
+    receipt = create_grocery_receipt(
+        session=session,
+        user=user,
+        store=store,
+        date_time=parsed_data.date_time,
+        img_content=img_content,
+        perceptual_hash=perceptual_hash,
+    )
 
+    items = get_or_create_items(session=session, store_id=store.id, purchases=parsed_data.purchases)
+    create_transactions_from_purchases(
+        session=session, purchases=parsed_data.purchases, receipt_id=receipt.id, items=items
+    )
+    record_item_prices(
+        session=session,
+        receipt_id=receipt.id,
+        date_time=parsed_data.date_time,
+        purchases=[(items[purchase.name].id, purchase) for purchase in parsed_data.purchases],
+    )
+    update_spending_rollups(
+        session=session,
+        user_id=user.id,
+        store_id=store.id,
+        date_time=parsed_data.date_time,
+        purchases=[(items[purchase.name].category, purchase) for purchase in parsed_data.purchases],
+    )
+    return receipt
+
+
+def add_grocery_receipt_to_db(img_content: bytes, parsed_data: GroceryReceiptSchema, db_url: str):
+    """Add a grocery receipt to the database.
+
+    Args:
+        img_content (bytes): The image content of the grocery receipt.
+        parsed_data (GroceryReceiptSchema): The parsed data from the grocery receipt.
+        db_url (str): The database URL.
+    """
+    add_grocery_receipts_to_db(receipts=[(img_content, parsed_data)], db_url=db_url)
+
+
+def add_grocery_receipts_to_db(receipts: list[tuple[bytes, GroceryReceiptSchema]], db_url: str):
+    """Add several grocery receipts to the database in a single transaction.
+
+    Either all receipts are saved or, if any fails, none of them.
+
+    Args:
+        receipts (list[tuple[bytes, GroceryReceiptSchema]]): The image content and parsed data of each receipt.
+        db_url (str): The database URL.
+    """
+    with track_stage("db_save"), Session(get_engine(db_url)) as session:
+        saved = []
+        for img_content, parsed_data in receipts:
+            receipt = save_grocery_receipt(session=session, img_content=img_content, parsed_data=parsed_data)
+            saved.append((receipt.id, receipt.image_hash, receipt.perceptual_hash, parsed_data.user.username))
         session.commit()
+    for receipt_id, image_hash, perceptual_hash, username in saved:
+        record_image_hash(image_hash)
+        record_perceptual_hash(receipt_id, perceptual_hash, username=username)
+
+
+async def add_grocery_receipt_to_db_async(
+    img_content: bytes, parsed_data: GroceryReceiptSchema, db_url: str, perceptual_hash: str | None = None
+):
+    """Async variant of add_grocery_receipt_to_db.
+
+    Args:
+        img_content (bytes): The image content of the grocery receipt.
+        parsed_data (GroceryReceiptSchema): The parsed data from the grocery receipt.
+        db_url (str): The database URL.
+        perceptual_hash (str | None): The perceptual hash of the image, computed from the image if None.
+    """
+    if perceptual_hash is None:
+        # Computed off the event loop, which the synchronous save below would otherwise block
+        perceptual_hash = await compute_perceptual_hash_async(img_content)
+    with track_stage("db_save"):
+        async with AsyncSession(get_async_engine(db_url)) as session:
+            receipt = await session.run_sync(
+                lambda sync_session: save_grocery_receipt(
+                    session=sync_session,
+                    img_content=img_content,
+                    parsed_data=parsed_data,
+                    perceptual_hash=perceptual_hash,
+                )
+            )
+            receipt_id, image_hash = receipt.id, receipt.image_hash
+            await session.commit()
+    record_image_hash(image_hash)
+    record_perceptual_hash(receipt_id, perceptual_hash, username=parsed_data.user.username)
@@ -0,0 +1,257 @@
+import gzip
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, NamedTuple
+
+import brotli
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.datastructures import Headers, QueryParams
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import settings
+from orm.utils import get_data_version_async
+
+logger = logging.getLogger(__name__)
+
+# User of requests without a current_user query parameter, mirroring the mocked authentication
+DEFAULT_USER = "mock_user"
+
+
+def make_etag(body: bytes, suffix: str = "") -> str:
+    """Make a strong ETag from the content of a response body."""
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}{suffix}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Check whether an If-None-Match header matches an ETag, using weak comparison as required for GET."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def not_modified(etag: str, cache_control: str, **headers: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control, **headers})
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    headers: list[tuple[bytes, bytes]]
+    route: Any
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of GET response bodies, partitioned by user.
+
+    Each entry records the version of the user's data it was computed from, see
+    get_data_version_async, and is only served while that version is current. The version is kept in
+    the database, so receipts saved by other processes, e.g. the receipt worker, take effect on the
+    next request. Entries of shared resources are cached under the user None. Entries also expire
+    after `ttl_seconds`.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[str | None, str], tuple[float, int, CachedResponse]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user: str | None, key: str, version: int) -> CachedResponse | None:
+        """Get a cached response computed from the given version of the user's data."""
+        with self._lock:
+            entry = self._entries.get((user, key))
+            if entry is None:
+                return None
+
+            expires_at, entry_version, response = entry
+            if expires_at <= time.monotonic() or entry_version != version:
+                del self._entries[(user, key)]
+                return None
+
+            self._entries.move_to_end((user, key))
+            return response
+
+    def set(self, user: str | None, key: str, response: CachedResponse, version: int):
+        """Cache a response computed from the given version of the user's data, read before computing it."""
+        with self._lock:
+            self._entries[(user, key)] = (time.monotonic() + self.ttl_seconds, version, response)
+            self._entries.move_to_end((user, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Global response cache instance
+response_cache: ResponseCache | None = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    """Get the response cache, or None if it is disabled."""
+    global response_cache
+    if response_cache is None and settings.response_cache_enabled:
+        with _response_cache_lock:
+            if response_cache is None:
+                response_cache = ResponseCache(
+                    ttl_seconds=settings.response_cache_ttl_seconds, max_entries=settings.response_cache_max_entries
+                )
+    return response_cache
+
+
+class ResponseCacheMiddleware:
+    """
+    Cache successful GET responses under the given path prefixes and answer conditional requests.
+
+    Responses get a strong ETag and a private Cache-Control header; a request whose If-None-Match
+    matches is answered with 304 and no body. Responses of `shared_path_prefixes` do not depend on
+    the user and are shared between users.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        path_prefixes: tuple[str, ...],
+        shared_path_prefixes: tuple[str, ...] = (),
+        max_age_seconds: int = 0,
+    ):
+        self.app = app
+        self.path_prefixes = path_prefixes + shared_path_prefixes
+        self.shared_path_prefixes = shared_path_prefixes
+        self.cache_control = f"private, max-age={max_age_seconds}, must-revalidate"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        cache = get_response_cache()
+        if (
+            cache is None
+            or scope["type"] != "http"
+            or scope["method"] != "GET"
+            or not scope["path"].startswith(self.path_prefixes)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        query_params = QueryParams(scope["query_string"])
+        if scope["path"].startswith(self.shared_path_prefixes):
+            user = None
+        else:
+            user = query_params.get("current_user", DEFAULT_USER)
+        key = f"{scope['path']}?{'&'.join(sorted(f'{name}={value}' for name, value in query_params.multi_items()))}"
+
+        try:
+            version = await get_data_version_async(username=user)
+        except SQLAlchemyError:
+            logger.warning("Could not read the data version of %s, not caching the response.", user, exc_info=True)
+            await self.app(scope, receive, send)
+            return
+
+        cached = cache.get(user, key, version=version)
+        if cached is None:
+            messages: list[Message] = []
+
+            async def capture(message: Message):
+                messages.append(message)
+
+            await self.app(scope, receive, capture)
+            start, body = messages[0], b"".join(message.get("body", b"") for message in messages[1:])
+            if start["status"] != 200:
+                for message in messages:
+                    await send(message)
+                return
+
+            headers = [(name, value) for name, value in start["headers"] if name.lower() != b"content-length"]
+            cached = CachedResponse(body=body, etag=make_etag(body), headers=headers, route=scope.get("route"))
+            cache.set(user, key, cached, version=version)
+        elif cached.route is not None:
+            # Lets the metrics middleware label cache hits with their route
+            scope["route"] = cached.route
+
+        if etag_matches(Headers(scope=scope).get("if-none-match"), cached.etag):
+            await not_modified(cached.etag, self.cache_control)(scope, receive, send)
+            return
+
+        headers = [
+            *cached.headers,
+            (b"content-length", str(len(cached.body)).encode()),
+            (b"etag", cached.etag.encode()),
+            (b"cache-control", self.cache_control.encode()),
+        ]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": cached.body})
+
+
+def parse_accept_encoding(accept_encoding: str) -> dict[str, float]:
+    """Parse an Accept-Encoding header into the quality value of each encoding."""
+    qualities = {}
+    for part in accept_encoding.split(","):
+        encoding, *params = (piece.strip() for piece in part.split(";"))
+        if not encoding:
+            continue
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        qualities[encoding.lower()] = quality
+    return qualities
+
+
+class PrecompressedBody:
+    """
+    A static response body compressed once with brotli and gzip, served in the encoding the client prefers.
+
+    Each encoding has its own strong ETag, since they are different representations.
+    """
+
+    # Encodings in order of preference when the client accepts several equally
+    ENCODINGS = ("br", "gzip", "identity")
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str = "public, no-cache"):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.variants = {
+            "br": brotli.compress(body, quality=11),
+            "gzip": gzip.compress(body, compresslevel=9, mtime=0),
+            "identity": body,
+        }
+        self.etags = {
+            encoding: make_etag(body, suffix="" if encoding == "identity" else f"-{encoding}")
+            for encoding in self.ENCODINGS
+        }
+
+    def select_encoding(self, accept_encoding: str | None) -> str:
+        qualities = parse_accept_encoding(accept_encoding or "")
+        default_quality = qualities.get("*", 0.0)
+        best, best_quality = "identity", 0.0
+        for encoding in self.ENCODINGS[:-1]:
+            quality = qualities.get(encoding, default_quality)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def response(self, request: Request) -> Response:
+        """Build the response for a request, a 304 if the client's copy is current."""
+        encoding = self.select_encoding(request.headers.get("accept-encoding"))
+        etag = self.etags[encoding]
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag, self.cache_control, Vary="Accept-Encoding")
+
+        headers = {"ETag": etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=self.variants[encoding], media_type=self.media_type, headers=headers)
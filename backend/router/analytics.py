@@ -0,0 +1,73 @@
+from datetime import date, timedelta
+
+from fastapi import APIRouter, HTTPException
+
+from config import settings
+from orm.data_models import RollupPeriod, SpendingSummary
+from orm.rollups import SpendingGroupBy, get_spending_breakdown_async, get_spending_series_async
+
+router = APIRouter(prefix="/v0/analytics", tags=["analytics"])
+
+
+def get_date_range(start: date | None, end: date | None) -> tuple[date, date]:
+    """Resolve an inclusive date range from the query, defaulting to the last year up to today."""
+    end = end or date.today()
+    if start is None:
+        # Feb 29 has no counterpart a year earlier and is clamped to Feb 28
+        year_ago = end.replace(year=end.year - 1, day=min(end.day, 28) if end.month == 2 else end.day)
+        start = year_ago + timedelta(days=1)
+    if start > end:
+        raise HTTPException(status_code=422, detail="The start date must not be after the end date.")
+    return start, end + timedelta(days=1)
+
+
+@router.get("/spending")
+async def get_spending(
+    period: RollupPeriod = RollupPeriod.MONTH,
+    start: date | None = None,
+    end: date | None = None,
+    group_by: SpendingGroupBy = SpendingGroupBy.NONE,
+    current_user: str = "mock_user",  # Mocked for example purposes
+) -> list[SpendingSummary]:
+    """
+    Get the spending of the user per day, week or month, read from precomputed rollups.
+
+    Args:
+        period (RollupPeriod): The period to aggregate by.
+        start (date | None): The first day of the range, defaults to a year before the end.
+        end (date | None): The last day of the range, defaults to today.
+        group_by (SpendingGroupBy): Whether to split each period by category or store.
+        current_user (User): The authenticated user.
+
+    Returns:
+        list[SpendingSummary]: The spending ordered by period.
+    """
+    start, end = get_date_range(start, end)
+    return await get_spending_series_async(
+        username=current_user, period=period, start=start, end=end, group_by=group_by, db_url=settings.database_url
+    )
+
+
+@router.get("/spending/breakdown")
+async def get_spending_breakdown(
+    start: date | None = None,
+    end: date | None = None,
+    group_by: SpendingGroupBy = SpendingGroupBy.CATEGORY,
+    current_user: str = "mock_user",  # Mocked for example purposes
+) -> list[SpendingSummary]:
+    """
+    Get the total spending of the user over a date range by category or store.
+
+    Args:
+        start (date | None): The first day of the range, defaults to a year before the end.
+        end (date | None): The last day of the range, defaults to today.
+        group_by (SpendingGroupBy): Whether to split the total by category or store.
+        current_user (User): The authenticated user.
+
+    Returns:
+        list[SpendingSummary]: The spending ordered from the highest.
+    """
+    start, end = get_date_range(start, end)
+    return await get_spending_breakdown_async(
+        username=current_user, start=start, end=end, group_by=group_by, db_url=settings.database_url
+    )
@@ -0,0 +1,47 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+
+from config import settings
+from orm.export import get_export_watermark_async, stream_transactions_arrow
+
+# Served outside the cached analytics prefix, since the response cache would buffer the whole stream
+router = APIRouter(prefix="/v0/exports", tags=["exports"])
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+@router.get(
+    "/transactions",
+    response_class=StreamingResponse,
+    responses={200: {"content": {ARROW_STREAM_MEDIA_TYPE: {}}}},
+)
+async def export_transactions(
+    since: Annotated[int, Query(ge=0)] = 0,
+    current_user: str = "mock_user",  # Mocked for example purposes
+) -> StreamingResponse:
+    """
+    Stream the transactions of the user as an Arrow IPC stream, for analysis with pyarrow, pandas or DuckDB.
+
+    Rows are fetched from a server-side cursor and sent one record batch at a time. The ID of the last
+    exported transaction is returned in the Export-Watermark header; pass it as `since` to only fetch
+    the transactions saved afterwards.
+
+    IDs are assigned before transactions commit, so a receipt saved while the watermark is read can
+    commit later with lower IDs. Clients that must not miss any transaction should pass a `since`
+    EXPORT_OVERLAP_TRANSACTIONS below the watermark and drop the transaction IDs they already have.
+
+    Args:
+        since (int): Only export transactions with a greater ID.
+        current_user (User): The authenticated user.
+
+    Returns:
+        StreamingResponse: The Arrow IPC stream of the transactions.
+    """
+    until = await get_export_watermark_async(db_url=settings.database_url)
+    return StreamingResponse(
+        stream_transactions_arrow(since=since, until=until, username=current_user, db_url=settings.database_url),
+        media_type=ARROW_STREAM_MEDIA_TYPE,
+        headers={"Export-Watermark": str(max(since, until))},
+    )
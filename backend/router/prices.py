@@ -0,0 +1,57 @@
+from datetime import date
+from typing import Annotated
+
+from fastapi import APIRouter, Query
+
+from config import settings
+from orm.data_models import PricePoint, StorePriceSummary
+from orm.prices import compare_item_prices_async, get_item_price_history_async
+from router.analytics import get_date_range
+
+router = APIRouter(prefix="/v0/prices", tags=["prices"])
+
+
+@router.get("/items/{item_id}")
+async def get_item_price_history(
+    item_id: int,
+    start: date | None = None,
+    end: date | None = None,
+    max_points: Annotated[int, Query(ge=1, le=1000)] = 200,
+) -> list[PricePoint]:
+    """
+    Get the price history of an item at its store, normalized per pound or per each.
+
+    Args:
+        item_id (int): The ID of the item.
+        start (date | None): The first day of the range, defaults to a year before the end.
+        end (date | None): The last day of the range, defaults to today.
+        max_points (int): The maximum number of points per unit, purchases are bucketed by equal numbers of days.
+
+    Returns:
+        list[PricePoint]: The price buckets ordered by date.
+    """
+    start, end = get_date_range(start, end)
+    return await get_item_price_history_async(
+        item_id=item_id, start=start, end=end, max_points=max_points, db_url=settings.database_url
+    )
+
+
+@router.get("/compare")
+async def compare_item_prices(
+    name: str,
+    start: date | None = None,
+    end: date | None = None,
+) -> list[StorePriceSummary]:
+    """
+    Compare the prices of an item across stores, normalized per pound or per each.
+
+    Args:
+        name (str): The name of the item.
+        start (date | None): The first day of the range, defaults to a year before the end.
+        end (date | None): The last day of the range, defaults to today.
+
+    Returns:
+        list[StorePriceSummary]: The prices per store, ordered from the cheapest.
+    """
+    start, end = get_date_range(start, end)
+    return await compare_item_prices_async(name=name, start=start, end=end, db_url=settings.database_url)
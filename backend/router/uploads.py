@@ -0,0 +1,129 @@
+import mmap
+import tempfile
+from typing import IO
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from orm.data_models import GroceryReceipt
+
+# Size of the chunks read from an upload while hashing it
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class SpooledUpload:
+    """
+    An uploaded file copied to a spool file of its own while hashing it, exposed as a read-only memory map.
+
+    The content is a memoryview over the mapping, so it is paged in from the spool file on demand
+    rather than copied onto the heap. The spool file has a path, so the image process pool can read it
+    without the content being pickled to the worker.
+    """
+
+    def __init__(self, filename: str | None, spool: IO[bytes], image_hash: str, size: int):
+        self.filename = filename
+        self.image_hash = image_hash
+        self.size = size
+        self.path = spool.name
+        self._spool = spool
+        self._mmap = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        self.content = memoryview(self._mmap)
+
+    def close(self):
+        self.content.release()
+        self._mmap.close()
+        # Deletes the spool file
+        self._spool.close()
+
+    def __enter__(self) -> "SpooledUpload":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+async def spool_upload(upload: UploadFile, max_bytes: int) -> SpooledUpload:
+    """
+    Stream an uploaded file in chunks to a spool file, hashing it and enforcing a size limit.
+
+    Args:
+        upload (UploadFile): The uploaded file, closed once spooled.
+        max_bytes (int): The largest accepted file size.
+
+    Raises:
+        HTTPException: 413 if the file is larger than max_bytes, 400 if it is empty.
+
+    Returns:
+        SpooledUpload: The hashed upload.
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {max_bytes} byte upload limit.")
+
+    spool = tempfile.NamedTemporaryFile(prefix="upload-")
+    try:
+        hasher = GroceryReceipt.new_image_hasher()
+        size = 0
+        await upload.seek(0)
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"File exceeds the {max_bytes} byte upload limit.")
+            hasher.update(chunk)
+            await run_in_threadpool(spool.write, chunk)
+
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Uploaded file is empty.")
+        spool.flush()
+        spooled = SpooledUpload(filename=upload.filename, spool=spool, image_hash=hasher.hexdigest(), size=size)
+    except BaseException:
+        spool.close()
+        raise
+    # The multipart parser's copy is no longer needed
+    await upload.close()
+    return spooled
+
+
+class RequestSizeLimitMiddleware:
+    """
+    Reject request bodies larger than `max_bytes` with a 413, and malformed Content-Length headers with a 400.
+
+    Requests declaring a larger Content-Length are rejected before their body is read; chunked
+    requests are cut off as soon as the received body exceeds the limit.
+    """
+
+    def __init__(self, app: ASGIApp, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None:
+            response = None
+            if not content_length.strip().isdigit():
+                response = JSONResponse(status_code=400, content={"detail": "Invalid Content-Length header."})
+            elif int(content_length) > self.max_bytes:
+                response = JSONResponse(
+                    status_code=413, content={"detail": f"Request exceeds the {self.max_bytes} byte limit."}
+                )
+            if response is not None:
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Request exceeds the {self.max_bytes} byte limit.")
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -1,33 +1,151 @@
+import asyncio
+import time
+import uuid
+from collections.abc import AsyncIterator
+from enum import StrEnum
 from pathlib import Path
 from typing import Annotated
 
-from fastapi import APIRouter, File, HTTPException, UploadFile
+from fastapi import APIRouter, File, HTTPException, Query, Request, Response, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlmodel import Field, SQLModel
 
-from agent.utils import ImageType, parse_grocery_receipt
+from agent.analysis import ReceiptImageAnalysis, analyze_receipt_image_async
+from agent.rate_limit import get_llm_rate_limiter
+from agent.streaming import ReceiptStreamEvent, ReceiptStreamEventType, stream_grocery_receipt
+from agent.utils import ImageType, parse_grocery_receipt_async
 from config import settings
-from orm.data_models import GroceryReceiptSchema
-from orm.utils import is_receipt_in_db
+from metrics import track_stage
+from orm.data_models import GroceryReceiptSchema, ReceiptJobRead, ReceiptJobStatus, ReceiptPage, ReceiptRead
+from orm.engine import PoolStats, get_pool_stats
+from orm.jobs import enqueue_receipt_job_async, get_receipt_job_async
+from orm.perceptual import find_near_duplicate_receipt, format_perceptual_hash
+from orm.receipts import get_receipt_async, list_receipts_async
+from orm.utils import get_existing_image_hashes_async, is_image_hash_in_db_async
+from router.uploads import SpooledUpload, spool_upload
 
 router = APIRouter(prefix="/v0", tags=["v0"])
 
+# Seconds between keep-alive comments on an idle job event stream
+SSE_KEEPALIVE_SECONDS = 15
+
+# Response header carrying the ID of a saved receipt the upload looks like another photo of
+NEAR_DUPLICATE_HEADER = "Near-Duplicate-Receipt"
+
+
+class BatchReceiptStatus(StrEnum):
+    PARSED = "parsed"
+    DUPLICATE = "duplicate"
+    ERROR = "error"
+
+
+class BatchReceiptResult(SQLModel):
+    filename: str = Field(description="Name of the uploaded file")
+    image_hash: str | None = Field(default=None, description="SHA-256 hash of the uploaded image")
+    status: BatchReceiptStatus = Field(description="Outcome of processing the file")
+    receipt: GroceryReceiptSchema | None = Field(default=None, description="Parsed receipt data if parsed")
+    detail: str | None = Field(default=None, description="Reason the file was not parsed")
+    near_duplicate_of: int | None = Field(
+        default=None, description="ID of a saved receipt the image looks like another photo of, parsed regardless"
+    )
+
+
+async def check_receipt_not_in_db(
+    upload: SpooledUpload, username: str, reject_near_duplicates: bool, parse: bool = True
+) -> tuple[ReceiptImageAnalysis, int | None]:
+    """
+    Check that the uploaded image was not saved before, and look for another photo of the same receipt.
+
+    A new image is decoded once, in a single task of the image process pool, for its perceptual hash
+    and, when it is parsed next, for the pre-classifier and the preprocessing (see agent/analysis.py).
+
+    Near-duplicates are only flagged by default, since distinct receipts of a store can have close
+    perceptual hashes; clients can reject them to ask the user for confirmation before uploading again.
+
+    Args:
+        upload (SpooledUpload): The uploaded image.
+        username (str): The user uploading the image.
+        reject_near_duplicates (bool): Whether to reject near-duplicates of the user's saved receipts.
+        parse (bool): Whether the image is parsed next by this process, rather than queued.
+
+    Returns:
+        tuple[ReceiptImageAnalysis, int | None]: The analysis to parse the image with, and the ID of a
+            saved receipt of the user the image is a near-duplicate of, if any.
+
+    Raises:
+        HTTPException: 409 if the image, or a near-duplicate of it when rejected, is already in the database.
+    """
+    if await is_image_hash_in_db_async(image_hash=upload.image_hash, db_url=settings.database_url):
+        raise HTTPException(status_code=409, detail="Receipt already exists in the database.")
+
+    analysis = await analyze_upload(upload, parse=parse)
+    receipt_id = find_near_duplicate_image(analysis, username=username)
+    if receipt_id is not None and reject_near_duplicates:
+        raise HTTPException(
+            status_code=409,
+            detail=f"A near-duplicate of this receipt already exists in the database ({receipt_id}).",
+            headers={NEAR_DUPLICATE_HEADER: str(receipt_id)},
+        )
+    return analysis, receipt_id
+
+
+def get_near_duplicate_headers(receipt_id: int | None) -> dict[str, str]:
+    return {NEAR_DUPLICATE_HEADER: str(receipt_id)} if receipt_id is not None else {}
+
+
+async def analyze_upload(upload: SpooledUpload, parse: bool = True) -> ReceiptImageAnalysis:
+    """Analyze an uploaded image from its spool file, only for its perceptual hash unless it is parsed next."""
+    return await analyze_receipt_image_async(
+        upload.path,
+        classify=parse and settings.preclassifier_enabled,
+        preprocess=parse and settings.image_preprocessing_enabled,
+    )
+
+
+def find_near_duplicate_image(analysis: ReceiptImageAnalysis, username: str) -> int | None:
+    """Find a saved receipt of the user whose image is a near-duplicate of an analyzed image."""
+    if analysis.dhash is None:
+        return None
+    return find_near_duplicate_receipt(perceptual_hash=format_perceptual_hash(analysis.dhash), username=username)
+
 
 @router.get("/status")
 def get_status():
     return {"status": "ok"}
 
 
-@router.post("/grocery_receipt")
+@router.get("/status/db_pool")
+def get_db_pool_status() -> list[PoolStats]:
+    """Get the connection pool metrics of the database engines."""
+    return get_pool_stats()
+
+
+@router.post(
+    "/grocery_receipt",
+    responses={202: {"model": ReceiptJobRead, "description": "Receipt queued for parsing (async mode)"}},
+)
 async def parse_grocery_receipt_image(
     # img_file: Annotated[UploadFile, File()], current_user: User = Depends(get_current_user)
     img_file: Annotated[UploadFile, File()],
+    request: Request,
+    response: Response,
     current_user: str = "mock_user",  # Mocked for example purposes
+    async_mode: bool = False,
+    reject_near_duplicates: bool = False,
 ) -> GroceryReceiptSchema:
     """
     Parse a grocery receipt image and return the structured data.
 
+    In async mode the receipt is queued for a worker to parse and save, and the job is returned
+    right away with a 202; its result is available from the jobs endpoints. An image that looks
+    like another photo of a saved receipt is flagged with the receipt's ID in the
+    Near-Duplicate-Receipt header.
+
     Args:
         img_file (UploadFile): The uploaded image file of the grocery receipt.
         current_user (User): The authenticated user parsing the receipt.
+        async_mode (bool): Whether to queue the receipt instead of parsing it in the request.
+        reject_near_duplicates (bool): Whether to reject near-duplicates with a 409 instead of flagging them.
 
     Returns:
         GroceryReceiptSchema: The parsed receipt data.
@@ -35,13 +153,336 @@ async def parse_grocery_receipt_image(
 
     file_extension = Path(img_file.filename).suffix
     img_type = ImageType.from_extension(extension=file_extension)
-    img_content = await img_file.read()
 
-    # todo: handle separate cases for invalid image, file type, already existing receipt, server error
-    if is_receipt_in_db(img_content=img_content, db_url=settings.database_url):
-        raise HTTPException(
-            status_code=409,
-            detail="Receipt already exists in the database.",
+    with track_stage("upload_hash"):
+        upload = await spool_upload(img_file, max_bytes=settings.max_upload_bytes)
+
+    with upload:
+        # todo: handle separate cases for invalid image, file type, already existing receipt, server error
+        analysis, near_duplicate_id = await check_receipt_not_in_db(
+            upload, username=current_user, reject_near_duplicates=reject_near_duplicates, parse=not async_mode
+        )
+        response.headers.update(get_near_duplicate_headers(near_duplicate_id))
+
+        if async_mode:
+            job = await enqueue_receipt_job_async(
+                username=current_user,
+                img_content=bytes(upload.content),
+                img_type=img_type.value,
+                image_hash=upload.image_hash,
+                max_attempts=settings.job_max_attempts,
+                db_url=settings.database_url,
+            )
+            return JSONResponse(
+                status_code=202,
+                content=ReceiptJobRead.model_validate(job).model_dump(mode="json"),
+                headers={
+                    "Location": str(request.url_for("get_receipt_job", job_id=job.id)),
+                    **get_near_duplicate_headers(near_duplicate_id),
+                },
+            )
+
+        return await parse_grocery_receipt_async(
+            user=current_user,
+            img_content=upload.content,
+            img_type=img_type,
+            image_hash=upload.image_hash,
+            analysis=analysis,
+        )
+
+
+@router.post(
+    "/grocery_receipt/stream",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {"schema": ReceiptStreamEvent.model_json_schema()}}}},
+)
+async def stream_grocery_receipt_image(
+    img_file: Annotated[UploadFile, File()],
+    current_user: str = "mock_user",  # Mocked for example purposes
+    reject_near_duplicates: bool = False,
+) -> StreamingResponse:
+    """
+    Parse a grocery receipt image, streaming the store and each purchase as soon as they are parsed.
+
+    Results are streamed as newline-delimited ReceiptStreamEvent JSON; the last event carries the
+    validated receipt, or an error if parsing failed. Near-duplicates are flagged as by
+    parse_grocery_receipt_image.
+
+    Args:
+        img_file (UploadFile): The uploaded image file of the grocery receipt.
+        current_user (User): The authenticated user parsing the receipt.
+        reject_near_duplicates (bool): Whether to reject near-duplicates with a 409 instead of flagging them.
+
+    Returns:
+        StreamingResponse: The receipt events.
+    """
+    img_type = ImageType.from_extension(extension=Path(img_file.filename).suffix)
+
+    with track_stage("upload_hash"):
+        upload = await spool_upload(img_file, max_bytes=settings.max_upload_bytes)
+
+    try:
+        analysis, near_duplicate_id = await check_receipt_not_in_db(
+            upload, username=current_user, reject_near_duplicates=reject_near_duplicates
         )
+    except BaseException:
+        upload.close()
+        raise
+
+    async def stream_events() -> AsyncIterator[str]:
+        try:
+            async for event in stream_grocery_receipt(
+                user=current_user,
+                img_content=upload.content,
+                img_type=img_type,
+                image_hash=upload.image_hash,
+                analysis=analysis,
+            ):
+                yield event.model_dump_json() + "\n"
+        except Exception as err:
+            yield ReceiptStreamEvent(event=ReceiptStreamEventType.ERROR, detail=str(err)).model_dump_json() + "\n"
+        finally:
+            upload.close()
+
+    return StreamingResponse(
+        stream_events(), media_type="application/x-ndjson", headers=get_near_duplicate_headers(near_duplicate_id)
+    )
+
+
+@router.get("/grocery_receipts")
+async def list_grocery_receipts(
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    include_purchases: bool = False,
+    current_user: str = "mock_user",  # Mocked for example purposes
+) -> ReceiptPage:
+    """
+    List the saved receipts of the user from the most recent purchase, a page at a time.
+
+    Args:
+        cursor (str | None): The `next_cursor` of the previous page, omitted for the first page.
+        limit (int): The maximum number of receipts on the page.
+        include_purchases (bool): Whether to include the purchases of each receipt.
+        current_user (User): The authenticated user.
+
+    Returns:
+        ReceiptPage: The receipts and the cursor of the next page.
+    """
+    try:
+        return await list_receipts_async(
+            username=current_user,
+            limit=limit,
+            cursor=cursor,
+            include_purchases=include_purchases,
+            db_url=settings.database_url,
+        )
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err)) from err
+
+
+@router.get("/grocery_receipts/{receipt_id}")
+async def get_grocery_receipt(
+    receipt_id: int,
+    current_user: str = "mock_user",  # Mocked for example purposes
+) -> ReceiptRead:
+    """
+    Get a saved receipt of the user with its purchases.
+
+    Args:
+        receipt_id (int): The ID of the receipt.
+        current_user (User): The authenticated user.
+
+    Returns:
+        ReceiptRead: The receipt.
+    """
+    receipt = await get_receipt_async(receipt_id=receipt_id, username=current_user, db_url=settings.database_url)
+    if receipt is None:
+        raise HTTPException(status_code=404, detail="Receipt not found.")
+    return receipt
+
+
+@router.get("/jobs/{job_id}")
+async def get_receipt_job(
+    job_id: uuid.UUID,
+    current_user: str = "mock_user",  # Mocked for example purposes
+) -> ReceiptJobRead:
+    """
+    Get the status of a queued receipt parse of the user and its result once succeeded.
+
+    Args:
+        job_id (uuid.UUID): The ID of the job.
+        current_user (User): The authenticated user.
+
+    Returns:
+        ReceiptJobRead: The job.
+    """
+    job = await get_receipt_job_async(job_id=job_id, username=current_user, db_url=settings.database_url)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return ReceiptJobRead.model_validate(job)
+
+
+@router.get(
+    "/jobs/{job_id}/events",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {"schema": ReceiptJobRead.model_json_schema()}}}},
+)
+async def stream_receipt_job_events(
+    job_id: uuid.UUID,
+    request: Request,
+    current_user: str = "mock_user",  # Mocked for example purposes
+) -> StreamingResponse:
+    """
+    Stream the status of a queued receipt parse of the user as Server-Sent Events until it succeeds or fails.
+
+    A `job` event carrying the ReceiptJobRead is sent whenever the job changes, and a comment is sent
+    periodically to keep the connection open through proxies.
+
+    Args:
+        job_id (uuid.UUID): The ID of the job.
+        current_user (User): The authenticated user.
+
+    Returns:
+        StreamingResponse: The job events.
+    """
+    job = await get_receipt_job_async(job_id=job_id, username=current_user, db_url=settings.database_url)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    async def stream_events() -> AsyncIterator[str]:
+        current_job, last_event, last_sent_at = job, None, time.monotonic()
+        while True:
+            event = ReceiptJobRead.model_validate(current_job).model_dump_json()
+            if event != last_event:
+                yield f"event: job\ndata: {event}\n\n"
+                last_event, last_sent_at = event, time.monotonic()
+            elif time.monotonic() - last_sent_at >= SSE_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent_at = time.monotonic()
+
+            if current_job.status in (ReceiptJobStatus.SUCCEEDED, ReceiptJobStatus.FAILED):
+                return
+            await asyncio.sleep(settings.job_poll_interval_seconds)
+            if await request.is_disconnected():
+                return
+            current_job = await get_receipt_job_async(
+                job_id=job_id, username=current_user, db_url=settings.database_url
+            )
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.post(
+    "/grocery_receipts/batch",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {"schema": BatchReceiptResult.model_json_schema()}}}},
+)
+async def parse_grocery_receipt_images(
+    img_files: Annotated[list[UploadFile], File()],
+    current_user: str = "mock_user",  # Mocked for example purposes
+) -> StreamingResponse:
+    """
+    Parse many grocery receipt images concurrently.
+
+    Files already in the database and files repeated within the batch are reported as duplicates
+    without being parsed; files that look like other photos of the user's saved receipts are parsed
+    and flagged with the receipt's ID in `near_duplicate_of`. Results are streamed as newline-delimited
+    BatchReceiptResult JSON in completion order.
+
+    Args:
+        img_files (list[UploadFile]): The uploaded image files of the grocery receipts.
+        current_user (User): The authenticated user parsing the receipts.
+
+    Returns:
+        StreamingResponse: One BatchReceiptResult per uploaded file.
+    """
+    results: list[BatchReceiptResult] = []
+    to_parse: list[tuple[BatchReceiptResult, SpooledUpload, ImageType]] = []
+
+    uploads: list[SpooledUpload] = []
+    # The uploads are closed once streamed, or here if the response cannot be built
+    try:
+        for img_file in img_files:
+            try:
+                with track_stage("upload_hash"):
+                    uploads.append(await spool_upload(img_file, max_bytes=settings.max_upload_bytes))
+            except HTTPException as err:
+                results.append(
+                    BatchReceiptResult(filename=img_file.filename, status=BatchReceiptStatus.ERROR, detail=err.detail)
+                )
+            except OSError as err:
+                # E.g. the temporary directory is full
+                results.append(
+                    BatchReceiptResult(
+                        filename=img_file.filename,
+                        status=BatchReceiptStatus.ERROR,
+                        detail=f"Could not store the uploaded file: {err.strerror or err}",
+                    )
+                )
+
+        existing_hashes = await get_existing_image_hashes_async(
+            image_hashes=[upload.image_hash for upload in uploads], db_url=settings.database_url
+        )
+        seen_hashes = set()
+        for upload in uploads:
+            result = BatchReceiptResult(
+                filename=upload.filename, image_hash=upload.image_hash, status=BatchReceiptStatus.PARSED
+            )
+            try:
+                img_type = ImageType.from_extension(extension=Path(upload.filename).suffix)
+            except ValueError as err:
+                result.status, result.detail = BatchReceiptStatus.ERROR, str(err)
+                results.append(result)
+                continue
+
+            if upload.image_hash in existing_hashes:
+                result.status, result.detail = BatchReceiptStatus.DUPLICATE, "Receipt already exists in the database."
+            elif upload.image_hash in seen_hashes:
+                result.status, result.detail = BatchReceiptStatus.DUPLICATE, "Receipt repeated in the batch."
+            else:
+                to_parse.append((result, upload, img_type))
+            seen_hashes.add(upload.image_hash)
+            results.append(result)
+    except BaseException:
+        for upload in uploads:
+            upload.close()
+        raise
+
+    semaphore = asyncio.Semaphore(settings.batch_max_concurrency)
+    rate_limiter = get_llm_rate_limiter()
+
+    async def parse_one(result: BatchReceiptResult, upload: SpooledUpload, img_type: ImageType) -> BatchReceiptResult:
+        async with semaphore:
+            try:
+                analysis = await analyze_upload(upload)
+                result.near_duplicate_of = find_near_duplicate_image(analysis, username=current_user)
+                result.receipt = await parse_grocery_receipt_async(
+                    user=current_user,
+                    img_content=upload.content,
+                    img_type=img_type,
+                    image_hash=upload.image_hash,
+                    analysis=analysis,
+                    rate_limiter=rate_limiter,
+                )
+            except Exception as err:
+                result.status, result.detail = BatchReceiptStatus.ERROR, str(err)
+        return result
+
+    async def stream_results() -> AsyncIterator[str]:
+        for result in results:
+            if result.status != BatchReceiptStatus.PARSED:
+                yield result.model_dump_json() + "\n"
+
+        tasks = [asyncio.create_task(parse_one(*args)) for args in to_parse]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield (await next_done).model_dump_json() + "\n"
+        finally:
+            # Stop outstanding parses if the client disconnects
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for upload in uploads:
+                upload.close()
 
-    return parse_grocery_receipt(user=current_user, img_content=img_content, img_type=img_type)
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
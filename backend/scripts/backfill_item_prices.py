@@ -0,0 +1,36 @@
+"""
+Rebuild the item price history from the stored transactions.
+
+Receipts saved through the API add their prices as they are saved; run this once after creating the
+item_prices table, or to repair the history after editing transactions directly.
+
+Usage (from the backend directory):
+    python -m scripts.backfill_item_prices
+"""
+
+import argparse
+import time
+
+from sqlmodel import Session
+
+from config import settings
+from orm.engine import get_engine
+from orm.prices import rebuild_item_prices
+from orm.utils import bump_data_versions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-url", default=settings.database_url, help="Database URL, defaults to DATABASE_URL")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with Session(get_engine(args.db_url)) as session:
+        price_count = rebuild_item_prices(session=session)
+        bump_data_versions(session=session)
+        session.commit()
+    print(f"Rebuilt {price_count} item prices in {time.perf_counter() - start:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
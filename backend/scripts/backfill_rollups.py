@@ -0,0 +1,44 @@
+"""
+Rebuild the spending rollups from the stored transactions.
+
+Receipts saved through the API update the rollups as they are saved; run this once after creating the
+spending_rollups table, or to repair the rollups after editing transactions directly.
+
+Usage (from the backend directory):
+    python -m scripts.backfill_rollups
+    python -m scripts.backfill_rollups --username alice
+"""
+
+import argparse
+import time
+
+from sqlmodel import Session, select
+
+from config import settings
+from orm.data_models import User
+from orm.engine import get_engine
+from orm.rollups import rebuild_spending_rollups
+from orm.utils import bump_data_versions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--username", help="Only rebuild the rollups of this user")
+    parser.add_argument("--db-url", default=settings.database_url, help="Database URL, defaults to DATABASE_URL")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with Session(get_engine(args.db_url)) as session:
+        user_id = None
+        if args.username:
+            user_id = session.exec(select(User.id).where(User.username == args.username)).first()
+            if user_id is None:
+                parser.error(f"User {args.username} not found.")
+        transaction_count = rebuild_spending_rollups(session=session, user_id=user_id)
+        bump_data_versions(session=session, user_ids=[user_id] if user_id is not None else None)
+        session.commit()
+    print(f"Rebuilt the rollups of {transaction_count} transactions in {time.perf_counter() - start:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Check that incremental exports pick up transactions committed out of ID order, exiting with status 1 if not.
+
+Transaction IDs are assigned when a receipt is saved rather than when it commits, so a long save can
+commit transactions below the watermark of an export that ran meanwhile. The check inserts such a
+late transaction between two exports into a temporary SQLite database and expects every transaction
+to be exported exactly once.
+
+Usage (from the backend directory):
+    python -m scripts.check_export_watermark
+"""
+
+import argparse
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+import pyarrow.dataset as ds
+from sqlmodel import Session
+
+from config import settings
+from orm.data_models import GroceryReceiptSchema, Purchase, StoreBase, Transaction, UnitType, UserBase
+from orm.engine import get_engine
+from orm.export import export_transactions, read_watermark
+from orm.migrations import run_migrations
+from orm.utils import add_grocery_receipt_to_db
+
+
+def insert_transaction(db_url: str, transaction_id: int):
+    """Insert a transaction with a given ID, as committed by a concurrent receipt save."""
+    with Session(get_engine(db_url)) as session:
+        session.add(
+            Transaction(
+                id=transaction_id,
+                receipt_id=1,
+                item_id=1,
+                quantity=1,
+                unit_price=transaction_id,
+                unit_type=UnitType.EACH,
+            )
+        )
+        session.commit()
+
+
+def check(db_url: str, output_dir: Path) -> list[str]:
+    """Export before and after a transaction commits below the watermark.
+
+    Returns:
+        list[str]: The failed cases, empty if all pass.
+    """
+    # The receipt images are placeholders
+    settings.perceptual_dedup_enabled = False
+    with get_engine(db_url).connect() as connection:
+        run_migrations(connection)
+    for number in (1, 2):
+        parsed_data = GroceryReceiptSchema(
+            is_valid=True,
+            date_time=datetime(2025, 6, number),
+            user=UserBase(username="check_user"),
+            store=StoreBase(name="Check Store"),
+            purchases=[Purchase(name="BANANAS", category="produce", quantity=1, unit_price=number, unit_type="ea")],
+        )
+        add_grocery_receipt_to_db(img_content=f"receipt {number}".encode(), parsed_data=parsed_data, db_url=db_url)
+
+    # A save that got later IDs commits first, leaving a gap for one that started earlier
+    insert_transaction(db_url, transaction_id=10)
+    first = export_transactions(output_dir=output_dir, db_url=db_url)
+    insert_transaction(db_url, transaction_id=5)
+    second = export_transactions(output_dir=output_dir, db_url=db_url)
+    third = export_transactions(output_dir=output_dir, db_url=db_url)
+
+    failures = []
+    if (first.rows, second.rows, third.rows) != (3, 1, 0):
+        failures.append(f"exports wrote {first.rows}, {second.rows} and {third.rows} rows instead of 3, 1 and 0")
+    exported = Counter(ds.dataset(output_dir, partitioning="hive").to_table()["transaction_id"].to_pylist())
+    if set(exported) != {1, 2, 5, 10}:
+        failures.append(f"exported transactions {sorted(exported)} instead of [1, 2, 5, 10]")
+    if duplicates := sorted(transaction_id for transaction_id, count in exported.items() if count > 1):
+        failures.append(f"transactions {duplicates} were exported more than once")
+    if read_watermark(output_dir).transaction_id != 10:
+        failures.append(f"watermark is {read_watermark(output_dir).transaction_id} instead of 10")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        failures = check(db_url=f"sqlite:///{Path(tmp_dir) / 'check.sqlite3'}", output_dir=Path(tmp_dir) / "export")
+        get_engine(f"sqlite:///{Path(tmp_dir) / 'check.sqlite3'}").dispose()
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print("A transaction committed below the watermark was exported once by the next export.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Check that item names are matched to the items they abbreviate and not to different items, exiting with
+status 1 if not.
+
+Wrong matches merge the transactions of different items, which scripts/recanonicalize_items.py cannot
+undo, so run it after changing the normalization or similarity rules in orm/canonical.py.
+
+Usage (from the backend directory):
+    python -m scripts.check_item_matching
+    python -m scripts.check_item_matching --threshold 0.8
+"""
+
+import argparse
+import sys
+
+from config import settings
+from orm.canonical import CanonicalItemIndex
+
+# Receipt item names and the existing item name they must match
+MATCHING_NAMES = [
+    ("ORG BANANAS", "Organic Banana"),
+    ("ORG. BNNA", "ORGANIC BANANAS"),
+    ("CHKN BRST BNLS", "CHICKEN BREAST BONELESS"),
+    ("CHOC MILK", "CHOCOLATE MILK"),
+    ("GRD BF 80/20", "GROUND BEEF 80/20"),
+    ("WHL MLK", "WHOLE MILK"),
+    ("STRWBRY", "STRAWBERRY"),
+]
+
+# Receipt item names and the existing item name of a different item they must not match
+DISTINCT_NAMES = [
+    ("BUTTER", "BUTTERMILK"),
+    ("CORN", "CORNFLAKES"),
+    ("CHEESE", "CHEESECAKE"),
+    ("PEPPER", "PEPPERONI"),
+    ("EGG", "EGGPLANT"),
+    ("PEA", "PEANUTS"),
+    ("CUP", "CUPCAKE"),
+    ("MILK 2%", "MILK 1%"),
+]
+
+
+def check(threshold: float) -> list[str]:
+    """Match each name against an index holding only its expected or distinct item.
+
+    Returns:
+        list[str]: The failed cases, empty if all pass.
+    """
+    failures = []
+    for cases, should_match in ((MATCHING_NAMES, True), (DISTINCT_NAMES, False)):
+        for name, item_name in cases:
+            index = CanonicalItemIndex(threshold=threshold)
+            index.add(1, item_name)
+            if (index.match(name) == 1) != should_match:
+                failures.append(f"{name!r} {'did not match' if should_match else 'matched'} {item_name!r}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--threshold", type=float, default=settings.item_match_threshold, help="Defaults to ITEM_MATCH_THRESHOLD"
+    )
+    args = parser.parse_args()
+
+    failures = check(args.threshold)
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    total = len(MATCHING_NAMES) + len(DISTINCT_NAMES)
+    print(f"{total - len(failures)}/{total} item matching cases pass.")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
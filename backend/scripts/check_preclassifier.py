@@ -0,0 +1,51 @@
+"""
+Check that the pre-classifier rejects the bundled non-receipt images and passes the receipts, exiting with
+status 1 if not.
+
+Run it after changing the features, weights or PRECLASSIFIER_MIN_SCORE, and add misclassified photos
+to SAMPLES under resources/.
+
+Usage (from the backend directory):
+    python -m scripts.check_preclassifier
+    python -m scripts.check_preclassifier --min-score 0.5
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from agent.preclassifier import score_receipt_image
+from config import settings
+
+RESOURCES_DIR = Path(__file__).parent.parent / "resources"
+
+# Sample images and whether they show a receipt
+SAMPLES = [
+    ("receipt_1.HEIC", True),
+    ("not_receipt.jpg", False),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--min-score", type=float, default=settings.preclassifier_min_score, help="Defaults to PRECLASSIFIER_MIN_SCORE"
+    )
+    args = parser.parse_args()
+
+    failures = 0
+    for filename, is_receipt in SAMPLES:
+        image_score = score_receipt_image((RESOURCES_DIR / filename).read_bytes())
+        is_passed = image_score.score >= args.min_score
+        failures += is_passed != is_receipt
+        print(
+            f"{filename}: score {image_score.score:.2f}, {'passed' if is_passed else 'rejected'}"
+            f"{'' if is_passed == is_receipt else ' (wrong)'}"
+        )
+    print(f"{len(SAMPLES) - failures}/{len(SAMPLES)} samples classified correctly.")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
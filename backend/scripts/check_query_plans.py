@@ -0,0 +1,53 @@
+"""
+Check that the hot-path queries still read their tables through indexes, exiting with status 1 if not.
+
+Run it against a migrated database, e.g. in CI after the migrations or after changing a query or index.
+
+Usage (from the backend directory):
+    python -m scripts.check_query_plans
+    python -m scripts.check_query_plans --migrate --db-url sqlite:///plans.db
+"""
+
+import argparse
+import asyncio
+import sys
+
+from config import settings
+from orm.engine import dispose_engines
+from orm.migrations import get_migration_status_async, run_migrations_async
+from orm.query_plans import HOT_PATH_QUERIES, check_query_plans_async
+
+
+async def check(args: argparse.Namespace) -> bool:
+    try:
+        if args.migrate:
+            await run_migrations_async(db_url=args.db_url)
+        _, pending = await get_migration_status_async(db_url=args.db_url)
+        if pending:
+            print(f"{len(pending)} migrations are pending, apply them first or pass --migrate.", file=sys.stderr)
+            return False
+        regressions = await check_query_plans_async(db_url=args.db_url)
+    finally:
+        await dispose_engines()
+
+    for regression in regressions:
+        print(f"{regression.check}: {regression.reason} of {regression.table}\n{regression.plan}\n", file=sys.stderr)
+    print(
+        f"{len(HOT_PATH_QUERIES) - len({regression.check for regression in regressions})}/{len(HOT_PATH_QUERIES)} "
+        "hot-path queries use indexes."
+    )
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--migrate", action="store_true", help="Apply the pending migrations first")
+    parser.add_argument("--db-url", default=settings.database_url, help="Database URL, defaults to DATABASE_URL")
+    args = parser.parse_args()
+
+    if not asyncio.run(check(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Check that cached GET responses change once another process saves a receipt, exiting with status 1 if not.
+
+The receipt worker and scripts/ingest_receipts.py save receipts outside the API process, so the API
+must notice the change through the database rather than an in-process invalidation. The check runs
+against a temporary SQLite database and saves each receipt from a separate process.
+
+Usage (from the backend directory):
+    python -m scripts.check_response_cache
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+
+from app import app
+from config import settings
+from orm.data_models import GroceryReceiptSchema, Purchase, StoreBase, UserBase
+from orm.engine import dispose_engines, get_engine
+from orm.migrations import run_migrations
+from orm.utils import add_grocery_receipt_to_db
+from response_cache import get_response_cache
+
+USERNAME = "check_user"
+
+# Cached endpoints of the user's data and of the data shared by all users
+PATHS = [
+    f"/api/v0/grocery_receipts?current_user={USERNAME}",
+    f"/api/v0/analytics/spending?current_user={USERNAME}&period=day&start=2025-06-01&end=2025-06-30",
+    "/api/v0/prices/items/1?start=2025-06-01&end=2025-06-30",
+]
+
+
+def save_receipt(db_url: str, number: int):
+    """Save a receipt with a single purchase of the same item, run in a separate process."""
+    # The receipt images are placeholders
+    settings.perceptual_dedup_enabled = False
+    parsed_data = GroceryReceiptSchema(
+        is_valid=True,
+        date_time=datetime(2025, 6, number),
+        user=UserBase(username=USERNAME),
+        store=StoreBase(name="Check Store"),
+        purchases=[Purchase(name="BANANAS", category="produce", quantity=1, unit_price=number, unit_type="ea")],
+    )
+    add_grocery_receipt_to_db(img_content=f"receipt {number}".encode(), parsed_data=parsed_data, db_url=db_url)
+
+
+def save_receipt_in_process(db_url: str, number: int):
+    process = multiprocessing.get_context("spawn").Process(target=save_receipt, args=(db_url, number))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Saving receipt {number} failed with exit code {process.exitcode}.")
+
+
+def check(db_url: str) -> list[str]:
+    """Request each path before and after another process saves a receipt.
+
+    Returns:
+        list[str]: The failed cases, empty if all pass.
+    """
+    settings.database_url = db_url
+    settings.response_cache_enabled = True
+    with get_engine(db_url).connect() as connection:
+        run_migrations(connection)
+    save_receipt_in_process(db_url, number=1)
+
+    # Without the lifespan, which would load the dedup indexes and warm the LLM clients
+    client = TestClient(app)
+    failures = []
+    first = {path: client.get(path) for path in PATHS}
+    for path, response in first.items():
+        if response.status_code != 200:
+            failures.append(f"{path} failed with status {response.status_code}: {response.text}")
+        elif client.get(path).headers["etag"] != response.headers["etag"]:
+            failures.append(f"{path} was not cached")
+    if len(get_response_cache()) != len(PATHS):
+        failures.append(f"{len(get_response_cache())} responses cached instead of {len(PATHS)}")
+
+    save_receipt_in_process(db_url, number=2)
+    for path, response in first.items():
+        after = client.get(path)
+        if after.headers.get("etag") == response.headers.get("etag") or after.content == response.content:
+            failures.append(f"{path} served the cached response after another process saved a receipt")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        failures = check(db_url=f"sqlite:///{Path(tmp_dir) / 'check.sqlite3'}")
+        asyncio.run(dispose_engines())
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"Cached responses of {len(PATHS)} endpoints changed after another process saved a receipt.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Export the transactions joined with their items, stores and receipts to Parquet or Arrow IPC files.
+
+Files are partitioned by the month of the receipt (month=YYYY-MM) and can be read as one dataset, e.g.
+pyarrow.dataset.dataset(directory, partitioning="hive") or DuckDB's read_parquet('directory/*/*.parquet').
+Each run only exports the transactions saved since the previous run into the same directory.
+
+Usage (from the backend directory):
+    python -m scripts.export_transactions exports/transactions
+    python -m scripts.export_transactions exports/transactions --format arrow --full
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+from config import settings
+from orm.export import EXPORT_BATCH_SIZE, ExportFormat, export_transactions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output_dir", type=Path, help="Export directory, holding the watermark of previous runs")
+    parser.add_argument("--format", type=ExportFormat, default=ExportFormat.PARQUET, choices=list(ExportFormat))
+    parser.add_argument("--since", type=int, help="Export transactions with a greater ID instead of the watermark")
+    parser.add_argument(
+        "--full", action="store_true", help="Export all transactions, ignoring the watermark (use an empty directory)"
+    )
+    parser.add_argument("--username", help="Only export the transactions of this user")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="Rows fetched per chunk")
+    parser.add_argument("--db-url", default=settings.database_url, help="Database URL, defaults to DATABASE_URL")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    result = export_transactions(
+        output_dir=args.output_dir,
+        export_format=args.format,
+        since=0 if args.full else args.since,
+        username=args.username,
+        batch_size=args.batch_size,
+        db_url=args.db_url,
+    )
+    print(
+        f"Exported {result.rows} transactions ({result.since}, {result.until}] to {len(result.files)} files "
+        f"in {time.perf_counter() - start:.1f}s."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Ingest a directory or manifest of receipt images into the database.
+
+Images are hashed and checked against the database in bulk, so receipts already saved are never
+parsed. Images that look like other photos of receipts the user already saved are flagged, or
+skipped with --skip-near-duplicates. New images are parsed concurrently
+within the LLM rate limit and saved in batched transactions. Every processed file is appended to a
+checkpoint file, so an interrupted run resumes where it stopped. Failed files are not checkpointed
+and are retried on the next run.
+
+Without --yes each parsed receipt is shown for confirmation before it is saved.
+
+Usage (from the backend directory):
+    python -m scripts.ingest_receipts ~/receipts --user alice --yes
+    python -m scripts.ingest_receipts --manifest receipts.txt --concurrency 8 --yes
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from enum import StrEnum
+from pathlib import Path
+
+from agent.analysis import analyze_receipt_image_async
+from agent.image import shutdown_image_process_pool
+from agent.rate_limit import get_llm_rate_limiter
+from agent.utils import ImageType, parse_grocery_receipt_async
+from config import settings
+from main import get_user_confirmation, print_receipt_info
+from orm.data_models import GroceryReceipt, GroceryReceiptSchema
+from orm.dedup import load_dedup_index
+from orm.engine import dispose_engines
+from orm.perceptual import find_near_duplicate_receipt, format_perceptual_hash, load_perceptual_index
+from orm.utils import add_grocery_receipt_to_db, add_grocery_receipts_to_db, get_existing_image_hashes_async
+
+SUPPORTED_EXTENSIONS = {f".{image_type.value}" for image_type in ImageType}
+
+# Image hashes checked against the database per query
+HASH_LOOKUP_BATCH_SIZE = 1000
+
+
+class IngestStatus(StrEnum):
+    SAVED = "saved"
+    DUPLICATE = "duplicate"
+    INVALID = "invalid"
+    REJECTED = "rejected"
+    ERROR = "error"
+
+
+def find_images(paths: list[Path], manifest: Path | None) -> list[Path]:
+    """
+    List the supported images in the directories, files and manifest, without repeats.
+
+    Missing files and files of unsupported types are reported on stderr and skipped.
+    """
+    if manifest is not None:
+        paths = [*paths, *(Path(line.strip()) for line in manifest.read_text().splitlines() if line.strip())]
+
+    images = []
+    for path in paths:
+        if path.is_dir():
+            images.extend(sorted(file for file in path.rglob("*") if file.suffix.lower() in SUPPORTED_EXTENSIONS))
+        elif not path.is_file():
+            print(f"Skipping {path}: no such file.", file=sys.stderr)
+        elif path.suffix.lower() not in SUPPORTED_EXTENSIONS:
+            print(f"Skipping {path}: unsupported image type.", file=sys.stderr)
+        else:
+            images.append(path)
+    return list(dict.fromkeys(image.resolve() for image in images))
+
+
+def hash_image(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """Hash an image file in chunks, as GroceryReceipt.generate_image_hash would hash its content."""
+    hasher = GroceryReceipt.new_image_hasher()
+    with path.open("rb") as file:
+        while chunk := file.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+async def hash_image_async(path: Path) -> str | None:
+    """Hash an image file in a thread, or report it on stderr and return None if it cannot be read."""
+    try:
+        return await asyncio.to_thread(hash_image, path)
+    except OSError as err:
+        print(f"Could not read {path}: {err}", file=sys.stderr)
+        return None
+
+
+class Checkpoint:
+    """Append-only JSON lines file of processed images, flushed after every write."""
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def load(self) -> set[str]:
+        """Get the paths of the images processed by previous runs."""
+        if not self.path.exists():
+            return set()
+        with self.path.open() as file:
+            return {json.loads(line)["path"] for line in file if line.strip()}
+
+    def record(self, entries: list[dict]):
+        if not entries:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a") as file:
+            file.writelines(json.dumps(entry) + "\n" for entry in entries)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class Progress:
+    """Single-line progress bar with throughput and status counts, written to stderr."""
+
+    def __init__(self, total: int, width: int = 30):
+        self.total = total
+        self.width = width
+        self.counts: Counter[IngestStatus] = Counter()
+        self.start = time.perf_counter()
+
+    @property
+    def done(self) -> int:
+        return sum(self.counts.values())
+
+    def update(self, status: IngestStatus):
+        self.counts[status] += 1
+        self.render()
+
+    def render(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        eta = (self.total - self.done) / rate if rate else 0.0
+        filled = self.width * self.done // self.total if self.total else self.width
+        counts = " ".join(f"{status} {count}" for status, count in sorted(self.counts.items()))
+        sys.stderr.write(
+            f"\r[{'#' * filled}{'.' * (self.width - filled)}] {self.done}/{self.total} "
+            f"{rate:.2f} images/s ETA {eta:.0f}s {counts}\033[K"
+        )
+        sys.stderr.flush()
+
+    def finish(self):
+        self.render()
+        sys.stderr.write("\n")
+
+
+def confirm_receipt(path: Path, gr_schema: GroceryReceiptSchema) -> bool:
+    print(f"\n\n{path}")
+    print_receipt_info(gr_schema)
+    return get_user_confirmation()
+
+
+async def save_batch(
+    batch: list[tuple[Path, str, bytes, GroceryReceiptSchema]], checkpoint: Checkpoint, progress: Progress, db_url: str
+):
+    """Save receipts in one transaction, falling back to one transaction per receipt if it fails."""
+    receipts = [(img_content, gr_schema) for _, _, img_content, gr_schema in batch]
+    try:
+        await asyncio.to_thread(add_grocery_receipts_to_db, receipts=receipts, db_url=db_url)
+        saved = batch
+    except Exception:
+        saved = []
+        for entry in batch:
+            path, _, img_content, gr_schema = entry
+            try:
+                await asyncio.to_thread(
+                    add_grocery_receipt_to_db, img_content=img_content, parsed_data=gr_schema, db_url=db_url
+                )
+                saved.append(entry)
+            except Exception as err:
+                print(f"\nCould not save {path}: {err}", file=sys.stderr)
+                progress.update(IngestStatus.ERROR)
+
+    checkpoint.record(
+        [
+            {"path": str(path), "image_hash": image_hash, "status": IngestStatus.SAVED}
+            for path, image_hash, _, _ in saved
+        ]
+    )
+    for _ in saved:
+        progress.update(IngestStatus.SAVED)
+    batch.clear()
+
+
+async def ingest(args: argparse.Namespace):
+    try:
+        await ingest_images(args)
+    finally:
+        await dispose_engines()
+
+
+async def ingest_images(args: argparse.Namespace):
+    checkpoint = Checkpoint(args.checkpoint)
+    processed = checkpoint.load()
+    images = [image for image in find_images(args.paths, args.manifest) if str(image) not in processed]
+    print(f"{len(images)} images to ingest, {len(processed)} already processed.", file=sys.stderr)
+
+    await asyncio.to_thread(load_dedup_index, args.db_url)
+    await asyncio.to_thread(load_perceptual_index, args.db_url)
+    image_hashes = await asyncio.gather(*(hash_image_async(image) for image in images))
+    unique_hashes = list(dict.fromkeys(image_hash for image_hash in image_hashes if image_hash is not None))
+    existing_hashes = set()
+    for start in range(0, len(unique_hashes), HASH_LOOKUP_BATCH_SIZE):
+        existing_hashes |= await get_existing_image_hashes_async(
+            image_hashes=unique_hashes[start : start + HASH_LOOKUP_BATCH_SIZE], db_url=args.db_url
+        )
+
+    progress = Progress(total=len(images))
+    to_parse, seen_hashes, duplicates = [], set(), []
+    for image, image_hash in zip(images, image_hashes, strict=True):
+        if image_hash is None:
+            # Not checkpointed, so the image is retried by the next run like failed parses
+            progress.update(IngestStatus.ERROR)
+        elif image_hash in existing_hashes or image_hash in seen_hashes:
+            duplicates.append({"path": str(image), "image_hash": image_hash, "status": IngestStatus.DUPLICATE})
+            progress.update(IngestStatus.DUPLICATE)
+        else:
+            seen_hashes.add(image_hash)
+            to_parse.append((image, image_hash))
+    checkpoint.record(duplicates)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    rate_limiter = get_llm_rate_limiter()
+
+    async def parse(image: Path, image_hash: str):
+        async with semaphore:
+            try:
+                img_content = await asyncio.to_thread(image.read_bytes)
+                # Decoded once from the file for the near-duplicate check and the parse
+                analysis = await analyze_receipt_image_async(str(image))
+                receipt_id = None
+                if analysis.dhash is not None:
+                    receipt_id = find_near_duplicate_receipt(
+                        perceptual_hash=format_perceptual_hash(analysis.dhash), username=args.user
+                    )
+                if receipt_id is not None:
+                    if args.skip_near_duplicates:
+                        return image, image_hash, None, None, None
+                    print(f"\n{image} may be another photo of saved receipt {receipt_id}.", file=sys.stderr)
+                gr_schema = await parse_grocery_receipt_async(
+                    user=args.user,
+                    img_content=img_content,
+                    img_type=ImageType.from_extension(image.suffix),
+                    image_hash=image_hash,
+                    db_url=args.db_url,
+                    analysis=analysis,
+                    rate_limiter=rate_limiter,
+                )
+                return image, image_hash, img_content, gr_schema, None
+            except Exception as err:
+                return image, image_hash, None, None, err
+
+    batch = []
+    for task in asyncio.as_completed([parse(image, image_hash) for image, image_hash in to_parse]):
+        image, image_hash, img_content, gr_schema, err = await task
+        if err is not None:
+            print(f"\nCould not parse {image}: {err}", file=sys.stderr)
+            progress.update(IngestStatus.ERROR)
+            continue
+
+        status = None
+        if gr_schema is None:
+            # Another photo of a receipt the user already saved
+            status = IngestStatus.DUPLICATE
+        elif not gr_schema.is_valid and not args.include_invalid:
+            status = IngestStatus.INVALID
+        elif not args.yes and not await asyncio.to_thread(confirm_receipt, image, gr_schema):
+            status = IngestStatus.REJECTED
+        if status is not None:
+            checkpoint.record([{"path": str(image), "image_hash": image_hash, "status": status}])
+            progress.update(status)
+            continue
+
+        batch.append((image, image_hash, img_content, gr_schema))
+        if len(batch) >= args.batch_size:
+            await save_batch(batch, checkpoint=checkpoint, progress=progress, db_url=args.db_url)
+    if batch:
+        await save_batch(batch, checkpoint=checkpoint, progress=progress, db_url=args.db_url)
+
+    progress.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", type=Path, nargs="*", help="Image files or directories searched recursively")
+    parser.add_argument("--manifest", type=Path, help="File listing one image path per line")
+    parser.add_argument("--user", default="food_user", help="Username the receipts are saved for")
+    parser.add_argument("--concurrency", type=int, default=settings.batch_max_concurrency, help="Concurrent parses")
+    parser.add_argument("--batch-size", type=int, default=20, help="Receipts saved per transaction")
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        default=Path(".cache/ingest_checkpoint.jsonl"),
+        help="File recording processed images, to resume an interrupted run",
+    )
+    parser.add_argument("--yes", action="store_true", help="Save parsed receipts without asking for confirmation")
+    parser.add_argument(
+        "--skip-near-duplicates", action="store_true", help="Skip images that look like photos of saved receipts"
+    )
+    parser.add_argument("--include-invalid", action="store_true", help="Also save receipts parsed as invalid")
+    parser.add_argument("--db-url", default=settings.database_url, help="Database URL, defaults to DATABASE_URL")
+    args = parser.parse_args()
+    if not args.paths and args.manifest is None:
+        parser.error("Give image paths, directories or a --manifest.")
+
+    try:
+        asyncio.run(ingest(args))
+    finally:
+        shutdown_image_process_pool()
+
+
+if __name__ == "__main__":
+    main()
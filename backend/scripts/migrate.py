@@ -0,0 +1,49 @@
+"""
+Create the database tables and apply the pending schema migrations (see orm/migrations.py).
+
+On Postgres, indexes on existing tables are built with CREATE INDEX CONCURRENTLY, so the migrations
+can run against a live database without blocking receipt uploads.
+
+Usage (from the backend directory):
+    python -m scripts.migrate
+    python -m scripts.migrate --status
+"""
+
+import argparse
+import asyncio
+import logging
+
+from config import settings
+from orm.engine import dispose_engines
+from orm.migrations import get_migration_status_async, run_migrations_async
+
+
+async def migrate(args: argparse.Namespace):
+    try:
+        if args.status:
+            applied, pending = await get_migration_status_async(db_url=args.db_url)
+            for migration in applied:
+                print(f"{migration.version:>4}  applied {migration.applied_at:%Y-%m-%d %H:%M}  {migration.description}")
+            for migration in pending:
+                print(f"{migration.version:>4}  pending                   {migration.description}")
+            return
+
+        applied = await run_migrations_async(db_url=args.db_url)
+        print(f"Applied {len(applied)} migrations." if applied else "The database is up to date.")
+    finally:
+        await dispose_engines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--status", action="store_true", help="List the applied and pending migrations")
+    parser.add_argument("--db-url", default=settings.database_url, help="Database URL, defaults to DATABASE_URL")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("orm.migrations").setLevel(logging.INFO)
+    asyncio.run(migrate(args))
+
+
+if __name__ == "__main__":
+    main()
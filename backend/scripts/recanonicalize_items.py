@@ -0,0 +1,54 @@
+"""
+Merge duplicate items created before item canonicalization, e.g. "ORG BNNA" and "ORGANIC BANANAS".
+
+For each store, items whose names match an older item of the store are merged into it and every
+item name is recorded as an alias. Spending rollups are rebuilt if any items were merged, since
+they are keyed by the category of the item.
+
+Usage (from the backend directory):
+    python -m scripts.recanonicalize_items --dry-run
+    python -m scripts.recanonicalize_items --store-id 3
+"""
+
+import argparse
+
+from sqlmodel import Session, select
+
+from config import settings
+from orm.canonical import merge_duplicate_items
+from orm.data_models import Item, Store
+from orm.engine import get_engine
+from orm.rollups import rebuild_spending_rollups
+from orm.utils import bump_data_versions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store-id", type=int, help="Only merge the items of this store")
+    parser.add_argument("--dry-run", action="store_true", help="Print the merges without changing the database")
+    parser.add_argument("--db-url", default=settings.database_url, help="Database URL, defaults to DATABASE_URL")
+    args = parser.parse_args()
+
+    merged_count = 0
+    with Session(get_engine(args.db_url)) as session:
+        store_ids = [args.store_id] if args.store_id else session.exec(select(Store.id).order_by(Store.id)).all()
+        for store_id in store_ids:
+            # Names are read before merging, since merged items are deleted
+            names = dict(session.exec(select(Item.id, Item.name).where(Item.store_id == store_id)).all())
+            canonical_ids = merge_duplicate_items(session=session, store_id=store_id, dry_run=args.dry_run)
+            for item_id, canonical_id in canonical_ids.items():
+                print(f"Store {store_id}: {names[item_id]!r} -> {names[canonical_id]!r}")
+            merged_count += len(canonical_ids)
+            if not args.dry_run:
+                # Commit per store to keep transactions short on large catalogs
+                session.commit()
+
+        if merged_count and not args.dry_run:
+            rebuild_spending_rollups(session=session)
+            bump_data_versions(session=session)
+            session.commit()
+    print(f"{'Found' if args.dry_run else 'Merged'} {merged_count} duplicate items in {len(store_ids)} stores.")
+
+
+if __name__ == "__main__":
+    main()
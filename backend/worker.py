@@ -0,0 +1,126 @@
+"""
+Worker processing queued receipt parses (see orm/jobs.py).
+
+Each job is parsed with Gemini and, if the receipt is valid, saved to the database. Failed jobs are
+retried with exponential backoff. Several worker processes may run against the same database; the
+processes of a host share one dedup index through DEDUP_BLOOM_PATH.
+
+Usage (from the backend directory):
+    python worker.py --concurrency 4
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+
+from agent.analysis import analyze_receipt_image_async
+from agent.image import shutdown_image_process_pool
+from agent.rate_limit import get_llm_rate_limiter
+from agent.utils import ImageType, parse_grocery_receipt_async
+from config import settings
+from orm.data_models import GroceryReceiptSchema, ReceiptJob
+from orm.dedup import load_dedup_index, refresh_dedup_index_periodically
+from orm.engine import dispose_engines
+from orm.jobs import claim_receipt_job_async, complete_receipt_job_async, fail_receipt_job_async
+from orm.perceptual import format_perceptual_hash
+from orm.utils import add_grocery_receipt_to_db_async, is_image_hash_in_db_async
+
+logger = logging.getLogger(__name__)
+
+
+async def process_receipt_job(job: ReceiptJob, db_url: str) -> GroceryReceiptSchema:
+    """Parse the receipt of a job and save it to the database if valid and not saved yet."""
+    # The image is decoded once for the parse and the perceptual hash saved with the receipt
+    analysis = await analyze_receipt_image_async(job.image)
+    gr_schema = await parse_grocery_receipt_async(
+        user=job.username,
+        img_content=job.image,
+        img_type=ImageType(job.image_type),
+        image_hash=job.image_hash,
+        db_url=db_url,
+        analysis=analysis,
+        rate_limiter=get_llm_rate_limiter(),
+    )
+    # A previous attempt may have saved the receipt before failing to complete the job
+    if gr_schema.is_valid and not await is_image_hash_in_db_async(image_hash=job.image_hash, db_url=db_url):
+        await add_grocery_receipt_to_db_async(
+            img_content=job.image,
+            parsed_data=gr_schema,
+            db_url=db_url,
+            perceptual_hash=format_perceptual_hash(analysis.dhash) if analysis.dhash is not None else None,
+        )
+    return gr_schema
+
+
+async def run_job(job: ReceiptJob, db_url: str):
+    """Run a claimed job, recording its result or scheduling a retry."""
+    if job.attempts > job.max_attempts:
+        # The job was reclaimed after its last attempt outlived the lease
+        await fail_receipt_job_async(
+            job, error="Job lease expired.", retry_base_seconds=settings.job_retry_base_seconds, db_url=db_url
+        )
+        return
+
+    try:
+        gr_schema = await process_receipt_job(job, db_url=db_url)
+    except Exception as err:
+        status = await fail_receipt_job_async(
+            job, error=str(err), retry_base_seconds=settings.job_retry_base_seconds, db_url=db_url
+        )
+        logger.exception("Receipt job %s failed on attempt %d, now %s.", job.id, job.attempts, status)
+        return
+
+    if not await complete_receipt_job_async(job, result=gr_schema, db_url=db_url):
+        logger.warning("Receipt job %s was reclaimed by another worker before it completed.", job.id)
+
+
+async def run_worker(concurrency: int, db_url: str, stop: asyncio.Event):
+    """Process jobs with `concurrency` concurrent loops until `stop` is set."""
+
+    async def work():
+        while not stop.is_set():
+            try:
+                job = await claim_receipt_job_async(lease_seconds=settings.job_lease_seconds, db_url=db_url)
+            except Exception:
+                logger.exception("Could not claim a receipt job.")
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=settings.job_poll_interval_seconds)
+                except TimeoutError:
+                    pass
+                continue
+            await run_job(job, db_url=db_url)
+
+    await asyncio.gather(*(work() for _ in range(concurrency)))
+
+
+async def main(concurrency: int, db_url: str):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    await asyncio.to_thread(load_dedup_index, db_url)
+    refresh_task = asyncio.create_task(refresh_dedup_index_periodically(db_url))
+    logger.info("Receipt worker started with concurrency %d.", concurrency)
+    try:
+        await run_worker(concurrency=concurrency, db_url=db_url, stop=stop)
+    finally:
+        refresh_task.cancel()
+        await asyncio.gather(refresh_task, return_exceptions=True)
+        await dispose_engines()
+        shutdown_image_process_pool()
+    logger.info("Receipt worker stopped.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=settings.job_worker_concurrency)
+    parser.add_argument("--db-url", default=settings.database_url)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(main(concurrency=args.concurrency, db_url=args.db_url))